@@ -24,11 +24,9 @@ import common
 logger = common.init_logging('cloudnode')
 
 
-import BaseHTTPServer
-from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from SocketServer import ThreadingMixIn
 import threading
-from urlparse import urlparse
+import Queue
+import itertools
 import json
 import base64
 import ConfigParser
@@ -43,6 +41,7 @@ import tpm_nvram
 import secure_mount
 import time
 import hashlib
+import zlib
 import openstack
 import zipfile
 import cStringIO
@@ -51,6 +50,15 @@ import importlib
 import shutil
 import tpm_random
 import tpm_exec
+import tornado.ioloop
+import tornado.web
+import tornado.gen
+import tornado.concurrent
+import tornado.netutil
+import tornado.httpserver
+import tornado.httpclient
+import concurrent.futures
+import functools
 
 # read the config file
 config = ConfigParser.RawConfigParser()
@@ -59,23 +67,265 @@ config.read(common.CONFIG_FILE)
 #lock required for multithreaded operation
 uvLock = threading.Lock()
 
-class Handler(BaseHTTPRequestHandler):
-    parsed_path = '' 
+# priorities of the work queued for the TPM, lower runs first
+PRIORITY_INTEGRITY_QUOTE = 0
+PRIORITY_IDENTITY_QUOTE = 1
+PRIORITY_KEYS = 2
+
+class TPMWorker(object):
+    """Runs all TPM operations of the node on one dedicated thread, most urgent first.
+    
+    Integrity quotes for the verifier run ahead of identity quotes for the tenant, which run ahead of 
+    installing delivered keys.  Work of the same priority runs in the order it was submitted.
+    """
+    def __init__(self):
+        self.queue = Queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def run(self):
+        while True:
+            (_,_,future,fn,args) = self.queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception:
+                future.set_exception_info(*sys.exc_info()[1:])
+    
+    def submit(self,priority,fn,*args):
+        """Returns a future for fn(*args) that can be yielded from a coroutine"""
+        future = concurrent.futures.Future()
+        self.queue.put((priority,next(self.counter),future,fn,args))
+        return future
+    
+    def shutdown(self):
+        # finish the queued work first
+        self.queue.put((sys.maxint,next(self.counter),None,None,None))
+
+class QuoteBatch(object):
+    def __init__(self):
+        self.nonces = []
+        self.result = tornado.concurrent.Future()
+
+class QuoteBatcher(object):
+    """Coalesces concurrent quote requests with the same masks into a single TPM quote.
+    
+    The first request of a batch waits quote_batch_window seconds and is then queued for the TPM 
+    worker, unless no other quote request is in flight, in which case it is queued right away.  
+    Requests that arrive until the worker picks the batch up join it.  The batch is quoted 
+    once over the root of a Merkle tree of all their nonces, and each request gets the shared quote 
+    together with the proof that its nonce is in the tree.  A batch of one is quoted over its own nonce.
+    """
+    def __init__(self,window,tpm_worker):
+        self.window = window
+        self.tpm_worker = tpm_worker
+        # batches are closed from the TPM worker thread
+        self.lock = threading.Lock()
+        self.batches = {}
+        # quote requests being served, batched or not
+        self.in_flight = 0
+    
+    def run(self,key,batch,create_quote):
+        """Quotes a batch, runs on the TPM worker"""
+        # close the batch, later requests start the next one
+        with self.lock:
+            del self.batches[key]
+        if len(batch.nonces)==1:
+            return create_quote(batch.nonces[0]),[None]
+        root,proofs = tpm_quote.merkle_tree(batch.nonces)
+        quote = create_quote(root)
+        logger.debug("Quoted batch of %d requests"%len(batch.nonces))
+        return quote,proofs
+    
+    @tornado.gen.coroutine
+    def quote(self,key,nonce,create_quote,priority):
+        """Returns the quote and the Merkle proof for nonce (None if the quote is over nonce itself)"""
+        with self.lock:
+            batch = self.batches.get(key,None)
+            leader = batch is None
+            if leader:
+                batch = QuoteBatch()
+                self.batches[key] = batch
+            index = len(batch.nonces)
+            batch.nonces.append(nonce)
+            self.in_flight+=1
+            # waiting for others to join only pays off when there are others
+            wait = leader and self.window>0 and self.in_flight>1
+        
+        try:
+            if leader:
+                if wait:
+                    yield tornado.gen.sleep(self.window)
+                try:
+                    result = yield self.tpm_worker.submit(priority,self.run,key,batch,create_quote)
+                    batch.result.set_result(result)
+                except Exception:
+                    batch.result.set_exc_info(sys.exc_info())
+            
+            (quote,proofs) = yield batch.result
+        finally:
+            with self.lock:
+                self.in_flight-=1
+        raise tornado.gen.Return((quote,proofs[index]))
+
+class ChangeNotifier(object):
+    """Watches the IMA measurement list and tells the verifiers polling this node when it grows.
+    
+    Verifiers that want hints name a port with their quote requests, the port of their REST API.  
+    Each hint is signed with the node's key and carries the nonce of the last quote that verifier 
+    asked for, so that the verifier can tell it is fresh.  Hints go over TLS when enable_tls is on.  Hints are sent at most once every min_hint_interval seconds, changes in 
+    between are folded into the next one.  A verifier that can't be reached is forgotten until it 
+    polls again.
+    """
+    def __init__(self,server,check_interval,min_interval):
+        self.server = server
+        self.check_interval = check_interval
+        self.min_interval = min_interval
+        # (ip,port) -> nonce of the last quote requested
+        self.verifiers = {}
+        self.last_count = None
+        self.last_sent = 0
+        self.pending = None
+        self.scheme = 'https' if config.getboolean('general','enable_tls') else 'http'
+    
+    def register(self,ip,port,nonce):
+        self.verifiers[(ip,port)] = nonce
+    
+    def count(self):
+        """Returns a value that changes whenever measurements are added"""
+        # securityfs files always report a size of 0, the kernel keeps a count instead
+        countfile = os.path.join(os.path.dirname(common.IMA_ML),'runtime_measurements_count')
+        if os.path.exists(countfile):
+            with open(countfile,'r') as f:
+                return f.read().strip()
+        if os.path.exists(common.IMA_ML):
+            return os.path.getsize(common.IMA_ML)
+        return None
+    
+    def start(self):
+        """Start watching from the IOLoop of the calling thread"""
+        self.last_count = self.count()
+        tornado.ioloop.PeriodicCallback(self.check,self.check_interval*1000).start()
+    
+    def check(self):
+        count = self.count()
+        if count == self.last_count:
+            return
+        self.last_count = count
+        if len(self.verifiers)==0 or self.pending is not None:
+            return
+        wait = self.last_sent+self.min_interval-time.time()
+        if wait>0:
+            self.pending = tornado.ioloop.IOLoop.current().call_later(wait,self.send)
+        else:
+            self.send()
+    
+    def send(self):
+        self.pending = None
+        self.last_sent = time.time()
+        client = tornado.httpclient.AsyncHTTPClient()
+        for (ip,port),nonce in self.verifiers.items():
+            message = json.dumps({'instance_id':self.server.node_uuid,'nonce':nonce})
+            body = json.dumps({'message':message,'signature':crypto.rsa_sign(self.server.rsaprivatekey,message)})
+            url = "%s://%s:%d/v2/hints/%s"%(self.scheme,ip,port,self.server.node_uuid)
+            cb = functools.partial(self.on_response,(ip,port))
+            # nodes aren't given the verifier's CA, and hints are signed and carry nothing secret
+            client.fetch(url,method="POST",body=body,callback=cb,validate_cert=False)
+        logger.debug("Sent measurement change hints to %d verifiers"%len(self.verifiers))
+    
+    def on_response(self,verifier,response):
+        if response.error:
+            logger.warning("Unable to send measurement change hint to %s:%d: %s"%(verifier[0],verifier[1],response.error))
+            if isinstance(response.error, IOError) or (isinstance(response.error, tornado.httpclient.HTTPError) and response.error.code == 599):
+                self.verifiers.pop(verifier,None)
+
+# size of the chunks a measurement list is streamed in
+STREAM_CHUNK_SIZE = 65536
+
+class CompressedContentEncoding(tornado.web.OutputTransform):
+    """Applies the gzip or deflate content encoding, whichever the client lists first, to JSON responses.
+    
+    Every flushed chunk is compressed on its own so that streamed responses stay streamed.
+    """
+    # responses that are too short don't benefit from compression
+    MIN_LENGTH = 1024
+    COMPRESS_LEVEL = 6
+    
+    def __init__(self, request):
+        self._encoding = None
+        self._compressor = None
+        for encoding in request.headers.get("Accept-Encoding", "").split(','):
+            encoding = encoding.split(';')[0].strip()
+            if encoding in ['gzip','deflate']:
+                self._encoding = encoding
+                break
     
-    def do_HEAD(self):
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if self._encoding is not None and \
+                headers.get("Content-Type", "").split(";")[0] == 'application/json' and \
+                (not finishing or len(chunk) >= self.MIN_LENGTH) and \
+                "Content-Encoding" not in headers:
+            headers["Content-Encoding"] = self._encoding
+            # the gzip container is selected by adding 16 to the window bits
+            wbits = zlib.MAX_WBITS
+            if self._encoding == 'gzip':
+                wbits+=16
+            self._compressor = zlib.compressobj(self.COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+            chunk = self.transform_chunk(chunk, finishing)
+            if "Content-Length" in headers:
+                if finishing:
+                    headers["Content-Length"] = str(len(chunk))
+                else:
+                    del headers["Content-Length"]
+        return status_code, headers, chunk
+    
+    def transform_chunk(self, chunk, finishing):
+        if self._compressor is not None:
+            chunk = self._compressor.compress(chunk)
+            if finishing:
+                chunk+=self._compressor.flush(zlib.Z_FINISH)
+            else:
+                chunk+=self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return chunk
+
+class Handler(tornado.web.RequestHandler):
+    server = None
+    
+    def initialize(self, server):
+        self.server = server
+    
+    def write_error(self, status_code, **kwargs):
+        common.echo_json_response(self, status_code, self._reason)
+    
+    def head(self):
         """Not supported.  Will always return a 400 response"""
-        self.do_GET()
+        return self.get()
 
-    def do_GET(self):
+    @tornado.gen.coroutine
+    def get(self):
         """This method services the GET request typically from either the Tenant or the Cloud Verifier.
         
         Only tenant and cloudverifier uri's are supported. Both requests require a nonce parameter.  
         The Cloud verifier requires an additional mask paramter.  If the uri or parameters are incorrect, a 400 response is returned.
         """
         
-        logger.info('GET invoked from ' + str(self.client_address)  + ' with uri:' + self.path)
+        logger.info('GET invoked from ' + str(self.request.remote_ip)  + ' with uri:' + self.request.path)
+        
+        rest_params = common.get_restful_params(self.request.path)
+        if rest_params is None:
+            logger.warning('GET returning 400 response. uri not supported: ' + self.request.path)
+            common.echo_json_response(self, 400, "uri not supported")
+            return
         
-        rest_params = common.get_restful_params(self.path)
         if "keys" in rest_params and rest_params['keys']=='verify':
             if self.server.K is None:
                 logger.info('GET key challenge returning 400 response. bootstrap key not available')
@@ -114,13 +364,28 @@ class Handler(BaseHTTPRequestHandler):
                 return
             
             # identity quotes are always shallow
-            if not tpm_initialize.is_vtpm() or rest_params["quotes"]=='identity':
-                quote = tpm_quote.create_quote(nonce, self.server.rsapublickey_exportable,pcrmask)
+            deep = tpm_initialize.get_tpm_context().is_vtpm() and rest_params["quotes"]!='identity'
+            # the verifier's periodic integrity checks go ahead of tenant requests at the TPM
+            priority = (PRIORITY_INTEGRITY_QUOTE,PRIORITY_IDENTITY_QUOTE)[rest_params["quotes"]=='identity']
+            if not deep:
+                create_quote = lambda n: tpm_quote.create_quote(n, self.server.rsapublickey_exportable,pcrmask)
                 imaMask = pcrmask
             else:
-                quote = tpm_quote.create_deep_quote(nonce, self.server.rsapublickey_exportable, vpcrmask, pcrmask)
+                create_quote = lambda n: tpm_quote.create_deep_quote(n, self.server.rsapublickey_exportable, vpcrmask, pcrmask)
                 imaMask = vpcrmask
             
+            # requesters that can check a Merkle proof may share a quote with other requests
+            merkle_proof = None
+            if "batch" in rest_params and rest_params["batch"] is not None and int(rest_params["batch"],0) == 1:
+                quote,merkle_proof = yield self.server.quote_batcher.quote((deep,pcrmask,vpcrmask), nonce, create_quote, priority)
+            else:
+                quote = yield self.server.tpm_worker.submit(priority, create_quote, nonce)
+            
+            # the verifier wants to hear about new measurements between polls
+            if "hint" in rest_params and rest_params["hint"] is not None and rest_params["hint"].isdigit() and \
+                    self.server.change_notifier is not None:
+                self.server.change_notifier.register(self.request.remote_ip, int(rest_params["hint"]), nonce)
+            
             # Allow for a partial quote response (without pubkey) 
             if "partial" in rest_params and (rest_params["partial"] is None or int(rest_params["partial"],0) == 1):
                 response = { 
@@ -132,41 +397,79 @@ class Handler(BaseHTTPRequestHandler):
                     'pubkey': self.server.rsapublickey_exportable, 
                 }
             
+            if merkle_proof is not None:
+                response['merkle_proof'] = merkle_proof
+            
             # return a measurement list if available
             if tpm_quote.check_mask(imaMask, common.IMA_PCR):
                 if not os.path.exists(common.IMA_ML):
                     logger.warn("IMA measurement list not available: %s"%(common.IMA_ML))
                 else:
-                    with open(common.IMA_ML,'r') as f:
-                        ml = f.read()
-                    response['ima_measurement_list']=ml
+                    yield self.stream_json_response(200, "Success", response, 'ima_measurement_list', common.IMA_ML)
+                    logger.info('GET %s quote returning 200 response.'%(rest_params["quotes"]))
+                    return
             
             common.echo_json_response(self, 200, "Success", response)
             logger.info('GET %s quote returning 200 response.'%(rest_params["quotes"]))
             return
         
         else:
-            logger.warning('GET returning 400 response. uri not supported: ' + self.path)
+            logger.warning('GET returning 400 response. uri not supported: ' + self.request.path)
             common.echo_json_response(self, 400, "uri not supported")
             return
         
 
-    def do_POST(self):
+    @tornado.gen.coroutine
+    def stream_json_response(self,code,status,results,key,path):
+        """Like common.echo_json_response, but with the contents of the file at path as results[key].
+        
+        The file is sent in chunks straight from disk using chunked transfer encoding (compressed 
+        chunk by chunk if the client accepts it) instead of being read into memory first.
+        """
+        results = dict(results)
+        results[key] = ""
+        json_response = json.dumps({'code': code, 'status': status, 'results' : results})
+        # split the response around the empty placeholder string
+        field = '%s: "'%json.dumps(key)
+        (head,tail) = json_response.split(field+'"',1)
+        
+        self.set_status(code)
+        self.set_header('Content-Type', 'application/json')
+        self.write(head+field)
+        with open(path,'r') as f:
+            lines = []
+            size = 0
+            # whole lines keep multibyte characters intact for the JSON encoder
+            for line in f:
+                lines.append(line)
+                size+=len(line)
+                if size>=STREAM_CHUNK_SIZE:
+                    self.write(json.dumps(''.join(lines))[1:-1])
+                    yield self.flush()
+                    lines = []
+                    size = 0
+        self.write(json.dumps(''.join(lines))[1:-1]+'"'+tail)
+
+    @tornado.gen.coroutine
+    def post(self):
         """This method services the POST request typically from either the Tenant or the Cloud Verifier.
         
         Only tenant and cloudverifier uri's are supported. Both requests require a nonce parameter.  
         The Cloud verifier requires an additional mask parameter.  If the uri or parameters are incorrect, a 400 response is returned.
         """        
-        rest_params = common.get_restful_params(self.path)
+        rest_params = common.get_restful_params(self.request.path)
+        
+        if rest_params is None or "keys" not in rest_params:
+            logger.warning('POST returning 400 response. uri not supported: ' + self.request.path)
+            common.echo_json_response(self, 400, "uri not supported")
+            return
         
-        content_length = int(self.headers.get('Content-Length', 0))
-        if content_length <= 0:
-            logger.warning('POST returning 400 response, expected content in message. url:  ' + self.path)
+        if len(self.request.body) == 0:
+            logger.warning('POST returning 400 response, expected content in message. url:  ' + self.request.path)
             common.echo_json_response(self, 400, "expected content in message")
             return
         
-        post_body = self.rfile.read(content_length)
-        json_body = json.loads(post_body)
+        json_body = json.loads(self.request.body)
             
         b64_encrypted_key = json_body['encrypted_key']
         decrypted_key = crypto.rsa_decrypt(self.server.rsaprivatekey,base64.b64decode(b64_encrypted_key))
@@ -183,16 +486,24 @@ class Handler(BaseHTTPRequestHandler):
             self.server.add_V(decrypted_key)
             have_derived_key = self.server.attempt_decryption(self)
         else:
-            logger.warning('POST returning  response. uri not supported: ' + self.path)
+            logger.warning('POST returning  response. uri not supported: ' + self.request.path)
             common.echo_json_response(self, 400, "uri not supported")
             return
         logger.info('POST of %s key returning 200'%(('V','U')[rest_params["keys"] == "ukey"]))
         common.echo_json_response(self, 200, "Success")
+        self.finish()
         
         # no key yet, then we're done
         if not have_derived_key:
             return
         
+        try:
+            yield self.server.tpm_worker.submit(PRIORITY_KEYS, self.install_key)
+        except Exception as e:
+            logger.exception(e)
+    
+    def install_key(self):
+        """Store the derived key and deliver the payload.  Runs on the TPM worker."""
         # woo hoo we have a key 
         # ok lets write out the key now
         secdir = secure_mount.mount() # confirm that storage is still securely mounted
@@ -286,30 +597,11 @@ class Handler(BaseHTTPRequestHandler):
             
         return
 
-    def get_query_tag_value(self, path, query_tag):
-        """This is a utility method to query for specific the http parameters in the uri.  
-        
-        Returns the value of the parameter, or None if not found."""  
-        data = { }
-        parsed_path = urlparse(self.path)
-        query_tokens = parsed_path.query.split('&')
-        # find the 'ids' query, there can only be one
-        for tok in query_tokens:
-            query_tok = tok.split('=')
-            query_key = query_tok[0]
-            if query_key is not None and query_key == query_tag:
-                # ids tag contains a comma delimited list of ids
-                data[query_tag] = query_tok[1]    
-                break        
-        return data.get(query_tag,None) 
-    
-    def log_message(self, logformat, *args):
-        return
-                
-#consider using PooledProcessMixIn
-# https://github.com/muayyad-alsadi/python-PooledProcessMixIn
-class CloudNodeHTTPServer(ThreadingMixIn, HTTPServer):
-    """Http Server which will handle each request in a separate thread."""
+class CloudNodeHTTPServer(object):
+    """Http Server which serves requests from a Tornado IOLoop and runs all TPM work on a single TPMWorker.
+    
+    Connections are kept alive between requests so that pollers like the verifier can reuse them.
+    """
    
     ''' Do not modify directly unless you acquire uvLock. Set chosen for uniqueness of contained values''' 
     u_set = set([])
@@ -325,6 +617,10 @@ class CloudNodeHTTPServer(ThreadingMixIn, HTTPServer):
     K = None
     final_U = None
     node_uuid = None
+    tpm_worker = None
+    quote_batcher = None
+    change_notifier = None
+    ioloop = None
     
     def __init__(self, server_address, RequestHandlerClass, node_uuid):
         """Constructor overridden to provide ability to pass configuration arguments to the server"""
@@ -351,9 +647,40 @@ class CloudNodeHTTPServer(ThreadingMixIn, HTTPServer):
         if nvram_u is not None:
             logger.info("Existing U loaded from TPM NVRAM")
             self.add_U(nvram_u)
-        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
         self.enc_keyname = config.get('cloud_node','enc_keyname')
         self.node_uuid = node_uuid
+        self.tpm_worker = TPMWorker()
+        self.quote_batcher = QuoteBatcher(config.getfloat('cloud_node','quote_batch_window'),self.tpm_worker)
+        
+        # bind now so that a port in use is reported to the caller
+        self.sockets = tornado.netutil.bind_sockets(server_address[1],address=server_address[0] or None)
+        transforms = []
+        if config.getboolean('cloud_node','compress_responses'):
+            transforms.append(CompressedContentEncoding)
+        self.app = tornado.web.Application([
+            (r"/.*", RequestHandlerClass, {'server':self}),
+            ],transforms=transforms)
+        self.ioloop = tornado.ioloop.IOLoop()
+        if config.getboolean('cloud_node','measurement_hints'):
+            self.change_notifier = ChangeNotifier(self,
+                                                  config.getfloat('cloud_node','measurement_check_interval'),
+                                                  config.getfloat('cloud_node','min_hint_interval'))
+    
+    def serve_forever(self):
+        """Serve requests until shutdown() is called, typically from its own thread"""
+        self.ioloop.make_current()
+        server = tornado.httpserver.HTTPServer(self.app,idle_connection_timeout=config.getfloat('cloud_node','keepalive_timeout'))
+        server.add_sockets(self.sockets)
+        if self.change_notifier is not None:
+            self.change_notifier.start()
+        try:
+            self.ioloop.start()
+        finally:
+            server.stop()
+            self.tpm_worker.shutdown()
+    
+    def shutdown(self):
+        self.ioloop.add_callback(self.ioloop.stop)
 
 
     def add_U(self, u):
@@ -453,7 +780,9 @@ def main(argv=sys.argv):
     
     #initialize tpm 
     (ek,ekcert,aik) = tpm_initialize.init(self_activate=False,config_pw=config.get('cloud_node','tpm_ownerpassword')) # this tells initialize not to self activate the AIK
-    virtual_node = tpm_initialize.is_vtpm()
+    # look up the TPM state needed for quoting once instead of on every request
+    tpm_context = tpm_initialize.get_tpm_context()
+    virtual_node = tpm_context.is_vtpm()
     
     # try to get some TPM randomness into the system entropy pool
     tpm_random.init_system_rand()
@@ -478,6 +807,9 @@ def main(argv=sys.argv):
     if common.DEVELOP_IN_ECLIPSE:
         node_uuid = "C432FBB3-D2F1-4A97-9EF7-75BD81C866E9"
         
+    # find the registrar that owns this node when the registrar is a cluster
+    (registrar_ip,registrar_port) = registrar_client.route(config,node_uuid,registrar_ip,registrar_port)[0]
+    
     # register it and get back a blob
     keyblob = registrar_client.doRegisterNode(registrar_ip,registrar_port,node_uuid,ek,ekcert,aik)
     
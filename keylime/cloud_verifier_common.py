@@ -35,7 +35,8 @@ import socket
 import ca_util
 import sqlite3
 import revocation_notifier
-import keylime_sqlite
+import keylime_db
+import random
 
 logger = common.init_logging('cloudverifier_common')
 
@@ -65,6 +66,39 @@ class CloudInstance_Operational_State:
     }
     
 
+class CloudInstance(object):
+    """Record for an instance tracked by the Cloud Verifier.
+    
+    The durable fields are the columns persisted by the database (see init_db), the runtime 
+    fields only live as long as the verifier is polling the instance.  Rows returned by the 
+    database are turned into records with CloudInstance(row) and stored back with to_row().
+    """
+    # must match the columns in init_db
+    DURABLE_FIELDS = ('instance_id','v','ip','port','operational_state','public_key',
+                      'tpm_policy','vtpm_policy','metadata','ima_whitelist','revocation_key')
+    RUNTIME_FIELDS = ('registrar_keys','nonce','b64_encrypted_V','provide_V','num_retries','pending_event',
+                      'circuit_interval','last_hint','reported_state')
+    __slots__ = DURABLE_FIELDS + RUNTIME_FIELDS
+    
+    def __init__(self,row=None):
+        for field in self.DURABLE_FIELDS:
+            setattr(self,field,None if row is None else row[field])
+        self.registrar_keys = ''
+        self.nonce = ''
+        self.b64_encrypted_V = ''
+        self.provide_V = True
+        self.num_retries = 0
+        self.pending_event = None
+        # seconds until the next probe while the circuit to the node is open, None when closed
+        self.circuit_interval = None
+        # when the last measurement change hint from the node was acted on
+        self.last_hint = 0
+        # the operational state last published to the status change feed
+        self.reported_state = self.operational_state
+    
+    def to_row(self):
+        return {field:getattr(self,field) for field in self.DURABLE_FIELDS}
+
 class Timer(object):
     def __init__(self, verbose=False):
         self.verbose = verbose
@@ -80,6 +114,91 @@ class Timer(object):
         if self.verbose:
             print 'elapsed time: %f ms' % self.msecs
             
+class TokenBucket(object):
+    """Holds up to capacity tokens, refilled at rate tokens per second"""
+    __slots__ = ('rate','capacity','tokens','last')
+    
+    def __init__(self,rate,capacity,now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = now
+    
+    def refill(self,now):
+        self.tokens = min(self.capacity,self.tokens+(now-self.last)*self.rate)
+        self.last = now
+    
+    def wait(self,now):
+        """Returns 0 if a token is available, otherwise the seconds until one will be"""
+        self.refill(now)
+        if self.tokens>=1:
+            return 0
+        return (1-self.tokens)/self.rate
+    
+    def consume(self,now):
+        """Take a token.  Returns 0 if one was available, otherwise the seconds until one will be"""
+        wait = self.wait(now)
+        if wait==0:
+            self.tokens-=1
+        return wait
+
+class AdmissionControl(object):
+    """Rate limits for the REST API of the verifier.
+    
+    Every request takes a token from the bucket of its client (identified by its certificate) 
+    and from the bucket of its endpoint, status reads and changes being limited separately.  The 
+    API shares the IOLoop with polling, so while the loop lags behind by more than max_loop_lag 
+    seconds all requests are turned away to leave the loop to attestation.
+    """
+    # forget the buckets of idle clients once there are this many
+    MAX_CLIENTS = 1024
+    
+    def __init__(self,config):
+        self.enabled = config.getboolean('cloud_verifier','rate_limit')
+        self.burst = config.getfloat('cloud_verifier','rate_limit_burst')
+        self.client_rate = config.getfloat('cloud_verifier','rate_limit_client')
+        self.max_loop_lag = config.getfloat('cloud_verifier','max_loop_lag')
+        self.loop_lag = 0
+        self.clients = {}
+        self.endpoints = {}
+        now = time.time()
+        for endpoint in ['status','change']:
+            rate = config.getfloat('cloud_verifier','rate_limit_%s'%endpoint)
+            if rate>0:
+                self.endpoints[endpoint] = TokenBucket(rate,max(1,rate*self.burst),now)
+    
+    def client_bucket(self,client,now):
+        bucket = self.clients.get(client,None)
+        if bucket is None:
+            if len(self.clients)>=self.MAX_CLIENTS:
+                for key in self.clients.keys():
+                    self.clients[key].refill(now)
+                    if self.clients[key].tokens>=self.clients[key].capacity:
+                        del self.clients[key]
+            bucket = TokenBucket(self.client_rate,max(1,self.client_rate*self.burst),now)
+            self.clients[client] = bucket
+        return bucket
+    
+    def admit(self,client,endpoint):
+        """Returns 0 if the request may proceed, otherwise how many seconds the client should wait"""
+        if not self.enabled:
+            return 0
+        if self.max_loop_lag>0 and self.loop_lag>self.max_loop_lag:
+            return self.loop_lag
+        now = time.time()
+        buckets = []
+        if self.client_rate>0:
+            buckets.append(self.client_bucket(client,now))
+        if endpoint in self.endpoints:
+            buckets.append(self.endpoints[endpoint])
+        # only take tokens once every bucket has one so a rejected request costs nothing
+        wait = max([bucket.wait(now) for bucket in buckets]+[0])
+        if wait>0:
+            return wait
+        for bucket in buckets:
+            bucket.tokens-=1
+        return 0
+
 def init_mtls(config,section='cloud_verifier',generatedir='cv_ca'):
     if not config.getboolean('general',"enable_tls"):
         logger.warning("TLS is currently disabled, keys will be sent in the clear! Should only be used for testing.")
@@ -140,6 +259,10 @@ def init_mtls(config,section='cloud_verifier',generatedir='cv_ca'):
     else:
         my_priv_key = "%s/%s"%(tls_dir,my_priv_key)
         
+    # the server keeps this context for its lifetime.  Its session cache and session ticket keys
+    # let returning clients resume their TLS session instead of doing a full handshake, and 
+    # because the ticket keys are made here before any worker processes are forked, a ticket 
+    # issued by one worker is accepted by all of them.
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     context.load_verify_locations(cafile=ca_path)
     context.load_cert_chain(certfile=my_cert,keyfile=my_priv_key,password=my_key_pw)
@@ -160,9 +283,10 @@ def process_quote_response(instance, json_response, config):
         quote = json_response["quote"]
         
         ima_measurement_list = json_response.get("ima_measurement_list",None)
+        merkle_proof = json_response.get("merkle_proof",None)
         
         logger.debug("received quote:      %s"%quote)
-        logger.debug("for nonce:           %s"%instance['nonce'])
+        logger.debug("for nonce:           %s"%instance.nonce)
         logger.debug("received public key: %s"%received_public_key)
         logger.debug("received ima_measurement_list    %s"%(ima_measurement_list!=None))
     except Exception:
@@ -170,63 +294,119 @@ def process_quote_response(instance, json_response, config):
     
     # if no public key provided, then ensure we have cached it
     if received_public_key is None:
-        if instance.get('public_key',"") == "" or instance.get('b64_encrypted_V',"")=="":
+        if instance.public_key == "" or instance.b64_encrypted_V=="":
             logger.error("node did not provide public key and no key or encrypted_v was cached at CV")
             return False
-        instance['provide_V'] = False
-        received_public_key = instance['public_key']
+        instance.provide_V = False
+        received_public_key = instance.public_key
     
-    if instance.get('registrar_keys',"") is "":
+    if instance.registrar_keys is "":
         registrar_client.init_client_tls(config,'cloud_verifier')
-        registrar_keys = registrar_client.getKeys(config.get("general","registrar_ip"),config.get("general","registrar_tls_port"),instance['instance_id'])
+        registrar_keys = registrar_client.getRoutedKeys(config,instance.instance_id,config.get("general","registrar_ip"),config.get("general","registrar_tls_port"))
         if registrar_keys is None:
             logger.warning("AIK not found in registrar, quote not validated")
             return False
-        instance['registrar_keys']  = registrar_keys
+        instance.registrar_keys  = registrar_keys
         
     if tpm_quote.is_deep_quote(quote):
-        validQuote = tpm_quote.check_deep_quote(instance['nonce'],
+        validQuote = tpm_quote.check_deep_quote(instance.nonce,
                                                 received_public_key,
                                                 quote,
-                                                instance['registrar_keys']['aik'],
-                                                instance['registrar_keys']['provider_keys']['aik'],
-                                                instance['vtpm_policy'],
-                                                instance['tpm_policy'],
+                                                instance.registrar_keys['aik'],
+                                                instance.registrar_keys['provider_keys']['aik'],
+                                                instance.vtpm_policy,
+                                                instance.tpm_policy,
                                                 ima_measurement_list,
-                                                instance['ima_whitelist'])
+                                                instance.ima_whitelist,
+                                                merkle_proof)
     else:
-        validQuote = tpm_quote.check_quote(instance['nonce'],
+        validQuote = tpm_quote.check_quote(instance.nonce,
                                            received_public_key,
                                            quote,
-                                           instance['registrar_keys']['aik'],
-                                           instance['tpm_policy'],
+                                           instance.registrar_keys['aik'],
+                                           instance.tpm_policy,
                                            ima_measurement_list,
-                                           instance['ima_whitelist'])
+                                           instance.ima_whitelist,
+                                           merkle_proof)
     if not validQuote:
         return False
 
     # has public key changed? if so, clear out b64_encrypted_V, it is no longer valid
-    if received_public_key != instance.get('public_key',""):
-        instance['public_key'] = received_public_key
-        instance['b64_encrypted_V'] = ""
-        instance['provide_V'] = True
+    if received_public_key != instance.public_key:
+        instance.public_key = received_public_key
+        instance.b64_encrypted_V = ""
+        instance.provide_V = True
     
     # ok we're done
     return validQuote
 
 
+def jitter(delay):
+    """Randomize a delay to between half and all of its value so retries to many nodes spread out"""
+    return delay/2.0 + random.uniform(0,delay/2.0)
+
+def retry_delay(config,attempt):
+    """Returns how long to wait before the given retry (counting from 0) to contact a node.
+    
+    With exponential_backoff the retry_interval is doubled on every attempt up to max_retry_interval.
+    """
+    interval = config.getfloat('cloud_verifier','retry_interval')
+    if not config.getboolean('cloud_verifier','exponential_backoff'):
+        return interval
+    maximum = config.getfloat('cloud_verifier','max_retry_interval')
+    return jitter(min(interval*(2**min(attempt,32)),maximum))
+
+def encrypt_v(instance):
+    """Encrypt V with the public key of the node and cache the result in the instance"""
+    instance.b64_encrypted_V = base64.b64encode(crypto.rsa_encrypt(crypto.rsa_import_pubkey(instance.public_key),str(base64.b64decode(instance.v))))
+    return instance.b64_encrypted_V
+
+def restore_instance(row):
+    """Rebuild an instance loaded from the database after a warm restart of the verifier.
+    
+    The cached public key comes back with the row, the encrypted V is recomputed from it so 
+    it does not have to be derived again when V is next provided.
+    """
+    instance = CloudInstance(row)
+    if instance.public_key:
+        try:
+            encrypt_v(instance)
+        except Exception as e:
+            logger.warning("Unable to encrypt V with cached public key for instance %s: %s"%(instance.instance_id,e))
+            instance.b64_encrypted_V = ""
+    return instance
+
+def check_hint(instance,message,signature,now,config):
+    """Check a measurement change hint from a node.  
+    
+    Raises an exception if the hint isn't signed by the node or isn't for the last nonce sent to it.  
+    Returns False if it came too soon after the last hint acted on, True if the node should be 
+    attested now.
+    """
+    if not instance.public_key:
+        raise Exception("public key of instance %s not yet known"%instance.instance_id)
+    # the message comes out of a json body as unicode
+    message = str(message)
+    if not crypto.rsa_verify(crypto.rsa_import_pubkey(instance.public_key),message,signature):
+        raise Exception("invalid signature")
+    hint = json.loads(message)
+    if hint.get('instance_id') != instance.instance_id or hint.get('nonce') != instance.nonce:
+        raise Exception("hint is not for the current nonce of instance %s"%instance.instance_id)
+    if now-instance.last_hint < config.getfloat('cloud_verifier','min_hint_interval'):
+        return False
+    instance.last_hint = now
+    return True
+
 def prepare_v(instance):
     # be very careful printing K, U, or V as they leak in logs stored on unprotected disks
     if common.DEVELOP_IN_ECLIPSE:
-        logger.debug("b64_V (non encrypted): " + instance['v'])
+        logger.debug("b64_V (non encrypted): " + instance.v)
         
-    if instance.get('b64_encrypted_V',"") !="":
-        b64_encrypted_V = instance['b64_encrypted_V']
+    if instance.b64_encrypted_V !="":
+        b64_encrypted_V = instance.b64_encrypted_V
         logger.debug("Re-using cached encrypted V")
     else:
-        # encrypt V with the public key
-        b64_encrypted_V = base64.b64encode(crypto.rsa_encrypt(crypto.rsa_import_pubkey(instance['public_key']),str(base64.b64decode(instance['v']))))
-        instance['b64_encrypted_V'] = b64_encrypted_V
+        b64_encrypted_V = encrypt_v(instance)
         
     logger.debug("b64_encrypted_V:" + b64_encrypted_V)
     post_data = {
@@ -240,28 +420,28 @@ def prepare_get_quote(instance):
     
     This method is part of the polling loop of the thread launched on Tenant POST. 
     """
-    instance['nonce'] = tpm_initialize.random_password(20)
+    instance.nonce = tpm_initialize.random_password(20)
     
     params = {
-        'nonce': instance['nonce'],
-        'mask': instance['tpm_policy']['mask'],
-        'vmask': instance['vtpm_policy']['mask'],
+        'nonce': instance.nonce,
+        'mask': instance.tpm_policy['mask'],
+        'vmask': instance.vtpm_policy['mask'],
         }
     
     return params
 
 def process_get_status(instance):
-    if isinstance(instance['ima_whitelist'],dict) and 'whitelist' in instance['ima_whitelist']:
-        wl_len = len(instance['ima_whitelist']['whitelist'])
+    if isinstance(instance.ima_whitelist,dict) and 'whitelist' in instance.ima_whitelist:
+        wl_len = len(instance.ima_whitelist['whitelist'])
     else:
         wl_len = 0
-    response = {'operational_state':instance['operational_state'],
-                'v':instance['v'],
-                'ip':instance['ip'],
-                'port':instance['port'],
-                'tpm_policy':instance['tpm_policy'],
-                'vtpm_policy':instance['vtpm_policy'],
-                'metadata':instance['metadata'],
+    response = {'operational_state':instance.operational_state,
+                'v':instance.v,
+                'ip':instance.ip,
+                'port':instance.port,
+                'tpm_policy':instance.tpm_policy,
+                'vtpm_policy':instance.vtpm_policy,
+                'metadata':instance.metadata,
                 'ima_whitelist_len':wl_len,
                 }
     return response  
@@ -287,20 +467,20 @@ def get_query_tag_value(path, query_tag):
 def handleVerificationError(instance):
 
     # prepare the revocation message:
-    revocation = {'ip':instance['ip'],
-                'port':instance['port'],
-                'tpm_policy':instance['tpm_policy'],
-                'vtpm_policy':instance['vtpm_policy'],
-                'metadata':instance['metadata'],
+    revocation = {'ip':instance.ip,
+                'port':instance.port,
+                'tpm_policy':instance.tpm_policy,
+                'vtpm_policy':instance.vtpm_policy,
+                'metadata':instance.metadata,
                 } 
     
     revocation['time_revoked'] = time.asctime()
     tosend={'revocation': json.dumps(revocation)}
             
     #also need to load up private key for signing revocations
-    if instance['revocation_key']!="":
+    if instance.revocation_key!="":
         global signing_key
-        signing_key = crypto.rsa_import_privkey(instance['revocation_key'])
+        signing_key = crypto.rsa_import_privkey(instance.revocation_key)
         tosend['signature']=crypto.rsa_sign(signing_key,tosend['revocation'])
         
         #print "verified? %s"%crypto.rsa_verify(signing_key, tosend['signature'], tosend['revocation'])
@@ -310,7 +490,7 @@ def handleVerificationError(instance):
     revocation_notifier.notify(tosend)
 
 # ===== sqlite stuff =====
-def init_db(db_filename):
+def init_db(db_filename,config=None):
     # in the form key, SQL type
     cols_db = {
         'instance_id': 'TEXT PRIMARY_KEY',
@@ -329,16 +509,136 @@ def init_db(db_filename):
     # these are the columns that contain json data and need marshalling
     json_cols_db = ['tpm_policy','vtpm_policy','metadata','ima_whitelist']
     
-    # in the form key : default value
-    exclude_db = {
-        'registrar_keys': '',
-        'nonce': '',
-        'b64_encrypted_V': '',
-        'provide_V': True,
-        'num_retries': 0,
-        'pending_event': None,
+    # runtime only fields and their defaults live in CloudInstance
+    exclude_db = {}
+    return keylime_db.open_db(db_filename,cols_db,json_cols_db,exclude_db,config,'cloud_verifier')
+
+def init_sweep_db(db_filename,config=None):
+    """Open the table of on-demand attestation sweeps, stored next to the instance data.
+    
+    Each sweep is a row keyed by its handle in the instance_id column.
+    """
+    cols_db = {
+        'instance_id': 'TEXT PRIMARY_KEY',
+        'created': 'REAL',
+        'results': 'TEXT',
         }
-    return keylime_sqlite.KeylimeDB(db_filename,cols_db,json_cols_db,exclude_db)
+    json_cols_db = ['results']
+    exclude_db = {}
+    (base,ext) = os.path.splitext(db_filename)
+    return keylime_db.open_db("%s_sweeps%s"%(base,ext),cols_db,json_cols_db,exclude_db,config,'cloud_verifier')
+
+class EventLog(object):
+    """Ordered log of the operational state transitions of instances for the status change feed.
+    
+    Events are rows of a sqlite table whose rowid is the sequence number, so all worker processes 
+    of the verifier share one ordering.  Only the most recent max_events are kept.  With a db_engine
+    other than sqlite there is a single worker process and the log is kept in memory.
+    """
+    COLUMNS = ('seq','instance_id','old_state','new_state','timestamp')
+    
+    def __init__(self,db_filename,max_events):
+        self.db_filename = db_filename
+        self.max_events = max_events
+        self.conn = None
+        self.pid = None
+        if db_filename!=':memory:':
+            with sqlite3.connect(db_filename) as conn:
+                self.create(conn)
+            os.chmod(db_filename,0o600)
+    
+    def create(self,conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS events(seq INTEGER PRIMARY KEY AUTOINCREMENT, instance_id TEXT, old_state INT, new_state INT, timestamp REAL)")
+        conn.commit()
+    
+    def connect(self):
+        # connections can't be shared with forked worker processes
+        if self.conn is None or self.pid!=os.getpid():
+            self.conn = sqlite3.connect(self.db_filename)
+            self.pid = os.getpid()
+            if self.db_filename==':memory:':
+                self.create(self.conn)
+        return self.conn
+    
+    def append(self,transitions):
+        """Add (instance_id,old_state,new_state,timestamp) transitions in one transaction and return them as events"""
+        conn = self.connect()
+        events = []
+        with conn:
+            for transition in transitions:
+                cur = conn.execute("INSERT INTO events(instance_id,old_state,new_state,timestamp) VALUES(?,?,?,?)",transition)
+                events.append(dict(zip(self.COLUMNS,(cur.lastrowid,)+tuple(transition))))
+            if len(events)>0:
+                conn.execute("DELETE FROM events WHERE seq<=?",(events[-1]['seq']-self.max_events,))
+        return events
+    
+    def read(self,since,limit):
+        """Returns up to limit events after sequence number since, oldest first"""
+        rows = self.connect().execute("SELECT seq,instance_id,old_state,new_state,timestamp FROM events WHERE seq>? ORDER BY seq LIMIT ?",(since,limit)).fetchall()
+        return [dict(zip(self.COLUMNS,row)) for row in rows]
+    
+    def bounds(self):
+        """Returns the sequence numbers of the oldest and newest events kept, 0 if there are none"""
+        (first,last) = self.connect().execute("SELECT MIN(seq),MAX(seq) FROM events").fetchone()
+        return (first or 0,last or 0)
+
+def init_event_db(db_filename,config):
+    """Open the log of operational state transitions, stored next to the instance data"""
+    if config.get('cloud_verifier','db_engine')=='sqlite':
+        (base,ext) = os.path.splitext(db_filename)
+        event_filename = "%s_events%s"%(base,ext)
+    else:
+        event_filename = ':memory:'
+    return EventLog(event_filename,config.getint('cloud_verifier','max_events'))
+
+class HintInbox(object):
+    """Measurement change hints received by one worker process for instances polled by another.
+    
+    Hints arrive on the listener shared by all worker processes of the verifier.  A worker that 
+    receives a hint for an instance it does not poll leaves it in a sqlite table, which every worker 
+    checks for hints of its own instances.  Hints older than max_age seconds are dropped.
+    """
+    def __init__(self,db_filename,max_age):
+        self.db_filename = db_filename
+        self.max_age = max_age
+        self.conn = None
+        self.pid = None
+        with sqlite3.connect(db_filename) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS hints(instance_id TEXT PRIMARY KEY, message TEXT, signature TEXT, received REAL)")
+            conn.commit()
+        os.chmod(db_filename,0o600)
+    
+    def connect(self):
+        # connections can't be shared with forked worker processes
+        if self.conn is None or self.pid!=os.getpid():
+            self.conn = sqlite3.connect(self.db_filename)
+            self.pid = os.getpid()
+        return self.conn
+    
+    def put(self,instance_id,message,signature,now):
+        conn = self.connect()
+        conn.execute("INSERT OR REPLACE INTO hints(instance_id,message,signature,received) VALUES(?,?,?,?)",(instance_id,message,signature,now))
+        conn.commit()
+    
+    def take(self,instance_ids,now):
+        """Remove and return the (instance_id,message,signature) of the hints for any of instance_ids"""
+        conn = self.connect()
+        taken = []
+        for (instance_id,message,signature,received) in conn.execute("SELECT instance_id,message,signature,received FROM hints").fetchall():
+            if instance_id in instance_ids:
+                taken.append((instance_id,message,signature))
+                conn.execute("DELETE FROM hints WHERE instance_id=? AND received=?",(instance_id,received))
+        conn.execute("DELETE FROM hints WHERE received<?",(now-self.max_age,))
+        conn.commit()
+        return taken
+
+def init_hint_db(db_filename,config):
+    """Open the hints shared between worker processes, None if there is only one worker process"""
+    if config.getint('cloud_verifier','multiprocessing_pool_num_workers')==1:
+        return None
+    (base,ext) = os.path.splitext(db_filename)
+    # a hint no worker took within a few checks is for an instance no worker polls
+    return HintInbox("%s_hints%s"%(base,ext),max(1,10*config.getfloat('cloud_verifier','hint_check_interval')))
 
 def test_sql(): 
     # testing
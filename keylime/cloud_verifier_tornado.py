@@ -28,17 +28,89 @@ import traceback
 import sys
 import tornado.ioloop
 import tornado.web
+import tornado.process
+import tornado.iostream
+import ssl
+import tornado.locks
+import tornado.gen
+import math
+import time
 import functools
+import datetime
+import registrar_client
+import collections
+import uuid
 from tornado import httpserver
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httputil import url_concat
+from concurrent.futures import ThreadPoolExecutor
 import cloud_verifier_common
 import revocation_notifier
 
 config = ConfigParser.SafeConfigParser()
 config.read(common.CONFIG_FILE)
 
+# how often to check how far the IOLoop lags behind in seconds
+LOOP_LAG_CHECK_INTERVAL = 0.25
+
+# the instances polled by this worker process by instance_id
+polled_instances = {}
+
+# the port nodes send measurement change hints to, None if hints are off
+hint_port = None
+
+# hints for instances polled by other worker processes, None with a single worker process
+hint_inbox = None
+
+# the status change feed, None until the verifier is started
+status_feed = None
+
+# the most events returned by one request to the status change feed
+MAX_EVENTS_PER_RESPONSE = 1000
+
+# how often in seconds the transitions published to the status change feed are written to the event log
+EVENT_FLUSH_INTERVAL = 0.1
+
+# how long in seconds the outcome of an on-demand attestation sweep is kept
+SWEEP_RETENTION = 3600
+
+# how often in seconds the outcomes of running sweeps are written to the sweep database
+SWEEP_FLUSH_INTERVAL = 1
+
+# the instance fields an attestation sweep may select instances by
+SWEEP_FILTER_COLUMNS = ['ip','port','operational_state']
+
 class BaseHandler(tornado.web.RequestHandler):
+    admission = None
+    # set when the TLS listener lets nodes without a client certificate in to send hints
+    require_client_cert = False
+    
+    def prepare(self):
+        cert = None
+        if isinstance(self.request.connection.stream, tornado.iostream.SSLIOStream):
+            cert = self.request.get_ssl_certificate()
+        
+        if self.require_client_cert and not cert:
+            common.echo_json_response(self, 403, "Client certificate required")
+            logger.warning("%s returning 403 response to %s, no client certificate"%(self.request.method,self.request.remote_ip))
+            self.finish()
+            return
+        
+        if self.admission is None:
+            return
+        
+        # clients are told apart by certificate when mutual TLS is on
+        client = self.request.remote_ip
+        if cert:
+            client = "%s/%s"%(cert.get('subject'),cert.get('serialNumber'))
+        
+        endpoint = 'status' if self.request.method in ('GET','HEAD') else 'change'
+        wait = self.admission.admit(client,endpoint)
+        if wait>0:
+            self.set_header('Retry-After', str(int(math.ceil(wait))))
+            common.echo_json_response(self, 429, "Too Many Requests")
+            logger.warning("%s returning 429 response to %s, rate limit exceeded"%(self.request.method,client))
+            self.finish()
 
     def write_error(self, status_code, **kwargs):
 
@@ -67,8 +139,9 @@ class MainHandler(tornado.web.RequestHandler):
 
 class InstancesHandler(BaseHandler):
     db = None
-    def initialize(self, db):
+    def initialize(self, db, admission=None):
         self.db = db
+        self.admission = admission
        
     def head(self):
         """HEAD not supported"""
@@ -93,9 +166,9 @@ class InstancesHandler(BaseHandler):
         instance_id = rest_params["instances"]
         
         if instance_id is not None:
-            instance = self.db.get_instance(instance_id)
-            if instance != None:
-                response = cloud_verifier_common.process_get_status(instance)
+            row = self.db.get_instance(instance_id)
+            if row != None:
+                response = cloud_verifier_common.process_get_status(cloud_verifier_common.CloudInstance(row))
                 common.echo_json_response(self, 200, "Success", response)
                 #logger.info('GET returning 200 response for instance_id: ' + instance_id)
                 
@@ -138,8 +211,10 @@ class InstancesHandler(BaseHandler):
         op_state == cloud_verifier_common.CloudInstance_Operational_State.FAILED or \
         op_state == cloud_verifier_common.CloudInstance_Operational_State.INVALID_QUOTE:
             self.db.remove_instance(instance_id)
+            publish_state(instance_id, op_state, None)
         else:            
             self.db.update_instance(instance_id, 'operational_state',cloud_verifier_common.CloudInstance_Operational_State.TERMINATED)
+            publish_state(instance_id, op_state, cloud_verifier_common.CloudInstance_Operational_State.TERMINATED)
 
         common.echo_json_response(self, 200, "Success")
         logger.info('DELETE returning 200 response for instance id: ' + instance_id)
@@ -180,14 +255,15 @@ class InstancesHandler(BaseHandler):
                     d['ima_whitelist'] = json_body['ima_whitelist']
                     d['revocation_key'] = json_body['revocation_key']
                     
-                    new_instance = self.db.add_instance(instance_id,d)
+                    new_row = self.db.add_instance(instance_id,d)
                    
                     # don't allow overwriting
-                    if new_instance is None:
+                    if new_row is None:
                         common.echo_json_response(self, 409, "Node of uuid %s already exists"%(instance_id))
                         logger.warning("Node of uuid %s already exists"%(instance_id))
                     else:    
-                        self.process_instance(new_instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
+                        publish_state(instance_id, None, new_row['operational_state'])
+                        process_instance(self.db, cloud_verifier_common.CloudInstance(new_row), cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
                         common.echo_json_response(self, 200, "Success")
                         logger.info('POST returning 200 response for adding instance id: ' + instance_id)
             else:
@@ -219,10 +295,11 @@ class InstancesHandler(BaseHandler):
             instance_id = rest_params["instances"]
             
             if instance_id is not None: # this is for reactivating 
-                new_instance = self.db.get_instance(instance_id)
-                if new_instance is not None:
-                    new_instance['operational_state']=cloud_verifier_common.CloudInstance_Operational_State.START
-                    self.process_instance(new_instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
+                row = self.db.get_instance(instance_id)
+                if row is not None:
+                    new_instance = cloud_verifier_common.CloudInstance(row)
+                    new_instance.operational_state=cloud_verifier_common.CloudInstance_Operational_State.START
+                    process_instance(self.db, new_instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
                     common.echo_json_response(self, 200, "Success")
                     logger.info('PUT returning 200 response for instance id: ' + instance_id)
                 else:
@@ -239,181 +316,731 @@ class InstancesHandler(BaseHandler):
         self.finish()
 
 
-    def invoke_get_quote(self, instance, need_pubkey):
-        params = cloud_verifier_common.prepare_get_quote(instance)
-        instance['operational_state'] = cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE
-        client = tornado.httpclient.AsyncHTTPClient()
+class AttestationsHandler(BaseHandler):
+    sweeps = None
+    def initialize(self, db, sweeps, admission=None):
+        self.db = db
+        self.sweeps = sweeps
+        self.admission = admission
+    
+    def get(self):
+        """This method handles the GET requests to track on-demand attestation sweeps.
+        
+        /v2/attestations/handle returns the outcome so far of every instance in the sweep.  Outcomes are 
+        pending, attested, invalid (the instance failed and polling of it stops), unreachable or skipped 
+        (the instance is not being attested).  /v2/attestations/ lists the handles of recent sweeps.
+        """
+        rest_params = common.get_restful_params(self.request.path)
+        if rest_params is None or "attestations" not in rest_params:
+            common.echo_json_response(self, 400, "uri not supported")
+            logger.warning('GET returning 400 response. uri not supported: ' + self.request.path)
+            return
         
-        partial_req = "1"
-        if need_pubkey:
-            partial_req = "0"
+        handle = rest_params["attestations"]
+        if handle is None:
+            common.echo_json_response(self, 200, "Success", {'handles':self.sweeps.db.get_instance_ids()})
+            return
         
-        url = "http://%s:%d/v2/quotes/integrity/nonce/%s/mask/%s/vmask/%s/partial/%s/"%(instance['ip'],instance['port'],params["nonce"],params["mask"],params['vmask'],partial_req) 
-        # the following line adds the instance and params arguments to the callback as a convenience
-        cb = functools.partial(self.on_get_quote_response, instance, url)
-        client.fetch(url, callback=cb)
+        row = self.sweeps.db.get_instance(handle)
+        if row is None:
+            common.echo_json_response(self, 404, "attestation handle not found")
+            return
+        # sweeps started by this process may be ahead of what was written out
+        if handle in self.sweeps.results:
+            row['results'] = self.sweeps.results[handle]
+        counts = {}
+        for outcome in row['results'].values():
+            counts[outcome] = counts.get(outcome,0)+1
+        response = {'created':row['created'],
+                    'done':'pending' not in counts,
+                    'counts':counts,
+                    'results':row['results']}
+        common.echo_json_response(self, 200, "Success", response)
     
-    def on_get_quote_response(self, instance, url, response):
-        if instance is None:
-            raise Exception("instance deleted while being processed")
-        if response.error: 
-            # this is a connection error, retry get quote
-            if isinstance(response.error, IOError) or (isinstance(response.error, tornado.web.HTTPError) and response.error.code == 599):
-                self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE_RETRY)
+    @tornado.gen.coroutine
+    def post(self):
+        """This method handles the POST requests to attest instances right away.
+        
+        POST to /v2/attestations/ with a json block holding either a list of instance_ids or a filter, a 
+        dictionary of the instance fields ip, port or operational_state the instances must match.  An empty 
+        filter selects every instance.  Returns the handle to track the sweep with.
+        """
+        rest_params = common.get_restful_params(self.request.path)
+        if rest_params is None or "attestations" not in rest_params or rest_params["attestations"] is not None:
+            common.echo_json_response(self, 400, "uri not supported")
+            logger.warning('POST returning 400 response. uri not supported: ' + self.request.path)
+            return
+        
+        try:
+            json_body = json.loads(self.request.body)
+            if 'instance_ids' in json_body:
+                instance_ids = [str(i) for i in json_body['instance_ids']]
+            elif isinstance(json_body.get('filter',None),dict):
+                for key in json_body['filter']:
+                    if key not in SWEEP_FILTER_COLUMNS:
+                        raise Exception("can't filter on %s, valid fields are %s"%(key,", ".join(SWEEP_FILTER_COLUMNS)))
+                # the database is scanned on a thread of its own to keep polling going
+                instance_ids = yield self.sweeps.executor.submit(self.db.find_instance_ids,json_body['filter'])
             else:
-                #catastrophic error, do not continue
-                error = "Unexpected Get Quote response error for cloud instance " + instance['instance_id']  + ", Error: " + str(response.error)
-                logger.critical(error)
-                self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.FAILED)
-        else:
+                raise Exception("instance_ids or filter required")
+        except Exception as e:
+            common.echo_json_response(self, 400, "Error: %s"%e)
+            logger.warning("POST returning 400 response. Error: %s"%e)
+            return
+        
+        handle = self.sweeps.add(self.db, instance_ids)
+        common.echo_json_response(self, 200, "Success", {'handle':handle,'count':len(instance_ids)})
+        logger.info('POST started attestation sweep %s of %d instances'%(handle,len(instance_ids)))
+
+class SweepQueue(object):
+    """Attests instances on demand, ahead of their next poll, with at most max_concurrent quotes in flight.
+    
+    These attestations are out of band: they use their own nonce and leave the polling of the instance 
+    alone unless it fails, in which case the instance is marked invalid and its poller stops.  The 
+    outcome of every instance is kept in memory and written under the handle of its sweep to the sweep 
+    database every SWEEP_FLUSH_INTERVAL seconds and when the sweep is done, so that any worker process 
+    can report on it.
+    """
+    def __init__(self,db,max_concurrent):
+        self.db = db
+        self.max_concurrent = max_concurrent
+        self.queue = collections.deque()
+        self.active = 0
+        # results of the sweeps started by this process and how many of their instances are pending
+        self.results = {}
+        self.pending = {}
+        # handles with results not yet written out
+        self.dirty = set()
+        self.flush_timeout = None
+        # selects the instances of sweeps by filter
+        self.executor = ThreadPoolExecutor(max_workers=1)
+    
+    def add(self,instance_db,instance_ids):
+        now = time.time()
+        self.db.remove_instances_before('created',now-SWEEP_RETENTION)
+        # sweeps of this process may also have been removed by another worker process
+        if len(self.results)>0:
+            kept = set(self.db.get_instance_ids())
+            for handle in self.results.keys():
+                if handle not in kept:
+                    del self.results[handle]
+                    self.pending.pop(handle,None)
+                    self.dirty.discard(handle)
+        
+        handle = uuid.uuid4().hex
+        results = {instance_id:'pending' for instance_id in instance_ids}
+        self.db.add_instance(handle,{'created':now,'results':results})
+        self.results[handle] = results
+        self.pending[handle] = len(results)
+        for instance_id in instance_ids:
+            self.queue.append((instance_db,handle,instance_id))
+        self.dispatch()
+        return handle
+    
+    def dispatch(self):
+        while self.active<self.max_concurrent and len(self.queue)>0:
+            (instance_db,handle,instance_id) = self.queue.popleft()
+            self.active+=1
+            attest_once(instance_db, instance_id, functools.partial(self.on_done,handle,instance_id))
+    
+    def on_done(self,handle,instance_id,outcome):
+        self.active-=1
+        if handle in self.results:
+            self.results[handle][instance_id] = outcome
+            self.pending[handle]-=1
+            self.dirty.add(handle)
+            if self.pending[handle]<=0:
+                self.flush()
+            elif self.flush_timeout is None:
+                self.flush_timeout = tornado.ioloop.IOLoop.current().call_later(SWEEP_FLUSH_INTERVAL,self.flush)
+        self.dispatch()
+    
+    def flush(self):
+        """Write out the results of the sweeps that changed since they were last written"""
+        if self.flush_timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        for handle in self.dirty:
             try:
- 
-#                writeTime=False
-#                with cloud_verifier_common.Timer() as t:
-                    json_response = json.loads(response.body)
-
-                    # validate the cloud node response
-                    if cloud_verifier_common.process_quote_response(instance, json_response['results'], config):
-                        #only write timing if the quote was successful
-#                         if self.time_series_log_file_base_name is not None:
-#                             self.time_series_log_file.write("%s\n" % time.time())
-#                             self.time_series_log_file.flush()
-#                         writeTime=True
-                         
-                        if instance['provide_V']:
-                            self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V)
-                        else:
-                            self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
-                    else:
-                        self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.INVALID_QUOTE)
-                        if config.getboolean('cloud_verifier', 'revocation_notifier'):
-                            cloud_verifier_common.handleVerificationError(instance)
- 
-#                 if self.get_q_log_file_base_name is not None and writeTime:
-#                     self.get_q_log_file.write("%s\n" % t.secs)
-#                     self.get_q_log_file.flush()  
-                 
+                self.db.update_instance(handle,'results',self.results[handle])
             except Exception as e:
-                logger.debug(traceback.print_exc())
-                logger.critical("Unexpected exception occurred in worker_get_quote.  Error: %s"%e )            
+                logger.warning("Unable to save the results of attestation sweep %s: %s"%(handle,e))
+        self.dirty.clear()
 
+def attest_once(db, instance_id, callback):
+    """Request and check one quote from an instance outside of its polling, then call callback with the outcome"""
+    states = cloud_verifier_common.CloudInstance_Operational_State
+    row = db.get_instance(instance_id)
+    if row is None or row['operational_state'] in (states.SAVED,states.FAILED,states.TERMINATED,states.INVALID_QUOTE):
+        callback('skipped')
+        return
+    
+    # V is never sent to the node here, so there is no need to encrypt it as restore_instance does
+    instance = cloud_verifier_common.CloudInstance(row)
+    # save a trip to the registrar if this process already has the keys
+    if instance_id in polled_instances:
+        instance.registrar_keys = polled_instances[instance_id].registrar_keys
+    
+    try:
+        params = cloud_verifier_common.prepare_get_quote(instance)
+    except Exception as e:
+        logger.warning("Unable to attest instance %s: %s"%(instance_id,e))
+        callback('skipped')
+        return
+    # the quote is checked against the public key the node sends along
+    url = "http://%s:%d/v2/quotes/integrity/nonce/%s/mask/%s/vmask/%s/partial/0/batch/1/"%(instance.ip,instance.port,params["nonce"],params["mask"],params['vmask'])
+    client = tornado.httpclient.AsyncHTTPClient()
+    client.fetch(url, callback=functools.partial(on_attest_once_response, db, instance, callback), decompress_response=True)
+
+def on_attest_once_response(db, instance, callback, response):
+    outcome = 'unreachable'
+    try:
+        if not response.error:
+            json_response = json.loads(response.body)
+            if cloud_verifier_common.process_quote_response(instance, json_response['results'], config):
+                outcome = 'attested'
+            else:
+                outcome = 'invalid'
+                logger.warning("Instance %s failed on-demand attestation"%instance.instance_id)
+                db.update_instance(instance.instance_id, 'operational_state', cloud_verifier_common.CloudInstance_Operational_State.INVALID_QUOTE)
+                publish_state(instance.instance_id, instance.operational_state, cloud_verifier_common.CloudInstance_Operational_State.INVALID_QUOTE)
+                if config.getboolean('cloud_verifier', 'revocation_notifier'):
+                    cloud_verifier_common.handleVerificationError(instance)
+    except Exception as e:
+        logger.warning("Unexpected exception during on-demand attestation of instance %s: %s"%(instance.instance_id,e))
+        logger.warning(traceback.format_exc())
+    callback(outcome)
 
+def publish_state(instance_id, old_state, new_state):
+    """Add a transition of the operational state of an instance to the status change feed"""
+    if status_feed is not None and old_state != new_state:
+        # the feed is best effort, it must never get in the way of polling
+        try:
+            status_feed.publish(instance_id, old_state, new_state)
+        except Exception as e:
+            logger.warning("Unable to publish the state of instance %s to the status change feed: %s"%(instance_id,e))
 
-    def invoke_provide_v(self, instance):
-        if instance['pending_event'] is not None:
-            instance['pending_event'] = None
-        v_json_message = cloud_verifier_common.prepare_v(instance)
-        instance['operational_state'] = cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V
-        client = tornado.httpclient.AsyncHTTPClient()
-        url = "http://%s:%d/v2/keys/vkey"%(instance['ip'],instance['port'])
-        cb = functools.partial(self.on_provide_v_response, instance, url)
-        client.fetch(url, method="POST", callback=cb, headers=None, body=v_json_message)
+def report_state(instance):
+    """Publish the operational state of an instance if it changed since it was last published"""
+    publish_state(instance.instance_id, instance.reported_state, instance.operational_state)
+    instance.reported_state = instance.operational_state
+
+class StatusFeed(object):
+    """Lets clients wait for operational state transitions in the event log.
     
-    def on_provide_v_response(self, instance, url_with_params, response):
-        if instance is None:
-            raise Exception("instance deleted while being processed")
-        if response.error: 
-            if isinstance(response.error, IOError) or (isinstance(response.error, tornado.web.HTTPError) and response.error.code == 599):
-                self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V_RETRY)
-            else:
-                #catastrophic error, do not continue
-                error = "Unexpected Provide V response error for cloud instance " + instance['instance_id']  + ", Error: " + str(response.error)
-                logger.critical(error)
-                self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.FAILED)
-        else:
-            self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
- 
-    def process_instance(self, instance, new_operational_state):
+    Transitions published in this worker process are written to the log together every 
+    EVENT_FLUSH_INTERVAL seconds, waking waiters once they are.  Transitions published by other 
+    worker processes are picked up by checking the log every check_interval seconds, but only 
+    while somebody is waiting.
+    """
+    def __init__(self,events,check_interval):
+        self.events = events
+        self.changed = tornado.locks.Condition()
+        self.waiting = 0
+        self.last = events.bounds()[1]
+        self.check_interval = check_interval
+        self.checker = None
+        # transitions not yet written to the log
+        self.pending = []
+        self.flush_timeout = None
+    
+    def start(self):
+        # the last sequence number may have moved on in another worker process since the fork
+        self.last = self.events.bounds()[1]
+        self.checker = tornado.ioloop.PeriodicCallback(self.check, self.check_interval*1000)
+        self.checker.start()
+    
+    def publish(self,instance_id,old_state,new_state):
+        self.pending.append((instance_id,old_state,new_state,time.time()))
+        if self.flush_timeout is None:
+            self.flush_timeout = tornado.ioloop.IOLoop.current().call_later(EVENT_FLUSH_INTERVAL,self.flush)
+    
+    def flush(self):
+        """Write out the transitions published since the last flush"""
+        if self.flush_timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        (transitions,self.pending) = (self.pending,[])
         try:
-            if instance is None:
-                #import traceback
-                traceback.print_stack()
-            main_instance_operational_state = instance['operational_state']
-            stored_instance = self.db.get_instance(instance['instance_id'])
-            
-            # if the user did terminated this instance
-            if stored_instance['operational_state'] == cloud_verifier_common.CloudInstance_Operational_State.TERMINATED:
-                logger.warning("Instance %s terminated by user."%instance['instance_id'])
-                if instance['pending_event'] is not None:
-                    tornado.ioloop.IOLoop.current().remove_timeout(instance['pending_event'])
-                self.db.remove_instance(instance['instance_id'])
-                return
-            
-            # If failed during processing, log regardless and drop it on the floor
-            # The administration application (tenant) can GET the status and act accordingly (delete/retry/etc).  
-            if new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.FAILED or \
-                new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.INVALID_QUOTE:
-                instance['operational_state'] = new_operational_state
-                if instance['pending_event'] is not None:
-                    tornado.ioloop.IOLoop.current().remove_timeout(instance['pending_event'])
-                self.db.overwrite_instance(instance['instance_id'], instance)
-                logger.warning("Instance %s failed, stopping polling"%instance['instance_id'])
-                return
-            
-            # propagate all state 
-            self.db.overwrite_instance(instance['instance_id'], instance)
-            
-            # if new, get a quote
-            if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.START and \
-                new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE:
-                instance['num_retries']=0
-                self.invoke_get_quote(instance, True)
-                return
-            
-            if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE and \
-                (new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V): 
-                instance['num_retries']=0
-                self.invoke_provide_v(instance)
+            events = self.events.append(transitions)
+        except Exception as e:
+            logger.warning("Unable to write %d transitions to the status change feed: %s"%(len(transitions),e))
+            return
+        if len(events)>0:
+            self.last = events[-1]['seq']
+            self.changed.notify_all()
+    
+    def check(self):
+        if self.waiting==0:
+            return
+        last = self.events.bounds()[1]
+        if last!=self.last:
+            self.last = last
+            self.changed.notify_all()
+    
+    @tornado.gen.coroutine
+    def wait(self,since,timeout):
+        """Returns the events after sequence number since, waiting up to timeout seconds for one"""
+        events = self.events.read(since,MAX_EVENTS_PER_RESPONSE)
+        if len(events)==0 and timeout>0:
+            self.waiting+=1
+            try:
+                yield self.changed.wait(timeout=datetime.timedelta(seconds=timeout))
+            finally:
+                self.waiting-=1
+            events = self.events.read(since,MAX_EVENTS_PER_RESPONSE)
+        raise tornado.gen.Return(events)
+
+class EventsHandler(BaseHandler):
+    feed = None
+    closed = False
+    def initialize(self, feed, admission=None):
+        self.feed = feed
+        self.admission = admission
+    
+    def on_connection_close(self):
+        self.closed = True
+    
+    @tornado.gen.coroutine
+    def get(self):
+        """This method handles the GET requests to follow the operational state transitions of instances.
+        
+        /v2/events/seq returns the transitions after sequence number seq, oldest first, each with its seq, 
+        instance_id, old_state (null if the instance was added), new_state (null if it was removed, 
+        TERMINATED if it was deleted while being polled) and timestamp.  If there are none yet 
+        the request waits up to wait seconds (query argument, at most event_wait) for one.  /v2/events/ 
+        starts from the newest transition.  truncated is true if transitions after seq were already 
+        dropped from the feed or the feed started over, in which case the client should fetch the state
+        of all instances again.
+        With Accept: text/event-stream the transitions are streamed as server-sent events instead, 
+        resuming after the Last-Event-ID header if there is one.
+        """
+        rest_params = common.get_restful_params(self.request.path)
+        if rest_params is None or "events" not in rest_params:
+            common.echo_json_response(self, 400, "uri not supported")
+            logger.warning('GET returning 400 response. uri not supported: ' + self.request.path)
+            return
+        
+        max_wait = config.getfloat('cloud_verifier','event_wait')
+        try:
+            since = rest_params["events"]
+            if since is None:
+                since = self.request.headers.get('Last-Event-ID',None)
+            since = self.feed.events.bounds()[1] if since is None else int(since)
+            wait = min(max_wait,float(self.get_argument('wait',max_wait)))
+        except ValueError:
+            common.echo_json_response(self, 400, "invalid sequence number or wait time")
+            return
+        
+        (first,newest) = self.feed.events.bounds()
+        truncated = first>0 and since<first-1
+        # the feed started over, e.g. after a restart with an in-memory log
+        if since>newest:
+            truncated = True
+            since = newest
+        
+        if 'text/event-stream' in self.request.headers.get('Accept',''):
+            yield self.stream(since, max_wait)
+            return
+        
+        events = yield self.feed.wait(since, wait)
+        if self.closed:
+            return
+        last = events[-1]['seq'] if len(events)>0 else since
+        common.echo_json_response(self, 200, "Success", {'events':events,'last':last,'truncated':truncated})
+    
+    @tornado.gen.coroutine
+    def stream(self, since, keepalive):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        while not self.closed:
+            events = yield self.feed.wait(since, keepalive)
+            if len(events)==0:
+                self.write(": keepalive\n\n")
+            for event in events:
+                self.write("id: %d\ndata: %s\n\n"%(event['seq'],json.dumps(event)))
+                since = event['seq']
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
                 return
-            
-            if (main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V or
-               main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE) and \
-                new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE: 
-                instance['num_retries']=0
-                interval = config.getfloat('cloud_verifier','quote_interval')
-                
-                if interval==0:
-                    self.invoke_get_quote(instance, False)
-                else:
-                    #logger.debug("Setting up callback to check again in %f seconds"%interval)
-                    # set up a call back to check again
-                    cb = functools.partial(self.invoke_get_quote, instance, False)
-                    pending = tornado.ioloop.IOLoop.current().call_later(interval,cb)
-                    instance['pending_event'] = pending
+
+class HintsHandler(tornado.web.RequestHandler):
+    db = None
+    def initialize(self, db):
+        self.db = db
+    
+    def post(self):
+        """This method handles measurement change hints sent by nodes.
+        
+        Hints are POSTed to /v2/hints/instance_id with a json block holding the signed message and its signature.
+        A hint for an instance polled by another worker process is passed on to it and gets a 202 response.
+        Nodes don't have client certificates, so hints are the one request taken without one.
+        """
+        rest_params = common.get_restful_params(self.request.path)
+        if rest_params is None or "hints" not in rest_params or rest_params["hints"] is None:
+            common.echo_json_response(self, 400, "uri not supported")
+            logger.warning('POST returning 400 response. uri not supported: ' + self.request.path)
+            return
+        
+        instance_id = rest_params["hints"]
+        try:
+            json_body = json.loads(self.request.body)
+            message = json_body['message']
+            signature = json_body['signature']
+        except Exception as e:
+            common.echo_json_response(self, 400, "Error: %s"%e)
+            logger.warning("POST hint for instance %s returning 400 response. Error: %s"%(instance_id,e))
+            return
+        
+        instance = polled_instances.get(instance_id,None)
+        if instance is None:
+            if hint_inbox is None:
+                common.echo_json_response(self, 404, "instance id not found")
                 return
-            
-            maxr = config.getint('cloud_verifier','max_retries')
-            retry = config.getfloat('cloud_verifier','retry_interval')
-            if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE and \
-                new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE_RETRY:
-                if instance['num_retries']>=maxr:
-                    logger.warning("Instance %s was not reachable in %d tries, setting state to FAILED"%(instance['instance_id'],maxr))
-                    self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.FAILED)
-                else:
-                    cb = functools.partial(self.invoke_get_quote, instance, True)
-                    instance['num_retries']+=1
-                    logger.info("connection to %s refused after %d/%d tries, trying again in %f seconds"%(instance['ip'],instance['num_retries'],maxr,retry))
-                    tornado.ioloop.IOLoop.current().call_later(retry,cb)
-                return   
-            
-            if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V and \
-                new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V_RETRY:
-                if instance['num_retries']>=maxr:
-                    logger.warning("Instance %s was not reachable in %d tries, setting state to FAILED"%(instance['instance_id'],maxr))
-                    self.process_instance(instance, cloud_verifier_common.CloudInstance_Operational_State.FAILED)
+            hint_inbox.put(instance_id, message, signature, time.time())
+            common.echo_json_response(self, 202, "Accepted")
+            return
+        
+        try:
+            scheduled = take_hint(self.db, instance, message, signature)
+        except Exception as e:
+            common.echo_json_response(self, 400, "Error: %s"%e)
+            logger.warning("POST hint for instance %s returning 400 response. Error: %s"%(instance_id,e))
+            return
+        common.echo_json_response(self, 200, "Success", {'scheduled':scheduled})
+
+def take_hint(db, instance, message, signature):
+    """Act on a measurement change hint for an instance polled by this worker process.
+    
+    Raises an exception if the hint is not valid, returns whether a quote was requested.
+    """
+    if not cloud_verifier_common.check_hint(instance, message, signature, time.time(), config):
+        return False
+    scheduled = attest_now(db, instance)
+    if scheduled:
+        logger.info("Measurements of instance %s changed, requesting a quote now"%instance.instance_id)
+    return scheduled
+
+def check_hint_inbox(db):
+    """Act on the hints other worker processes received for instances polled by this one"""
+    try:
+        hints = hint_inbox.take(polled_instances, time.time())
+    except Exception as e:
+        logger.warning("Unable to read measurement change hints: %s"%e)
+        return
+    for (instance_id,message,signature) in hints:
+        instance = polled_instances.get(instance_id,None)
+        if instance is None:
+            continue
+        try:
+            take_hint(db, instance, message, signature)
+        except Exception as e:
+            logger.warning("Ignoring hint for instance %s: %s"%(instance_id,e))
+
+def attest_now(db, instance):
+    """Request the next periodic quote of an instance right away.
+    
+    Returns False if the instance isn't waiting for its next poll, e.g. because a quote is in flight
+    or the node is being retried.
+    """
+    if instance.pending_event is None or instance.num_retries>0 or instance.circuit_interval is not None:
+        return False
+    tornado.ioloop.IOLoop.current().remove_timeout(instance.pending_event)
+    invoke_get_quote(db, instance, False)
+    return True
+
+def invoke_get_quote(db, instance, need_pubkey):
+    instance.pending_event = None
+    params = cloud_verifier_common.prepare_get_quote(instance)
+    instance.operational_state = cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE
+    client = tornado.httpclient.AsyncHTTPClient()
+    
+    partial_req = "1"
+    if need_pubkey:
+        partial_req = "0"
+    
+    url = "http://%s:%d/v2/quotes/integrity/nonce/%s/mask/%s/vmask/%s/partial/%s/batch/1/"%(instance.ip,instance.port,params["nonce"],params["mask"],params['vmask'],partial_req) 
+    if hint_port is not None:
+        url+="hint/%d/"%hint_port
+    # the following line adds the instance and params arguments to the callback as a convenience
+    cb = functools.partial(on_get_quote_response, db, instance, url)
+    # ask for a compressed response, the client inflates it chunk by chunk as it arrives
+    client.fetch(url, callback=cb, decompress_response=True)
+
+def on_get_quote_response(db, instance, url, response):
+    if instance is None:
+        raise Exception("instance deleted while being processed")
+    if response.error: 
+        # this is a connection error, retry get quote
+        if isinstance(response.error, IOError) or (isinstance(response.error, tornado.web.HTTPError) and response.error.code == 599):
+            process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE_RETRY)
+        else:
+            #catastrophic error, do not continue
+            error = "Unexpected Get Quote response error for cloud instance " + instance.instance_id  + ", Error: " + str(response.error)
+            logger.critical(error)
+            process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.FAILED)
+    else:
+        try:
+ 
+#            writeTime=False
+#            with cloud_verifier_common.Timer() as t:
+                json_response = json.loads(response.body)
+
+                # validate the cloud node response
+                if cloud_verifier_common.process_quote_response(instance, json_response['results'], config):
+                    #only write timing if the quote was successful
+#                     if self.time_series_log_file_base_name is not None:
+#                         self.time_series_log_file.write("%s\n" % time.time())
+#                         self.time_series_log_file.flush()
+#                     writeTime=True
+                     
+                    if instance.provide_V:
+                        process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V)
+                    else:
+                        process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
                 else:
-                    cb = functools.partial(self.invoke_provide_v, instance)
-                    instance['num_retries']+=1
-                    logger.info("connection to %s refused after %d/%d tries, trying again in %f seconds"%(instance['ip'],instance['num_retries'],maxr,retry))
-                    tornado.ioloop.IOLoop.current().call_later(retry,cb)
-                return
+                    process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.INVALID_QUOTE)
+                    if config.getboolean('cloud_verifier', 'revocation_notifier'):
+                        cloud_verifier_common.handleVerificationError(instance)
+ 
+#             if self.get_q_log_file_base_name is not None and writeTime:
+#                 self.get_q_log_file.write("%s\n" % t.secs)
+#                 self.get_q_log_file.flush()  
+             
+        except Exception as e:
+            logger.debug(traceback.print_exc())
+            logger.critical("Unexpected exception occurred in worker_get_quote.  Error: %s"%e )            
+
+
+
+def invoke_provide_v(db, instance):
+    if instance.pending_event is not None:
+        instance.pending_event = None
+    v_json_message = cloud_verifier_common.prepare_v(instance)
+    instance.operational_state = cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V
+    client = tornado.httpclient.AsyncHTTPClient()
+    url = "http://%s:%d/v2/keys/vkey"%(instance.ip,instance.port)
+    cb = functools.partial(on_provide_v_response, db, instance, url)
+    client.fetch(url, method="POST", callback=cb, headers=None, body=v_json_message)
+
+def on_provide_v_response(db, instance, url_with_params, response):
+    if instance is None:
+        raise Exception("instance deleted while being processed")
+    if response.error: 
+        if isinstance(response.error, IOError) or (isinstance(response.error, tornado.web.HTTPError) and response.error.code == 599):
+            process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V_RETRY)
+        else:
+            #catastrophic error, do not continue
+            error = "Unexpected Provide V response error for cloud instance " + instance.instance_id  + ", Error: " + str(response.error)
+            logger.critical(error)
+            process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.FAILED)
+    else:
+        process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
+ 
+def check_terminated(db, instance):
+    """Stop polling the instance if the tenant terminated it (removing it) or an on-demand attestation 
+    found it invalid.  Returns True if polling stopped."""
+    states = cloud_verifier_common.CloudInstance_Operational_State
+    stored_instance = db.get_instance(instance.instance_id)
+    if stored_instance['operational_state'] == states.TERMINATED:
+        logger.warning("Instance %s terminated by user."%instance.instance_id)
+        if instance.pending_event is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(instance.pending_event)
+        db.remove_instance(instance.instance_id)
+        polled_instances.pop(instance.instance_id,None)
+        return True
+    # a poller never continues after marking the instance invalid itself, a restart by the tenant starts over
+    if stored_instance['operational_state'] == states.INVALID_QUOTE and instance.operational_state != states.START:
+        logger.warning("Instance %s failed on-demand attestation, stopping polling"%instance.instance_id)
+        if instance.pending_event is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(instance.pending_event)
+        polled_instances.pop(instance.instance_id,None)
+        return True
+    return False
+
+def schedule_retry(instance, maxr, cb):
+    delay = cloud_verifier_common.retry_delay(config, instance.num_retries)
+    instance.num_retries+=1
+    logger.info("connection to %s refused after %d/%d tries, trying again in %f seconds"%(instance.ip,instance.num_retries,maxr,delay))
+    # keep the handle so the retry is cancelled if the instance fails or is terminated
+    instance.pending_event = tornado.ioloop.IOLoop.current().call_later(delay,cb)
+
+def on_unreachable(db, instance, maxr):
+    if config.getboolean('cloud_verifier','circuit_breaker'):
+        open_circuit(db, instance)
+    else:
+        logger.warning("Instance %s was not reachable in %d tries, setting state to FAILED"%(instance.instance_id,maxr))
+        process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.FAILED)
+
+def open_circuit(db, instance):
+    """Stop attesting an unreachable node and only probe it until it answers again.
+    
+    The wait between probes starts at circuit_probe_interval and doubles after every failed 
+    probe up to max_circuit_probe_interval.
+    """
+    if instance.circuit_interval is None:
+        instance.circuit_interval = config.getfloat('cloud_verifier','circuit_probe_interval')
+        logger.warning("Instance %s was not reachable in %d tries, opening circuit"%(instance.instance_id,instance.num_retries))
+    else:
+        instance.circuit_interval = min(2*instance.circuit_interval,config.getfloat('cloud_verifier','max_circuit_probe_interval'))
+    delay = cloud_verifier_common.jitter(instance.circuit_interval)
+    logger.debug("Probing instance %s in %f seconds"%(instance.instance_id,delay))
+    cb = functools.partial(invoke_probe, db, instance)
+    instance.pending_event = tornado.ioloop.IOLoop.current().call_later(delay,cb)
+
+def invoke_probe(db, instance):
+    instance.pending_event = None
+    if check_terminated(db, instance):
+        return
+    # fetching the public key needs no TPM operations on the node
+    client = tornado.httpclient.AsyncHTTPClient()
+    url = "http://%s:%d/v2/keys/pubkey"%(instance.ip,instance.port)
+    cb = functools.partial(on_probe_response, db, instance)
+    client.fetch(url, callback=cb)
+
+def on_probe_response(db, instance, response):
+    try:
+        if response.error and (isinstance(response.error, IOError) or (isinstance(response.error, tornado.web.HTTPError) and response.error.code == 599)):
+            open_circuit(db, instance)
+            return
+        
+        # the node answered, start over with a full quote since it may have rebooted
+        logger.info("Instance %s is reachable again, closing circuit"%instance.instance_id)
+        instance.circuit_interval = None
+        instance.operational_state = cloud_verifier_common.CloudInstance_Operational_State.START
+        process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
+    except Exception as e:
+        logger.warning("Polling thread Exception error: %s"%e)
+        logger.warning("Polling thread trace: " + traceback.format_exc())
+
+def process_instance(db, instance, new_operational_state):
+    try:
+        if instance is None:
+            #import traceback
+            traceback.print_stack()
+        main_instance_operational_state = instance.operational_state
+        polled_instances[instance.instance_id] = instance
+        
+        # if the user did terminated this instance
+        if check_terminated(db, instance):
+            return
+        
+        # If failed during processing, log regardless and drop it on the floor
+        # The administration application (tenant) can GET the status and act accordingly (delete/retry/etc).  
+        if new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.FAILED or \
+            new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.INVALID_QUOTE:
+            instance.operational_state = new_operational_state
+            if instance.pending_event is not None:
+                tornado.ioloop.IOLoop.current().remove_timeout(instance.pending_event)
+            db.overwrite_instance(instance.instance_id, instance.to_row())
+            report_state(instance)
+            polled_instances.pop(instance.instance_id,None)
+            logger.warning("Instance %s failed, stopping polling"%instance.instance_id)
+            return
+        
+        # propagate all state 
+        db.overwrite_instance(instance.instance_id, instance.to_row())
+        report_state(instance)
+        
+        # if new, get a quote
+        if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.START and \
+            new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE:
+            instance.num_retries=0
+            invoke_get_quote(db, instance, True)
+            return
+        
+        if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE and \
+            (new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V): 
+            instance.num_retries=0
+            invoke_provide_v(db, instance)
+            return
+        
+        if (main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V or
+           main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE) and \
+            new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE: 
+            instance.num_retries=0
+            interval = config.getfloat('cloud_verifier','quote_interval')
             
-            print instance
-            raise Exception("nothing should ever fall out of this!")
+            if interval==0:
+                invoke_get_quote(db, instance, False)
+            else:
+                #logger.debug("Setting up callback to check again in %f seconds"%interval)
+                # set up a call back to check again
+                cb = functools.partial(invoke_get_quote, db, instance, False)
+                pending = tornado.ioloop.IOLoop.current().call_later(interval,cb)
+                instance.pending_event = pending
+            return
+        
+        maxr = config.getint('cloud_verifier','max_retries')
+        if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE and \
+            new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE_RETRY:
+            if instance.num_retries>=maxr:
+                on_unreachable(db, instance, maxr)
+            else:
+                schedule_retry(instance, maxr, functools.partial(invoke_get_quote, db, instance, True))
+            return   
+        
+        if main_instance_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V and \
+            new_operational_state == cloud_verifier_common.CloudInstance_Operational_State.PROVIDE_V_RETRY:
+            if instance.num_retries>=maxr:
+                on_unreachable(db, instance, maxr)
+            else:
+                schedule_retry(instance, maxr, functools.partial(invoke_provide_v, db, instance))
+            return
+        
+        print instance.to_row()
+        raise Exception("nothing should ever fall out of this!")
    
-        except Exception as e:
-            logger.warning("Polling thread Exception error: %s"%e)
-            logger.warning("Polling thread trace: " + traceback.format_exc())        
+    except Exception as e:
+        logger.warning("Polling thread Exception error: %s"%e)
+        logger.warning("Polling thread trace: " + traceback.format_exc())        
+
+def monitor_loop_lag(admission, expected):
+    """Record how late this callback ran as the current lag of the IOLoop"""
+    now = time.time()
+    admission.loop_lag = max(0,now-expected)
+    cb = functools.partial(monitor_loop_lag, admission, now+LOOP_LAG_CHECK_INTERVAL)
+    tornado.ioloop.IOLoop.current().call_later(LOOP_LAG_CHECK_INTERVAL,cb)
+
+def resume_instances(db):
+    """Resume polling of every instance persisted in a non-terminal state after a warm restart.
+    
+    The first quote for each instance is spread evenly across one quote_interval so the 
+    verifier doesn't contact the whole fleet at once.
+    """
+    states = cloud_verifier_common.CloudInstance_Operational_State
+    rows = []
+    for instance_id in db.get_instance_ids():
+        row = db.get_instance(instance_id)
+        if row is None:
+            continue
+        # deleted by the tenant while it was still being polled
+        if row['operational_state'] == states.TERMINATED:
+            db.remove_instance(instance_id)
+            continue
+        if row['operational_state'] == states.FAILED or row['operational_state'] == states.INVALID_QUOTE:
+            continue
+        rows.append(row)
+    
+    if len(rows)==0:
+        return
+    
+    interval = config.getfloat('cloud_verifier','quote_interval')
+    logger.info("Warm restart: resuming %d instances over %f seconds"%(len(rows),interval))
+    for i in range(len(rows)):
+        cb = functools.partial(resume_instance, db, rows[i])
+        tornado.ioloop.IOLoop.current().call_later(interval*i/len(rows),cb)
+
+def resume_instance(db, row):
+    instance = cloud_verifier_common.restore_instance(row)
+    instance.operational_state = cloud_verifier_common.CloudInstance_Operational_State.START
+    process_instance(db, instance, cloud_verifier_common.CloudInstance_Operational_State.GET_QUOTE)
+
+def log_tls_metrics(context):
+    """Log how many TLS handshakes of this worker process were full handshakes rather than resumed sessions"""
+    logger.info("TLS handshake metrics: %s"%json.dumps({'server':common.tls_session_stats(context),
+                                                         'registrar_client':common.tls_session_stats(registrar_client.context)},sort_keys=True))
 
 def start_tornado(tornado_server, port):
     tornado_server.listen(port)
@@ -430,9 +1057,28 @@ def main(argv=sys.argv):
      
     cloudverifier_port = config.get('general', 'cloudverifier_port')
     
+    # only the sqlite engine is shared between forked worker processes
+    if config.get('cloud_verifier','db_engine')!='sqlite' and config.getint('cloud_verifier','multiprocessing_pool_num_workers')!=1:
+        raise Exception("db_engine %s requires multiprocessing_pool_num_workers = 1"%config.get('cloud_verifier','db_engine'))
+    
     db_filename = "%s/%s"%(common.WORK_DIR,config.get('cloud_verifier','db_filename'))
-    db = cloud_verifier_common.init_db(db_filename)
-    db.update_all_instances('operational_state', cloud_verifier_common.CloudInstance_Operational_State.SAVED)
+    db = cloud_verifier_common.init_db(db_filename,config)
+    warm_restart = config.getboolean('cloud_verifier','warm_restart')
+    global status_feed
+    status_feed = StatusFeed(cloud_verifier_common.init_event_db(db_filename,config),config.getfloat('cloud_verifier','event_check_interval'))
+    if not warm_restart:
+        # written straight to the log in one transaction, the IOLoop isn't running yet
+        transitions = []
+        now = time.time()
+        for instance_id in db.get_instance_ids():
+            row = db.get_instance(instance_id)
+            if row is not None and row['operational_state']!=cloud_verifier_common.CloudInstance_Operational_State.SAVED:
+                transitions.append((instance_id, row['operational_state'], cloud_verifier_common.CloudInstance_Operational_State.SAVED, now))
+        try:
+            status_feed.events.append(transitions)
+        except Exception as e:
+            logger.warning("Unable to publish the saved state of instances to the status change feed: %s"%e)
+        db.update_all_instances('operational_state', cloud_verifier_common.CloudInstance_Operational_State.SAVED)
     
     num = db.count_instances()
     if num>0:
@@ -441,14 +1087,32 @@ def main(argv=sys.argv):
     
     logger.info('Starting Cloud Verifier (tornado) on port ' + cloudverifier_port + ', use <Ctrl-C> to stop')
 
-    app = tornado.web.Application([
+    admission = cloud_verifier_common.AdmissionControl(config)
+    sweeps = SweepQueue(cloud_verifier_common.init_sweep_db(db_filename,config),config.getint('cloud_verifier','max_concurrent_attestations'))
+    handlers = [
         (r"/", MainHandler),                      
-        (r"/v2/instances/.*", InstancesHandler,{'db':db}),
-        ])
+        (r"/v2/instances/.*", InstancesHandler,{'db':db,'admission':admission}),
+        (r"/v2/attestations/.*", AttestationsHandler,{'db':db,'sweeps':sweeps,'admission':admission}),
+        (r"/v2/events/.*", EventsHandler,{'feed':status_feed,'admission':admission}),
+        ]
     
     context = cloud_verifier_common.init_mtls(config)
+    
+    # nodes send hints to the same listener as the REST API 
+    measurement_hints = config.getboolean('cloud_verifier','measurement_hints')
+    if measurement_hints:
+        global hint_port, hint_inbox
+        hint_port = int(cloudverifier_port)
+        hint_inbox = cloud_verifier_common.init_hint_db(db_filename,config)
+        handlers.append((r"/v2/hints/.*", HintsHandler,{'db':db}))
+        if context is not None:
+            # nodes have no client certificate, the REST API handlers insist on one instead
+            context.verify_mode = ssl.CERT_OPTIONAL
+            BaseHandler.require_client_cert = True
+    
+    app = tornado.web.Application(handlers)
     server = tornado.httpserver.HTTPServer(app,ssl_options=context)
-    server.bind(int(cloudverifier_port), address='0.0.0.0')
+    server.bind(int(cloudverifier_port), address=config.get('cloud_verifier','listen_address'))
     
     #after TLS is up, start revocation notifier
     if config.getboolean('cloud_verifier', 'revocation_notifier'):
@@ -456,6 +1120,23 @@ def main(argv=sys.argv):
         revocation_notifier.start_broker()
         
     server.start(config.getint('cloud_verifier','multiprocessing_pool_num_workers')) 
+    status_feed.start()
+    
+    # pick up the hints other worker processes received for the instances this one polls
+    if hint_inbox is not None:
+        tornado.ioloop.PeriodicCallback(functools.partial(check_hint_inbox,db), config.getfloat('cloud_verifier','hint_check_interval')*1000).start()
+    
+    # only one worker process may resume polling, otherwise each instance would be polled once per worker
+    if warm_restart and tornado.process.task_id() in (None,0):
+        resume_instances(db)
+    
+    # each worker process limits its own API requests
+    if admission.enabled and admission.max_loop_lag>0:
+        monitor_loop_lag(admission, time.time())
+    
+    metrics_interval = config.getfloat('cloud_verifier','tls_metrics_interval')
+    if context is not None and metrics_interval>0:
+        tornado.ioloop.PeriodicCallback(functools.partial(log_tls_metrics,context), metrics_interval*1000).start()
         
     try:
         tornado.ioloop.IOLoop.instance().start()
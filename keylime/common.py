@@ -166,6 +166,16 @@ def echo_json_response(handler,code,status=None,results=None):
     else:
         return False
 
+def tls_session_stats(context):
+    """Counts of the full and resumed (session ID or ticket) TLS handshakes done with an SSL context"""
+    if context is None:
+        return {}
+    stats = context.session_stats()
+    return {
+        'full_handshakes': stats['accept_good']+stats['connect_good']-stats['hits'],
+        'resumed_handshakes': stats['hits'],
+        }
+
 def list_to_dict(list):
     """Convert list into dictionary via grouping [k0,v0,k1,v1,...]"""
     params = {}
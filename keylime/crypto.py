@@ -23,7 +23,7 @@ import base64
 # Crypto implementation using Cryptodomex package
  
 from Cryptodome.Random import get_random_bytes 
-from Cryptodome.Hash import HMAC,SHA384
+from Cryptodome.Hash import HMAC,SHA384,SHA1
 from Cryptodome.Cipher import PKCS1_OAEP
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Cipher import AES
@@ -73,6 +73,15 @@ def rsa_encrypt(key,message):
 def rsa_decrypt(key,ciphertext):
     cipher = PKCS1_OAEP.new(key)
     return cipher.decrypt(ciphertext)
+
+# TPM 1.2 encrypts to its storage and endorsement keys with TPM_ES_RSAESOAEP_SHA1_MGF1
+def tpm_rsa_encrypt(key,message):
+    cipher = PKCS1_OAEP.new(key,hashAlgo=SHA1,label='TCPA')
+    return cipher.encrypt(message)
+
+def tpm_rsa_decrypt(key,ciphertext):
+    cipher = PKCS1_OAEP.new(key,hashAlgo=SHA1,label='TCPA')
+    return cipher.decrypt(ciphertext)
  
 def generate_random_key(size=32):
     return get_random_bytes(size)
@@ -0,0 +1,395 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import common
+logger = common.init_logging('keylime_db')
+import os
+import json
+import threading
+import collections
+
+VALID_ENGINES = ['sqlite','memory','log']
+
+class KeylimeDBBase(object):
+    """Schema handling shared by all of the keylime storage engines.
+
+    Every engine stores one row per instance_id holding only the columns in cols_db.  Columns
+    listed in json_cols_db are kept as JSON strings and decoded when an instance is read back.
+    The exclude_db defaults are runtime only state and are added to every instance handed out.
+    """
+    # in the form key, SQL type
+    cols_db = None
+    # these are the columns that contain json data and need marshalling
+    json_cols_db = None
+    # in the form key : default value
+    exclude_db = None
+
+    def __init__(self,cols_db,json_cols_db,exclude_db):
+        self.cols_db = cols_db
+        self.json_cols_db = json_cols_db
+        self.exclude_db = exclude_db
+
+        if 'instance_id' not in cols_db or 'PRIMARY_KEY' not in cols_db['instance_id']:
+            raise Exception("the primary key of the database must be instance_id")
+
+    def check_key(self,key):
+        if key not in self.cols_db.keys():
+            raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+
+    def add_defaults(self,instance):
+        for key in self.exclude_db.keys():
+            instance[key] = self.exclude_db[key]
+        return instance
+
+    def marshal(self,key,value):
+        """Convert a value to the form it is stored in, json columns are stored as JSON strings"""
+        if key in self.json_cols_db:
+            return json.dumps(value)
+        return value
+
+    def unmarshal(self,row):
+        """Turn a stored row into an instance dictionary with the json columns decoded and defaults added"""
+        d = dict(row)
+        for key in self.json_cols_db:
+            if d.get(key,None) is not None:
+                d[key] = json.loads(d[key])
+        return self.add_defaults(d)
+
+    def check_criteria(self,criteria):
+        for key in criteria:
+            self.check_key(key)
+            if key in self.json_cols_db:
+                raise Exception("Database key %s holds json and can't be matched"%key)
+
+    def find_instance_ids(self,criteria):
+        """Returns the ids of the instances whose columns equal the values in criteria, json columns can't be matched"""
+        self.check_criteria(criteria)
+        instance_ids = []
+        for instance_id in self.get_instance_ids():
+            instance = self.get_instance(instance_id)
+            if instance is not None and all(instance[key]==criteria[key] for key in criteria):
+                instance_ids.append(instance_id)
+        return instance_ids
+
+    def update_instance_fields(self,instance_id,d):
+        """Set several columns of an instance at once"""
+        for key in d:
+            self.check_key(key)
+        for key,value in d.items():
+            self.update_instance(instance_id,key,value)
+
+    def remove_instances_before(self,key,value,criteria={}):
+        """Remove the instances whose column key is less than value and whose columns equal the values 
+        in criteria, returns how many were removed"""
+        self.check_criteria({key:value})
+        self.check_criteria(criteria)
+        removed = 0
+        for instance_id in self.find_instance_ids(criteria):
+            instance = self.get_instance(instance_id)
+            if instance is not None and instance[key] is not None and instance[key]<value:
+                if self.remove_instance(instance_id):
+                    removed+=1
+        return removed
+
+    def print_db(self):
+        return
+
+    def count_instances(self):
+        return len(self.get_instance_ids())
+
+class KeylimeMemoryDB(KeylimeDBBase):
+    """Storage engine that keeps all rows in process memory.  Nothing survives a restart.
+
+    Rows are stored marshalled exactly as the sqlite engine would store them so that callers
+    always receive fresh copies and see the same column types regardless of the engine.
+    """
+    rows = None
+    lock = None
+
+    def __init__(self,cols_db,json_cols_db,exclude_db):
+        KeylimeDBBase.__init__(self, cols_db, json_cols_db, exclude_db)
+        # keep insertion order to match the rowid order returned by sqlite
+        self.rows = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def coerce(self,key,value):
+        """Apply the sqlite column affinity rules the sqlite engine gets for free"""
+        sqltype = self.cols_db[key]
+        if value is None:
+            return value
+        if 'INT' in sqltype:
+            if isinstance(value,bool):
+                return int(value)
+            if isinstance(value,basestring):
+                try:
+                    return int(value)
+                except ValueError:
+                    return value
+        elif 'REAL' in sqltype:
+            if isinstance(value,(int,long)) and not isinstance(value,bool):
+                return float(value)
+        elif 'TEXT' in sqltype:
+            # sqlite hands text back as unicode
+            if isinstance(value,(int,long,float)) and not isinstance(value,bool):
+                return unicode(value)
+            if isinstance(value,str):
+                return value.decode('utf-8')
+        return value
+
+    def journal(self,record):
+        """Called with the lock held after every change.  The memory engine keeps no journal."""
+        return
+
+    def apply(self,record):
+        """Apply a single change record to the in-memory table"""
+        op = record['op']
+        if op=='put':
+            self.rows[record['id']] = record['row']
+        elif op=='del':
+            self.rows.pop(record['id'],None)
+        elif op=='set':
+            if record['id'] in self.rows:
+                self.rows[record['id']][record['key']] = record['value']
+        elif op=='setall':
+            for row in self.rows.itervalues():
+                row[record['key']] = record['value']
+        else:
+            raise Exception("Invalid database record operation %s"%op)
+
+    def commit(self,record):
+        self.apply(record)
+        self.journal(record)
+
+    def add_instance(self,instance_id, d):
+        d = self.add_defaults(d)
+
+        d['instance_id']=instance_id
+
+        row = {}
+        for key in self.cols_db.keys():
+            v = d[key]
+            if key in self.json_cols_db and isinstance(d[key],dict):
+                v = json.dumps(d[key])
+            row[key] = self.coerce(key,v)
+
+        with self.lock:
+            # don't allow overwrite
+            if row['instance_id'] in self.rows:
+                return None
+            self.commit({'op':'put','id':row['instance_id'],'row':row})
+
+        # these are JSON strings and should be converted to dictionaries
+        for item in self.json_cols_db:
+            if d[item] is not None and isinstance(d[item],basestring):
+                d[item] = json.loads(d[item])
+        return d
+
+    def remove_instance(self,instance_id):
+        instance_id = self.coerce('instance_id',instance_id)
+        with self.lock:
+            if instance_id not in self.rows:
+                return False
+            self.commit({'op':'del','id':instance_id})
+        return True
+
+    def update_instance(self,instance_id, key, value):
+        self.check_key(key)
+
+        value = self.coerce(key,self.marshal(key,value))
+        instance_id = self.coerce('instance_id',instance_id)
+        with self.lock:
+            if instance_id in self.rows:
+                self.commit({'op':'set','id':instance_id,'key':key,'value':value})
+        return
+
+    def update_instance_fields(self,instance_id,d):
+        for key in d:
+            self.check_key(key)
+
+        values = dict((key,self.coerce(key,self.marshal(key,value))) for key,value in d.items())
+        instance_id = self.coerce('instance_id',instance_id)
+        with self.lock:
+            if instance_id in self.rows:
+                row = dict(self.rows[instance_id])
+                row.update(values)
+                self.commit({'op':'put','id':instance_id,'row':row})
+        return
+
+    def update_all_instances(self,key,value):
+        self.check_key(key)
+
+        value = self.coerce(key,self.marshal(key,value))
+        with self.lock:
+            self.commit({'op':'setall','key':key,'value':value})
+        return
+
+    def get_instance(self,instance_id):
+        instance_id = self.coerce('instance_id',instance_id)
+        with self.lock:
+            row = self.rows.get(instance_id,None)
+            if row is None:
+                return None
+            return self.unmarshal(row)
+
+    def get_instance_ids(self):
+        with self.lock:
+            return self.rows.keys()
+
+    def find_instance_ids(self,criteria):
+        self.check_criteria(criteria)
+        criteria = dict((key,self.coerce(key,value)) for key,value in criteria.items())
+        with self.lock:
+            return [instance_id for instance_id,row in self.rows.items() if all(row[key]==criteria[key] for key in criteria)]
+
+    def remove_instances_before(self,key,value,criteria={}):
+        self.check_criteria({key:value})
+        self.check_criteria(criteria)
+        value = self.coerce(key,value)
+        criteria = dict((k,self.coerce(k,v)) for k,v in criteria.items())
+        with self.lock:
+            instance_ids = [instance_id for instance_id,row in self.rows.items() 
+                            if row[key] is not None and row[key]<value and all(row[k]==criteria[k] for k in criteria)]
+            for instance_id in instance_ids:
+                self.commit({'op':'del','id':instance_id})
+        return len(instance_ids)
+
+    def count_instances(self):
+        with self.lock:
+            return len(self.rows)
+
+    def overwrite_instance(self,instance_id,instance):
+        instance_id = self.coerce('instance_id',instance_id)
+        with self.lock:
+            if instance_id not in self.rows:
+                return
+            row = {'instance_id':instance_id}
+            for key in self.cols_db.keys():
+                if key == 'instance_id':
+                    continue
+                row[key] = self.coerce(key,self.marshal(key,instance[key]))
+            self.commit({'op':'put','id':instance_id,'row':row})
+        return
+
+class KeylimeLogDB(KeylimeMemoryDB):
+    """Storage engine that serves reads from memory and persists every change to an append-only log.
+
+    Each change is written as one JSON record per line.  Once the log holds more than
+    compaction_threshold records (and at least twice as many records as live rows) it is
+    rewritten as a snapshot with one record per row.  On startup the log is replayed into memory.
+    """
+    db_filename = None
+    logfile = None
+    num_records = 0
+    compaction_threshold = None
+    fsync = False
+
+    def __init__(self,dbname,cols_db,json_cols_db,exclude_db,compaction_threshold=10000,fsync=False):
+        KeylimeMemoryDB.__init__(self, cols_db, json_cols_db, exclude_db)
+        self.db_filename = dbname
+        self.compaction_threshold = compaction_threshold
+        self.fsync = fsync
+
+        # turn off persistence by default in development mode
+        if common.DEVELOP_IN_ECLIPSE and os.path.exists(self.db_filename):
+            os.remove(self.db_filename)
+
+        os.umask(0o077)
+        kl_dir = os.path.dirname(os.path.abspath(self.db_filename))
+        if not os.path.exists(kl_dir):
+            os.makedirs(kl_dir, 0o700)
+        if os.geteuid()!=0 and not common.DEVELOP_IN_ECLIPSE:
+            logger.warning("Creating database without root.  Sensitive data may be at risk!")
+
+        self.replay()
+        # start from a clean snapshot so the log never carries history from a previous run
+        self.compact()
+
+    def replay(self):
+        if not os.path.exists(self.db_filename):
+            return
+        with open(self.db_filename,'r') as f:
+            lines = f.readlines()
+        for i in range(len(lines)):
+            try:
+                record = json.loads(lines[i])
+            except ValueError:
+                if i==len(lines)-1:
+                    # a torn write from a crash, everything before it is intact
+                    logger.warning("Ignoring incomplete final record in database log %s"%self.db_filename)
+                    break
+                raise Exception("Database log %s is corrupt at line %d"%(self.db_filename,i+1))
+            self.apply(record)
+        logger.debug("Replayed %d records from database log %s"%(len(lines),self.db_filename))
+
+    def write_record(self,f,record):
+        f.write(json.dumps(record))
+        f.write('\n')
+
+    def sync(self,f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def compact(self):
+        """Rewrite the log as a snapshot of the live rows.  Must be called with the lock held."""
+        tmpname = "%s.tmp"%self.db_filename
+        with open(tmpname,'w') as f:
+            for instance_id in self.rows:
+                self.write_record(f,{'op':'put','id':instance_id,'row':self.rows[instance_id]})
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpname,0o600)
+        if self.logfile is not None:
+            self.logfile.close()
+        os.rename(tmpname,self.db_filename)
+        self.logfile = open(self.db_filename,'a')
+        self.num_records = len(self.rows)
+
+    def journal(self,record):
+        self.write_record(self.logfile,record)
+        self.sync(self.logfile)
+        self.num_records+=1
+
+        if self.num_records > max(self.compaction_threshold, 2*len(self.rows)):
+            self.compact()
+
+def open_db(dbname,cols_db,json_cols_db,exclude_db,config=None,section=None):
+    """Create the storage engine selected by the db_engine option of the given config section.
+
+    Without a config the sqlite engine is used.  The log engine stores its log in dbname with the
+    extension replaced by .log.
+    """
+    engine = 'sqlite'
+    if config is not None:
+        engine = config.get(section,'db_engine')
+
+    if engine == 'sqlite':
+        import keylime_sqlite
+        return keylime_sqlite.KeylimeDB(dbname,cols_db,json_cols_db,exclude_db)
+    elif engine == 'memory':
+        logger.warning("Using in-memory database, nothing will be persisted across restarts")
+        return KeylimeMemoryDB(cols_db,json_cols_db,exclude_db)
+    elif engine == 'log':
+        logname = "%s.log"%os.path.splitext(dbname)[0]
+        return KeylimeLogDB(logname,cols_db,json_cols_db,exclude_db,
+                            compaction_threshold=config.getint(section,'db_log_compaction_threshold'),
+                            fsync=config.getboolean(section,'db_log_fsync'))
+    else:
+        raise Exception("Invalid db_engine %s, valid options are %s"%(engine,", ".join(VALID_ENGINES)))
@@ -23,24 +23,14 @@ logger = common.init_logging('keylime_sqlite')
 import os
 import sqlite3
 import json
+import keylime_db
 
-class KeylimeDB():
+class KeylimeDB(keylime_db.KeylimeDBBase):
     db_filename = None
-    # in the form key, SQL type
-    cols_db = None
-    # these are the columns that contain json data and need marshalling
-    json_cols_db = None
-    # in the form key : default value
-    exclude_db = None
 
     def __init__(self,dbname,cols_db,json_cols_db,exclude_db):
+        keylime_db.KeylimeDBBase.__init__(self, cols_db, json_cols_db, exclude_db)
         self.db_filename = dbname
-        self.cols_db = cols_db
-        self.json_cols_db = json_cols_db
-        self.exclude_db = exclude_db
-        
-        if 'instance_id' not in cols_db or 'PRIMARY_KEY' not in cols_db['instance_id']:
-            raise Exception("the primary key of the database must be instance_id")
         
         # turn off persistence by default in development mode
         if common.DEVELOP_IN_ECLIPSE and os.path.exists(self.db_filename):
@@ -76,11 +66,6 @@ class KeylimeDB():
             for row in rows:
                 print row
             
-    def add_defaults(self,instance):
-        for key in self.exclude_db.keys():
-            instance[key] = self.exclude_db[key]
-        return instance
-            
     def add_instance(self,instance_id, d):        
         d = self.add_defaults(d)
         
@@ -127,30 +112,37 @@ class KeylimeDB():
         return True
         
     def update_instance(self,instance_id, key, value):
-        if key not in self.cols_db.keys():
-            raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+        self.check_key(key)
         
         with sqlite3.connect(self.db_filename) as conn:
             cur = conn.cursor()
-            # marshall back to string
-            if key in self.json_cols_db:
-                value = json.dumps(value)
-            cur.execute('UPDATE main SET %s = ? where instance_id = ?'%(key),(value,instance_id))
+            cur.execute('UPDATE main SET %s = ? where instance_id = ?'%(key),(self.marshal(key,value),instance_id))
             conn.commit()
         
         self.print_db()
         return
     
+    def update_instance_fields(self,instance_id,d):
+        for key in d:
+            self.check_key(key)
+        keys = d.keys()
+        if len(keys)==0:
+            return
+        
+        with sqlite3.connect(self.db_filename) as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE main SET %s where instance_id = ?'%', '.join(['%s = ?'%key for key in keys]),
+                        tuple(self.marshal(key,d[key]) for key in keys)+(instance_id,))
+            conn.commit()
+        self.print_db()
+        return
+    
     def update_all_instances(self,key,value):
-        if key not in self.cols_db.keys():
-            raise Exception("Database key %s not in schema: %s"%(key,self.cols_db.keys()))
+        self.check_key(key)
         
         with sqlite3.connect(self.db_filename) as conn:
             cur = conn.cursor()
-            # marshall back to string if needed
-            if key in self.json_cols_db:
-                value = json.dumps(value)
-            cur.execute('UPDATE main SET %s = ?'%key,(value,))
+            cur.execute('UPDATE main SET %s = ?'%key,(self.marshal(key,value),))
             conn.commit()
         self.print_db()
         return
@@ -164,14 +156,7 @@ class KeylimeDB():
                 return None
             
             colnames = [description[0] for description in cur.description]
-            d ={}
-            for i in range(len(colnames)):
-                if colnames[i] in self.json_cols_db:
-                    d[colnames[i]] = json.loads(rows[0][i])
-                else:
-                    d[colnames[i]]=rows[0][i]
-            d = self.add_defaults(d)
-            return d
+            return self.unmarshal(zip(colnames,rows[0]))
     
     def get_instance_ids(self):
         with sqlite3.connect(self.db_filename) as conn:
@@ -185,19 +170,37 @@ class KeylimeDB():
                 retval.append(i[0])
             return retval
 
-    def count_instances(self):
-        return len(self.get_instance_ids())
+    def find_instance_ids(self,criteria):
+        self.check_criteria(criteria)
+        keys = criteria.keys()
+        query = 'SELECT instance_id from main'
+        if len(keys)>0:
+            query += ' where '+' and '.join(['%s = ?'%key for key in keys])
+        with sqlite3.connect(self.db_filename) as conn:
+            cur = conn.cursor()
+            cur.execute(query,tuple(criteria[key] for key in keys))
+            return [row[0] for row in cur.fetchall()]
+
+    def remove_instances_before(self,key,value,criteria={}):
+        self.check_criteria({key:value})
+        self.check_criteria(criteria)
+        keys = criteria.keys()
+        query = 'DELETE FROM main WHERE %s < ?'%key
+        if len(keys)>0:
+            query += ' and '+' and '.join(['%s = ?'%k for k in keys])
+        with sqlite3.connect(self.db_filename) as conn:
+            cur = conn.cursor()
+            cur.execute(query,(value,)+tuple(criteria[k] for k in keys))
+            conn.commit()
+            return cur.rowcount
 
     def overwrite_instance(self,instance_id,instance):
         with sqlite3.connect(self.db_filename) as conn:
             cur = conn.cursor()
             for key in self.cols_db.keys():
-                if key is 'instance_id':
+                if key == 'instance_id':
                     continue
-                if key in self.json_cols_db:
-                    cur.execute('UPDATE main SET %s = ? where instance_id = ?'%(key),(json.dumps(instance[key]),instance_id))
-                else:
-                    cur.execute('UPDATE main SET %s = ? where instance_id = ?'%(key),(instance[key],instance_id))
+                cur.execute('UPDATE main SET %s = ? where instance_id = ?'%(key),(self.marshal(key,instance[key]),instance_id))
             conn.commit()
         self.print_db()
         return
@@ -49,8 +49,9 @@ def main(argv=sys.argv):
         argv = ['provider_platform_init.py','1','2']
     
     if len(argv)<3:
-        print "usage: provider_platform_init.py pubek.pem tpm_ekcert.der"
+        print "usage: provider_platform_init.py pubek.pem tpm_ekcert.der [num_groups]"
         print "\tassociates a hypervisor host to its TPM and registers it"
+        print "\tnum_groups vTPM groups are created and registered at once (default 1)"
         print 
         print "\tYou must obtain the public EK and the EK certificate from outside of Xen"
         print "\ttake ownership first, then obtain pubek, and ekcert as follows"
@@ -62,6 +63,10 @@ def main(argv=sys.argv):
     if common.DEVELOP_IN_ECLIPSE and not common.STUB_TPM:
         raise Exception("Can't use Xen features in Eclipse without STUB_TPM")
     
+    num_groups = 1
+    if len(argv)>3:
+        num_groups = int(argv[3])
+    
     # read in the pubek
     if common.STUB_TPM or common.DEVELOP_IN_ECLIPSE:
         ek = common.TEST_PUB_EK
@@ -71,44 +76,59 @@ def main(argv=sys.argv):
         ek = f.read()
         f.close()
         f = open(argv[2],'r')
-        ek = base64.b64encode(f.read())
+        ekcert = base64.b64encode(f.read())
         f.close()
             
     # fetch configuration parameters 
     provider_reg_port = config.get('general', 'provider_registrar_port')
     provider_reg_ip = config.get('general', 'provider_registrar_ip')
     
-    # create a new group
-    (group_uuid,group_aik,group_num,_) = vtpm_manager.add_vtpm_group()
+    # create the new groups
+    groups = []
+    while len(groups)<num_groups:
+        (group_uuid,group_aik,group_num,_) = vtpm_manager.add_vtpm_group()
+        groups.append((group_uuid,group_aik,group_num))
+        if group_num==0:
+            logger.info("WARNING: Group 0 created, creating another group to use as Group 1")
+            num_groups+=1
 
-    # registrar it and get back a blob
-    keyblob = registrar_client.doRegisterNode(provider_reg_ip,provider_reg_port,group_uuid,ek,ekcert,group_aik)
+    # register them all and get back a blob for each
+    nodes = {}
+    for (group_uuid,group_aik,_) in groups:
+        nodes[group_uuid] = (ek,ekcert,group_aik)
+    keyblobs = registrar_client.doRegisterNodes(provider_reg_ip,provider_reg_port,nodes)
     
-    # get the ephemeral registrar key by activating in the hardware tpm
-    key = base64.b64encode(vtpm_manager.activate_group(group_uuid, keyblob))
+    # get the ephemeral registrar keys by activating in the hardware tpm
+    keys = {}
+    for (group_uuid,_,_) in groups:
+        if keyblobs[group_uuid] is None:
+            raise Exception("Registration of VTPM group %s failed"%group_uuid)
+        keys[group_uuid] = base64.b64encode(vtpm_manager.activate_group(group_uuid, keyblobs[group_uuid]))
     
-    # tell the registrar server we know the key
-    registrar_client.doActivateNode(provider_reg_ip,provider_reg_port,group_uuid,key)
+    # tell the registrar server we know the keys
+    activated = registrar_client.doActivateNodes(provider_reg_ip,provider_reg_port,keys)
 
-    if not common.STUB_TPM:
-        output= {
-                 'uuid': group_uuid,
-                 'aikpem': group_aik,
-                 'pubekpem': ek,
-                 'ekcert': ekcert,
-                 }
+    for (group_uuid,group_aik,group_num) in groups:
+        if not activated[group_uuid]:
+            raise Exception("Activation of VTPM group %s failed"%group_uuid)
         
-        # store the key and the group UUID in a file to add to vtpms later
-        with open("group-%d-%s.tpm"%(group_num,group_uuid),'w') as f:
-            json.dump(output,f)
-
-    logger.info("Activated VTPM group %d, UUID %s"%(group_num,group_uuid))
-    if group_num==0:
-        logger.info("WARNING: Group 0 created, repeating activation again to create Group 1")
-        main(argv)
-    else:
-        # create a symlink to the most recently create group
-        symlink_force("group-%d-%s.tpm"%(group_num,group_uuid),"current_group.tpm")
+        if not common.STUB_TPM:
+            output= {
+                     'uuid': group_uuid,
+                     'aikpem': group_aik,
+                     'pubekpem': ek,
+                     'ekcert': ekcert,
+                     }
+            
+            # store the key and the group UUID in a file to add to vtpms later
+            with open("group-%d-%s.tpm"%(group_num,group_uuid),'w') as f:
+                json.dump(output,f)
+    
+        logger.info("Activated VTPM group %d, UUID %s"%(group_num,group_uuid))
+    
+    # create a symlink to the most recently create group
+    (group_uuid,_,group_num) = groups[-1]
+    symlink_force("group-%d-%s.tpm"%(group_num,group_uuid),"current_group.tpm")
 
 if __name__=="__main__":
     try:
@@ -27,19 +27,34 @@ import common
 import ssl
 import os
 import logging
+import hashlib
+import bisect
+import threading
 
 logger = common.init_logging('registrar_client')
 context = None
+tls_initialized = False
+tls_lock = threading.Lock()
 
 def init_client_tls(config,section):
-    global context
-    
+    """Set up the client TLS context once per process.  It is kept for the life of the process
+    so that connections and TLS sessions to the registrar are reused."""
     #make this reentrant
-    if context is not None:
+    if tls_initialized:
         return
     
+    # worker threads may get here at the same time, only one of them builds the context
+    with tls_lock:
+        if not tls_initialized:
+            build_client_tls(config,section)
+
+def build_client_tls(config,section):
+    """Build the client TLS context and publish it once it is complete.  Must be called with tls_lock held."""
+    global context, tls_initialized
+    
     if not config.getboolean('general',"enable_tls"):
         logger.warning("TLS is currently disabled, AIKs may not be authentic.")
+        tls_initialized = True
         return None
     
     logger.info("Setting up client TLS...")
@@ -73,16 +88,95 @@ def init_client_tls(config,section):
     my_cert = "%s/%s"%(tls_dir,my_cert)
     my_priv_key = "%s/%s"%(tls_dir,my_priv_key)
     
-    context = ssl.create_default_context()
-    context.load_verify_locations(cafile=ca_path)   
-    context.check_hostname = config.getboolean('general','tls_check_hostnames')
-    context.verify_mode = ssl.CERT_REQUIRED
+    new_context = ssl.create_default_context()
+    new_context.load_verify_locations(cafile=ca_path)   
+    new_context.check_hostname = config.getboolean('general','tls_check_hostnames')
+    new_context.verify_mode = ssl.CERT_REQUIRED
     
     if my_key_pw=='default':
         logger.warning("CAUTION: using default password for private key, please set private_key_pw to a strong password")
                 
-    context.load_cert_chain(certfile=my_cert,keyfile=my_priv_key,password=my_key_pw)
+    new_context.load_cert_chain(certfile=my_cert,keyfile=my_priv_key,password=my_key_pw)
+    context = new_context
+    tls_initialized = True
+    
+class RegistrarRing(object):
+    """Consistent hash ring that assigns instance ids to the shards of a registrar cluster.
+    
+    Each shard is an (ip,port,tls_port) tuple placed at VNODES points on the ring.  An instance 
+    id belongs to the first shard found clockwise from its own point, so adding a shard only 
+    moves the ids between its points and the points before them, all of which it takes from 
+    the next shard clockwise.
+    """
+    VNODES = 128
+    
+    def __init__(self,shards):
+        if len(shards)==0:
+            raise Exception("a registrar cluster needs at least one shard")
+        self.shards = shards
+        self.points = []
+        for shard in shards:
+            for i in range(self.VNODES):
+                self.points.append((self.hash("%s:%s:%s#%d"%(shard+(i,))),shard))
+        self.points.sort()
+        self.hashes = [point[0] for point in self.points]
     
+    def hash(self,key):
+        return long(hashlib.md5(key).hexdigest()[:16],16)
+    
+    def owners(self,instance_id):
+        """Returns the distinct shards clockwise from the point of instance_id, its owner first"""
+        start = bisect.bisect(self.hashes,self.hash(instance_id))
+        owners = []
+        for i in range(len(self.points)):
+            shard = self.points[(start+i)%len(self.points)][1]
+            if shard not in owners:
+                owners.append(shard)
+                if len(owners)==len(self.shards):
+                    break
+        return owners
+    
+    def owner(self,instance_id):
+        return self.owners(instance_id)[0]
+
+def parse_shard(value):
+    tokens = value.strip().split(':')
+    if len(tokens)!=3:
+        raise Exception("invalid registrar shard %s, expected ip:port:tls_port"%value)
+    return tuple(tokens)
+
+ring = None
+
+def get_ring(config):
+    """Returns the ring of the registrar cluster from registrar_shards or None if there is no cluster"""
+    global ring
+    value = config.get('general','registrar_shards').strip()
+    if value=="":
+        return None
+    if ring is None:
+        ring = RegistrarRing([parse_shard(shard) for shard in value.split(',')])
+    return ring
+
+def route(config,instance_id,registrar_ip,registrar_port,tls=False):
+    """Returns the (ip,port) of the registrars to try for instance_id in order.
+    
+    Without a registrar cluster this is just the given registrar.  Otherwise it is the shard that 
+    owns instance_id followed by the next shard clockwise, which held the id before its owner 
+    was added and keeps it until it has handed it off.
+    """
+    cluster = get_ring(config)
+    if cluster is None:
+        return [(registrar_ip,registrar_port)]
+    return [(shard[0],shard[2] if tls else shard[1]) for shard in cluster.owners(instance_id)[:2]]
+
+def getRoutedKeys(config,instance_id,registrar_ip,registrar_port):
+    """getKeys from the registrar or registrar cluster shard that holds instance_id"""
+    for (ip,port) in route(config,instance_id,registrar_ip,registrar_port,tls=True):
+        keys = getKeys(ip,port,instance_id)
+        if keys is not None:
+            return keys
+    return None
+
 def getAIK(registrar_ip,registrar_port,instance_id):
     retval = getKeys(registrar_ip,registrar_port,instance_id)
     if retval is None:
@@ -175,6 +269,105 @@ def doActivateNode(registrar_ip,registrar_port,instance_id,key):
         logger.error("Error: unexpected http response code from Registrar Server: " + str(response.status_code))
         common.log_http_response(logger,logging.ERROR,response.json())
 
+def doRegisterNodes(registrar_ip,registrar_port,nodes):
+    """Register many nodes in one request.
+    
+    :param nodes: dictionary of instance_id to a (pub_ek,ekcert,pub_aik) tuple
+    :returns: dictionary of instance_id to the blob for that node, or None if its registration failed
+    """
+    data = {'instances':{}}
+    for instance_id in nodes:
+        (pub_ek,ekcert,pub_aik) = nodes[instance_id]
+        data['instances'][instance_id] = {
+        'ek': pub_ek,
+        'ekcert': ekcert,
+        'aik': pub_aik,
+        }
+    v_json_message = json.dumps(data)
+    
+    response = tornado_requests.request("POST",
+                                        "http://%s:%s/v2/instances/"%(registrar_ip,registrar_port),
+                                        data=v_json_message,
+                                        context=None)
+
+    response_body = response.json() 
+    
+    if response.status_code != 200:
+        logger.error("Error: unexpected http response code from Registrar Server: " + str(response.status_code))
+        common.log_http_response(logger,logging.ERROR,response_body)
+        return dict.fromkeys(nodes)
+    
+    blobs = {}
+    results = response_body.get("results",{}).get("instances",{})
+    for instance_id in nodes:
+        result = results.get(instance_id,None)
+        if result is None or result['code'] != 200 or "blob" not in result['results']:
+            logger.error("Error: registration of %s failed: %s"%(instance_id,None if result is None else result['status']))
+            blobs[instance_id] = None
+        else:
+            blobs[instance_id] = result['results']['blob']
+    
+    logger.info("Node registration requested for %d nodes"%len(nodes))
+    return blobs
+
+def doActivateNodes(registrar_ip,registrar_port,keys):
+    """Activate many nodes in one request.
+    
+    :param keys: dictionary of instance_id to the key released by activating its AIK
+    :returns: dictionary of instance_id to True if the node was activated
+    """
+    data = {'instances':{}}
+    for instance_id in keys:
+        data['instances'][instance_id] = {
+        'auth_tag': crypto.do_hmac(base64.b64decode(keys[instance_id]),instance_id),
+        }
+    v_json_message = json.dumps(data)
+    
+    response = tornado_requests.request("PUT",
+                                        "http://%s:%s/v2/instances/"%(registrar_ip,registrar_port),
+                                        data=v_json_message,
+                                        context=None)
+    
+    response_body = response.json()
+    
+    if response.status_code != 200:
+        logger.error("Error: unexpected http response code from Registrar Server: " + str(response.status_code))
+        common.log_http_response(logger,logging.ERROR,response_body)
+        return dict.fromkeys(keys,False)
+    
+    activated = {}
+    results = response_body.get("results",{}).get("instances",{})
+    for instance_id in keys:
+        result = results.get(instance_id,None)
+        activated[instance_id] = result is not None and result['code'] == 200
+        if activated[instance_id]:
+            logger.info("Registration activated for node %s."%instance_id)
+        else:
+            logger.error("Error: activation of %s failed: %s"%(instance_id,None if result is None else result['status']))
+    return activated
+
+def doTransferInstance(registrar_ip,registrar_tls_port,instance_id,record):
+    """Hand off the record of instance_id to the registrar cluster shard that now owns it.
+    
+    :returns: True if the shard holds the record afterwards
+    """
+    global context
+    data = {}
+    for key in ['key','aik','ek','ekcert','virtual','active','provider_keys']:
+        data[key] = record[key]
+    
+    response = tornado_requests.request("POST",
+                                        "http://%s:%s/v2/instances/%s"%(registrar_ip,registrar_tls_port,instance_id),
+                                        data=json.dumps(data),
+                                        context=context)
+    
+    # the owner already has a record if the node registered with it directly
+    if response.status_code in (200,409):
+        return True
+    logger.error("Error: unexpected http response code from Registrar Server: " + str(response.status_code))
+    common.log_http_response(logger,logging.ERROR,response.json())
+    return False
+
 def doActivateVirtualNode(registrar_ip,registrar_port,instance_id,deepquote):
     data = {
     'deepquote': deepquote,
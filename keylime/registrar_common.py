@@ -23,10 +23,6 @@ violate any copyrights that exist in this work.
 import common
 logger = common.init_logging('registrar-common')
 
-import BaseHTTPServer
-from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from SocketServer import ThreadingMixIn
-from urlparse import urlparse
 import json
 import threading
 import traceback
@@ -41,41 +37,317 @@ import signal
 import time
 import hashlib
 import cloud_verifier_common
-import keylime_sqlite
+import keylime_db
+import collections
+import tornado.ioloop
+import tornado.web
+import tornado.gen
+import tornado.iostream
+from tornado import httpserver
+from concurrent.futures import ThreadPoolExecutor
 
 config = ConfigParser.SafeConfigParser()
 config.read(common.CONFIG_FILE)
-      
-class ProtectedHandler(BaseHTTPRequestHandler):
 
-    def do_HEAD(self):
+class WorkerPoolFull(Exception):
+    pass
+
+class WorkerPool(object):
+    """Runs the blocking parts of registration (EK verification, AIK encryption, deep quote 
+    checks and the database writes) on a fixed number of threads so they do not stall the IOLoop.
+    
+    At most max_queued calls may wait for a free thread, past that submit raises WorkerPoolFull
+    so that the request can be turned away instead of piling up during a boot storm.
+    """
+    def __init__(self,num_workers,max_queued):
+        self.num_workers = num_workers
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.completed = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+    
+    def queued(self):
+        return max(0,self.pending-self.num_workers)
+    
+    def run(self,submitted,fn,args):
+        started = time.time()
+        try:
+            return fn(*args)
+        except Exception:
+            with self.lock:
+                self.failed+=1
+            raise
+        finally:
+            with self.lock:
+                self.pending-=1
+                self.completed+=1
+                self.wait_time+=started-submitted
+                self.max_wait_time = max(self.max_wait_time,started-submitted)
+                self.run_time+=time.time()-started
+    
+    def submit(self,fn,*args):
+        """Returns a future for fn(*args) that can be yielded from a coroutine"""
+        with self.lock:
+            if self.queued()>=self.max_queued:
+                self.rejected+=1
+                raise WorkerPoolFull("%d requests already waiting for a worker"%self.queued())
+            self.pending+=1
+            self.submitted+=1
+        return self.executor.submit(self.run,time.time(),fn,args)
+    
+    def get_metrics(self):
+        with self.lock:
+            completed = max(1,self.completed)
+            return {
+                'workers': self.num_workers,
+                'active': min(self.pending,self.num_workers),
+                'queued': self.queued(),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'completed': self.completed,
+                'avg_wait_time': self.wait_time/completed,
+                'max_wait_time': self.max_wait_time,
+                'avg_run_time': self.run_time/completed,
+                }
+    
+    def log_metrics(self):
+        logger.info("Worker pool metrics: %s"%json.dumps(self.get_metrics(),sort_keys=True))
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+def check_ek(ek,ekcert):
+    """Check the EK certificate of a node, raising an exception if it is required and not valid"""
+    # config option must be on to check for EK certs
+    if config.getboolean('registrar','require_ek_cert'):
+        # no EK provided
+        if ekcert is None and not common.DEVELOP_IN_ECLIPSE:
+            raise Exception("No EK cert provided, require_ek_cert option in config set to True")
+        
+        # there is an EK
+        if not common.STUB_TPM and (ekcert!=None and ekcert!='virtual' and not tpm_initialize.verify_ek(base64.b64decode(ekcert), ek)):
+                raise Exception("Invalid EK certificate")
+
+def register_keys(instance_id,ek,ekcert,aik):
+    """Check the EK certificate and encrypt the AIK for a new node.  Runs on the worker pool."""
+    check_ek(ek,ekcert)
+    # try to encrypt the AIK
+    return tpm_initialize.encryptAIK(instance_id,aik,ek)
+
+def accept_handoff(db,instance_id,d):
+    """Check the EK of an instance handed off by another shard and store its record.  Runs on the worker pool.
+    
+    Returns False if the instance is already registered with this shard.
+    """
+    check_ek(d['ek'],d['ekcert'])
+    return db.add_instance(instance_id,d) is not None
+
+def register_instance(db,instance_id,ek,ekcert,aik):
+    """Check the keys of a new node and store its record, returns the encrypted AIK blob.  Runs on the worker pool."""
+    (blob,key) = register_keys(instance_id,ek,ekcert,aik)
+    d={}
+    d['ek']=ek
+    d['aik']=aik
+    d['ekcert']=ekcert
+    d['virtual']=int(ekcert=='virtual')
+    d['active']=int(False)
+    d['key']=key
+    d['provider_keys']={}
+    db.add_instance(instance_id, d)
+    return blob
+
+def activate_instance(db,instance_id,auth_tag):
+    """Check the auth tag of a physical node and mark its record active.  Runs on the worker pool."""
+    instance = db.get_instance(instance_id)
+    if instance is None:
+        raise Exception("attempting to activate instance before requesting registrar for %s"%instance_id)
+    
+    if instance['virtual']:
+        raise Exception("attempting to activate virtual AIK using physical interface for %s"%instance_id)
+    
+    if not common.STUB_TPM:
+        ex_mac = crypto.do_hmac(base64.b64decode(instance['key']),instance_id)
+        if ex_mac != auth_tag:
+            raise Exception("Auth tag %s does not match expected value %s"%(auth_tag,ex_mac))
+    db.update_instance(instance_id, 'active',True)
+
+# keys fetched from the provider registrar by instance_id as (time fetched, keys), oldest first
+provider_keys_cache = collections.OrderedDict()
+provider_keys_cache_lock = threading.Lock()
+# most provider keys to remember
+PROVIDER_KEYS_CACHE_SIZE = 1024
+
+def get_provider_keys(instance_id):
+    """Fetch the keys of the provider of a virtual node, remembering them for provider_keys_cache_ttl seconds"""
+    ttl = config.getfloat('registrar','provider_keys_cache_ttl')
+    now = time.time()
+    with provider_keys_cache_lock:
+        # entries are in the order they were fetched, so the expired ones are at the front
+        while len(provider_keys_cache)>0:
+            oldest = next(iter(provider_keys_cache))
+            if now-provider_keys_cache[oldest][0]<ttl:
+                break
+            del provider_keys_cache[oldest]
+        cached = provider_keys_cache.get(instance_id,None)
+    if cached is not None:
+        return cached[1]
+    
+    registrar_client.init_client_tls(config, 'registrar')
+    provider_keys = registrar_client.getKeys(config.get('general', 'provider_registrar_ip'), config.get('general', 'provider_registrar_tls_port'), instance_id)
+    if provider_keys is not None and ttl>0:
+        with provider_keys_cache_lock:
+            provider_keys_cache.pop(instance_id,None)
+            provider_keys_cache[instance_id] = (time.time(),provider_keys)
+            while len(provider_keys_cache)>PROVIDER_KEYS_CACHE_SIZE:
+                provider_keys_cache.popitem(last=False)
+    return provider_keys
+
+def check_virtual_activation(instance_id,instance,deepquote):
+    """Check the deep quote of a virtual node against the AIK of its provider.  Runs on the worker pool.
+    
+    Returns the keys of the provider.
+    """
+    # get an physical AIK for this host
+    provider_keys = get_provider_keys(instance_id)
+    if provider_keys is None:
+        raise Exception("Unable to get provider keys for %s"%instance_id)
+    # we already have the vaik
+    if not tpm_quote.check_deep_quote(hashlib.sha1(instance['key']),
+                                      instance_id+instance['aik']+instance['ek'], 
+                                      deepquote,  
+                                      instance['aik'],  
+                                      provider_keys['aik']):
+        raise Exception("Deep quote invalid")
+    return provider_keys
+
+def vactivate_instance(db,instance_id,deepquote):
+    """Check the deep quote of a virtual node and mark its record active.  Runs on the worker pool."""
+    instance = db.get_instance(instance_id)
+    if instance is None:
+        raise Exception("attempting to activate instance before requesting registrar for %s"%instance_id)
+    
+    if not instance['virtual']:
+        raise Exception("attempting to activate physical AIK using virtual interface for %s"%instance_id)
+    
+    provider_keys = check_virtual_activation(instance_id,instance,deepquote)
+    db.update_instance_fields(instance_id,{'active':True,'provider_keys':provider_keys})
+
+class RegistrarCache(object):
+    """Write-through cache of active registrar records in front of the database.
+    
+    Both registrar servers in a process share one cache.  Reads of active records are served 
+    from memory, all changes go to the database first and are then applied to the cached copy.
+    Records that are not yet active are not cached as they are only read to be activated.  At 
+    most cache_size records are kept, least recently used first out.  All access is from the 
+    IOLoop thread.  Registration and activation write to the database behind the cache from the 
+    worker pool instead, and then forget the cached copy of the record.
+    """
+    def __init__(self,db,cache_size):
+        self.db = db
+        self.cache_size = cache_size
+        self.records = collections.OrderedDict()
+    
+    def copy(self,record):
+        record = dict(record)
+        if isinstance(record.get('provider_keys',None),dict):
+            record['provider_keys'] = dict(record['provider_keys'])
+        return record
+    
+    def forget(self,instance_id):
+        """Drop the cached copy of a record changed in the database directly"""
+        self.records.pop(instance_id,None)
+    
+    def add_instance(self,instance_id,d):
+        self.records.pop(instance_id,None)
+        return self.db.add_instance(instance_id,d)
+    
+    def remove_instance(self,instance_id):
+        self.records.pop(instance_id,None)
+        return self.db.remove_instance(instance_id)
+    
+    def update_instance(self,instance_id,key,value):
+        self.db.update_instance(instance_id,key,value)
+        if instance_id in self.records:
+            # keep our own copy so later changes by the caller do not leak into the cache
+            if isinstance(value,dict):
+                value = dict(value)
+            self.records[instance_id][key] = value
+    
+    def get_instance(self,instance_id):
+        record = self.records.pop(instance_id,None)
+        if record is None:
+            record = self.db.get_instance(instance_id)
+            if record is None or not record['active'] or self.cache_size<=0:
+                return record
+        self.records[instance_id] = record
+        while len(self.records)>self.cache_size:
+            self.records.popitem(last=False)
+        return self.copy(record)
+    
+    def get_instance_ids(self):
+        return self.db.get_instance_ids()
+    
+    def count_instances(self):
+        return self.db.count_instances()
+
+class BaseHandler(tornado.web.RequestHandler):
+    db = None
+    workers = None
+    shard = None
+    shard_subjects = []
+    
+    def initialize(self, db, workers=None, shard=None, shard_subjects=[]):
+        self.db = db
+        self.workers = workers
+        self.shard = shard
+        self.shard_subjects = shard_subjects
+    
+    def write_error(self, status_code, **kwargs):
+        common.echo_json_response(self, status_code, self._reason)
+    
+    def busy(self, instance_id, e):
+        self.set_header('Retry-After', '1')
+        common.echo_json_response(self, 503, "Registrar busy: %s"%e)
+        logger.warning("%s for %s returning 503 response. Error: %s"%(self.request.method,instance_id,e))
+
+class ProtectedHandler(BaseHandler):
+
+    def head(self):
         """HEAD not supported"""    
         common.echo_json_response(self, 405, "HEAD not supported")
         return
     
-    def do_PATCH(self):
+    def patch(self):
         """PATCH not supported"""   
         common.echo_json_response(self, 405, "PATCH not supported")
         return  
        
-    def do_GET(self):
+    def get(self):
         """This method handles the GET requests to retrieve status on instances from the Registrar Server. 
         
         Currently, only instances resources are available for GETing, i.e. /v2/instances. All other GET uri's 
         will return errors. instances requests require a single instance_id parameter which identifies the 
         instance to be returned. If the instance_id is not found, a 404 response is returned.
         """
-        rest_params = common.get_restful_params(self.path)
+        rest_params = common.get_restful_params(self.request.path)
         
         if "instances" not in rest_params:
             common.echo_json_response(self, 400, "uri not supported")
-            logger.warning('GET returning 400 response. uri not supported: ' + self.path)
+            logger.warning('GET returning 400 response. uri not supported: ' + self.request.path)
             return
         
         instance_id = rest_params["instances"]
         
         if instance_id is not None:
-            instance = self.server.db.get_instance(instance_id)
+            instance = self.db.get_instance(instance_id)
             
             if instance is None:
                 common.echo_json_response(self, 404, "instance_id not found")
@@ -100,40 +372,100 @@ class ProtectedHandler(BaseHTTPRequestHandler):
             logger.info('GET returning 200 response for instance_id:' + instance_id)
         else:
             # return the available registered uuids from the DB
-            json_response = self.server.db.get_instance_ids()
+            json_response = self.db.get_instance_ids()
             common.echo_json_response(self, 200, "Success", {'uuids':json_response})
             logger.info('GET returning 200 response for instance_id list')
         
         return
 
 
-    def do_POST(self):
-        """POST not supported"""   
-        common.echo_json_response(self, 405, "POST not supported via TLS interface")
+    def peer_subject(self):
+        """Returns the common name of the client certificate of the request, None without one"""
+        if not isinstance(self.request.connection.stream, tornado.iostream.SSLIOStream):
+            return None
+        cert = self.request.get_ssl_certificate()
+        if not cert:
+            return None
+        for rdn in cert.get('subject',()):
+            for key,value in rdn:
+                if key=='commonName':
+                    return value
+        return None
+
+    @tornado.gen.coroutine
+    def post(self):
+        """This method handles the POST requests to hand off instances between the shards of a registrar cluster.
+        
+        Only registrars that are a shard of a cluster accept these, and only from clients whose certificate 
+        common name is listed in shard_subjects.  POST requests require an instance_id identifying the instance 
+        and a json block with its record.  The EK of the instance is checked again and the record is stored 
+        active or not as the sending shard reports, so nodes that activated with their old shard keep being 
+        served by the new one without registering again.  If the instance is already registered with this 
+        shard, a 409 response is returned.
+        """
+        if self.shard is None:
+            common.echo_json_response(self, 405, "POST not supported via TLS interface")
+            return
+        
+        subject = self.peer_subject()
+        if subject is None or subject not in self.shard_subjects:
+            common.echo_json_response(self, 403, "hand off not allowed from %s"%subject)
+            logger.warning('POST returning 403 response. hand off from %s not in shard_subjects'%subject)
+            return
+        
+        rest_params = common.get_restful_params(self.request.path)
+        
+        if "instances" not in rest_params or rest_params["instances"] is None:
+            common.echo_json_response(self, 400, "uri not supported")
+            logger.warning('POST instance returning 400 response. uri not supported: ' + self.request.path)
+            return
+        
+        instance_id = rest_params["instances"]
+        
+        try:
+            json_body = json.loads(self.request.body)
+            d = {}
+            for key in ['key','aik','ek','ekcert','virtual','active','provider_keys']:
+                d[key] = json_body[key]
+            d['active'] = int(bool(d['active']))
+            
+            added = yield self.workers.submit(accept_handoff,self.db.db,instance_id,d)
+            self.db.forget(instance_id)
+            if not added:
+                common.echo_json_response(self, 409, "instance_id %s already exists"%instance_id)
+                return
+            
+            common.echo_json_response(self, 200, "Success")
+            logger.info('POST accepted hand off of instance_id %s from %s'%(instance_id,subject))
+        except WorkerPoolFull as e:
+            self.busy(instance_id, e)
+        except Exception as e:
+            common.echo_json_response(self, 400, "Error: %s"%e)
+            logger.warning("POST for " + instance_id + " returning 400 response. Error: %s"%e)
         return 
 
-    def do_PUT(self):
+    def put(self):
         """PUT not supported"""   
         common.echo_json_response(self, 405, "PUT not supported via TLS interface")
         return 
 
-    def do_DELETE(self):
+    def delete(self):
         """This method handles the DELETE requests to remove instances from the Registrar Server. 
         
         Currently, only instances resources are available for DELETEing, i.e. /v2/instances. All other DELETE uri's will return errors.
         instances requests require a single instance_id parameter which identifies the instance to be deleted.    
         """
-        rest_params = common.get_restful_params(self.path)
+        rest_params = common.get_restful_params(self.request.path)
         
         if "instances" not in rest_params:
             common.echo_json_response(self, 400, "uri not supported")
-            logger.warning('DELETE instance returning 400 response. uri not supported: ' + self.path)
+            logger.warning('DELETE instance returning 400 response. uri not supported: ' + self.request.path)
             return
         
         instance_id = rest_params["instances"]
         
         if instance_id is not None:
-            if self.server.db.remove_instance(instance_id):
+            if self.db.remove_instance(instance_id):
                 #send response
                 common.echo_json_response(self, 200, "Success")
                 return
@@ -144,219 +476,214 @@ class ProtectedHandler(BaseHTTPRequestHandler):
         else:
             common.echo_json_response(self, 404)
             return                    
-    def log_message(self, logformat, *args):
-        return  
 
 
-class UnprotectedHandler(BaseHTTPRequestHandler):
+class UnprotectedHandler(BaseHandler):
 
-    def do_HEAD(self):
+    def head(self):
         """HEAD not supported"""    
         common.echo_json_response(self, 405, "HEAD not supported")
         return
     
-    def do_PATCH(self):
+    def patch(self):
         """PATCH not supported"""   
         common.echo_json_response(self, 405, "PATCH not supported")
         return  
        
-    def do_GET(self):
+    def get(self):
         """GET not supported"""   
         common.echo_json_response(self, 405, "GET not supported")
         return  
 
-    def do_POST(self):
+    def check_fields(self, json_body, fields):
+        """Raises an exception naming the first of fields missing from the json block of a node"""
+        if not isinstance(json_body,dict):
+            raise Exception("expected a json object")
+        for field in fields:
+            if field not in json_body:
+                raise Exception("%s not found in request"%field)
+
+    @tornado.gen.coroutine
+    def register(self, instance_id, json_body):
+        """Register a single node.  Returns the response code, status and results for it."""
+        try:
+            self.check_fields(json_body, ['ek','ekcert','aik'])
+            ek = json_body['ek']
+            ekcert = json_body['ekcert']
+            aik = json_body['aik']
+            
+            blob = yield self.workers.submit(register_instance,self.db.db,instance_id,ek,ekcert,aik)
+            self.db.forget(instance_id)
+            result = (200, "Success", {'blob': blob})
+            logger.info('POST returning key blob for instance_id: ' + instance_id)
+        except WorkerPoolFull as e:
+            result = (503, "Registrar busy: %s"%e, {})
+            logger.warning("POST for %s returning 503 response. Error: %s"%(instance_id,e))
+        except Exception as e:
+            result = (400, "Error: %s"%e, {})
+            logger.warning("POST for " + instance_id + " returning 400 response. Error: %s"%e)
+            logger.warning(traceback.format_exc())
+        raise tornado.gen.Return(result)
+    
+    @tornado.gen.coroutine
+    def activate(self, instance_id, json_body):
+        """Activate the AIK of a single physical node.  Returns the response code and status for it."""
+        try:
+            self.check_fields(json_body, ['auth_tag'])
+            yield self.workers.submit(activate_instance,self.db.db,instance_id,json_body['auth_tag'])
+            self.db.forget(instance_id)
+            result = (200, "Success")
+            logger.info('PUT activated: ' + instance_id)
+        except WorkerPoolFull as e:
+            result = (503, "Registrar busy: %s"%e)
+            logger.warning("PUT for %s returning 503 response. Error: %s"%(instance_id,e))
+        except Exception as e:
+            result = (400, "Error: %s"%e)
+            logger.warning("PUT for " + instance_id + " returning 400 response. Error: %s"%e)
+            logger.warning(traceback.format_exc())
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def post(self):
         """This method handles the POST requests to add instances to the Registrar Server.
         
         Currently, only instances resources are available for POSTing, i.e. /v2/instances. All other POST uri's
         will return errors. POST requests require an an instance_id identifying the instance to add, and json
-        block sent in the body with 2 entries: ek and aik.  
+        block sent in the body with 3 entries: ek, ekcert and aik.  
+        
+        POST requests to /v2/instances without an instance_id register many nodes at once.  The json block
+        maps each instance_id to its ek, ekcert and aik under "instances".  The response holds the code, status
+        and results (including the blob) of each node under "instances".
         """
-        rest_params = common.get_restful_params(self.path)
+        rest_params = common.get_restful_params(self.request.path)
         
         if "instances" not in rest_params:
             common.echo_json_response(self, 400, "uri not supported")
-            logger.warning('POST instance returning 400 response. uri not supported: ' + self.path)
+            logger.warning('POST instance returning 400 response. uri not supported: ' + self.request.path)
             return
         
         instance_id = rest_params["instances"]
         
-        if instance_id is None:
-            common.echo_json_response(self, 400, "instance id not found in uri")
-            logger.warning('POST instance returning 400 response. instance id not found in uri ' + self.path)
+        if len(self.request.body) == 0:
+            common.echo_json_response(self, 400, "Expected non zero content length")
+            logger.warning('POST returning 400 response. Expected non zero content length.')
             return
         
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length == 0:
-                common.echo_json_response(self, 400, "Expected non zero content length")
-                logger.warning('POST for ' + instance_id + ' returning 400 response. Expected non zero content length.')
-                return
-            
-            post_body = self.rfile.read(content_length)
-            json_body = json.loads(post_body)
-            
-            ek = json_body['ek']
-            ekcert = json_body['ekcert']
-            aik = json_body['aik']
-            
-            # config option must be on to check for EK certs
-            if config.getboolean('registrar','require_ek_cert'):
-                # no EK provided
-                if ekcert is None and not common.DEVELOP_IN_ECLIPSE:
-                    raise Exception("No EK cert provided, require_ek_cert option in config set to True")
-                
-                # there is an EK
-                if not common.STUB_TPM and (ekcert!=None and ekcert!='virtual' and not tpm_initialize.verify_ek(base64.b64decode(ekcert), ek)):
-                        raise Exception("Invalid EK certificate")
-            
-            # try to encrypt the AIK
-            (blob,key) = tpm_initialize.encryptAIK(instance_id,aik,ek)
-            d={}
-            d['ek']=ek
-            d['aik']=aik
-            d['ekcert']=ekcert
-            d['virtual']=int(ekcert=='virtual')
-            d['active']=int(False)
-            d['key']=key
-            d['provider_keys']={}
-            
-            self.server.db.add_instance(instance_id, d)
-            response = {
-                    'blob': blob,
-            }
-            common.echo_json_response(self, 200, "Success", response)
-            
-            logger.info('PUT returning key blob for instance_id: ' + instance_id)
-            return
+            json_body = json.loads(self.request.body)
+            if instance_id is None and (not isinstance(json_body,dict) or not isinstance(json_body.get('instances',None),dict)):
+                raise Exception("instances not found in batch request")
         except Exception as e:
             common.echo_json_response(self, 400, "Error: %s"%e)
-            logger.warning("PUT for " + instance_id + " returning 400 response. Error: %s"%e)
-            logger.warning(traceback.format_exc())
+            logger.warning("POST returning 400 response. Error: %s"%e)
             return
-
-
-    def do_PUT(self):
+        
+        if instance_id is not None:
+            code,status,results = yield self.register(instance_id, json_body)
+            if code == 503:
+                self.set_header('Retry-After', '1')
+            common.echo_json_response(self, code, status, results)
+            return
+        
+        # register all nodes in the batch concurrently
+        items = json_body['instances']
+        # ids from the uri are str, keep ids from the batch the same
+        instance_ids = [str(i) for i in items.keys()]
+        outcomes = yield [self.register(i, items[i]) for i in instance_ids]
+        response = {}
+        for i,(code,status,results) in zip(instance_ids,outcomes):
+            response[i] = {'code':code,'status':status,'results':results}
+        common.echo_json_response(self, 200, "Success", {'instances':response})
+        logger.info('POST registered batch of %d instances'%len(instance_ids))
+
+
+    @tornado.gen.coroutine
+    def put(self):
         """This method handles the PUT requests to add instances to the Registrar Server.
         
         Currently, only instances resources are available for PUTing, i.e. /v2/instances. All other PUT uri's
         will return errors.
+        
+        PUT requests to /v2/instances without an instance_id activate many physical nodes at once.  The json 
+        block maps each instance_id to its auth_tag under "instances".  The response holds the code and status
+        of each node under "instances".
         """
-        rest_params = common.get_restful_params(self.path)
+        rest_params = common.get_restful_params(self.request.path)
         
         if "instances" not in rest_params:
             common.echo_json_response(self, 400, "uri not supported")
-            logger.warning('PUT instance returning 400 response. uri not supported: ' + self.path)
+            logger.warning('PUT instance returning 400 response. uri not supported: ' + self.request.path)
             return
         
         instance_id = rest_params["instances"]
         
         if instance_id is None:
-            common.echo_json_response(self, 400, "instance id not found in uri")
-            logger.warning('PUT instance returning 400 response. instance id not found in uri ' + self.path)
+            yield self.put_batch()
             return
 
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length == 0:
+            if len(self.request.body) == 0:
                 common.echo_json_response(self, 400, "Expected non zero content length")
                 logger.warning('PUT for ' + instance_id + ' returning 400 response. Expected non zero content length.')
                 return 
         
-            post_body = self.rfile.read(content_length)
-            json_body = json.loads(post_body)
+            json_body = json.loads(self.request.body)
             
             if "activate" in rest_params:
-                auth_tag=json_body['auth_tag']
-                
-                instance = self.server.db.get_instance(instance_id)
-                if instance is None:
-                    raise Exception("attempting to activate instance before requesting registrar for %s"%instance_id)
-         
-                if instance['virtual']:
-                    raise Exception("attempting to activate virtual AIK using physical interface for %s"%instance_id)
-                
-                if common.STUB_TPM:
-                    self.server.db.update_instance(instance_id, 'active',True)
-                else:
-                    ex_mac = crypto.do_hmac(base64.b64decode(instance['key']),instance_id)
-                    if ex_mac == auth_tag:
-                        self.server.db.update_instance(instance_id, 'active',True)
-                    else:
-                        raise Exception("Auth tag %s does not match expected value %s"%(auth_tag,ex_mac))
-                
-                common.echo_json_response(self, 200, "Success")
-                logger.info('PUT activated: ' + instance_id)      
+                code,status = yield self.activate(instance_id, json_body)
+                if code == 503:
+                    self.set_header('Retry-After', '1')
+                common.echo_json_response(self, code, status)
             elif "vactivate" in rest_params:
                 deepquote = json_body.get('deepquote',None)
-
-                instance = self.server.db.get_instance(instance_id)
-                if instance is None:
-                    raise Exception("attempting to activate instance before requesting registrar for %s"%instance_id)
-                      
-                if not instance['virtual']:
-                    raise Exception("attempting to activate physical AIK using virtual interface for %s"%instance_id)
-                
-                # get an physical AIK for this host
-                registrar_client.init_client_tls(config, 'registrar')
-                provider_keys = registrar_client.getKeys(config.get('general', 'provider_registrar_ip'), config.get('general', 'provider_registrar_tls_port'), instance_id)
-                # we already have the vaik
-                if not tpm_quote.check_deep_quote(hashlib.sha1(instance['key']),
-                                                  instance_id+instance['aik']+instance['ek'], 
-                                                  deepquote,  
-                                                  instance['aik'],  
-                                                  provider_keys['aik']):
-                    raise Exception("Deep quote invalid")
-                
-                self.server.db.update_instance(instance_id, 'active',True)
-                self.server.db.update_instance(instance_id, 'provider_keys',provider_keys)
+                yield self.workers.submit(vactivate_instance,self.db.db,instance_id,deepquote)
+                self.db.forget(instance_id)
                 
                 common.echo_json_response(self, 200, "Success")
                 logger.info('PUT activated: ' + instance_id)           
             else:
                 pass           
+        except WorkerPoolFull as e:
+            self.busy(instance_id, e)
+            return
         except Exception as e:
             common.echo_json_response(self, 400, "Error: %s"%e)
             logger.warning("PUT for " + instance_id + " returning 400 response. Error: %s"%e)
             logger.warning(traceback.format_exc())
             return
+
+    @tornado.gen.coroutine
+    def put_batch(self):
+        """Activate the AIKs of all of the physical nodes in a batch PUT, reporting the outcome of each node"""
+        if len(self.request.body) == 0:
+            common.echo_json_response(self, 400, "Expected non zero content length")
+            logger.warning('PUT batch returning 400 response. Expected non zero content length.')
+            return
+        
+        try:
+            json_body = json.loads(self.request.body)
+            if not isinstance(json_body,dict) or not isinstance(json_body.get('instances',None),dict):
+                raise Exception("instances not found in batch request")
+        except Exception as e:
+            common.echo_json_response(self, 400, "Error: %s"%e)
+            logger.warning("PUT batch returning 400 response. Error: %s"%e)
+            return
+        
+        # activate all nodes in the batch concurrently
+        items = json_body['instances']
+        instance_ids = items.keys()
+        outcomes = yield [self.activate(str(i), items[i]) for i in instance_ids]
+        response = {}
+        for i,(code,status) in zip(instance_ids,outcomes):
+            response[i] = {'code':code,'status':status,'results':{}}
+        common.echo_json_response(self, 200, "Success", {'instances':response})
+        logger.info('PUT activated batch of %d instances'%len(items))
             
 
-    def do_DELETE(self):
+    def delete(self):
         """DELETE not supported"""   
         common.echo_json_response(self, 405, "DELETE not supported")
         return  
-                           
-    def log_message(self, logformat, *args):
-        return  
-
-#consider using PooledProcessMixIn
-# https://github.com/muayyad-alsadi/python-PooledProcessMixIn
-class ProtectedRegistrarServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
-    
-    db = None
-    
-    def __init__(self, server_address, db,RequestHandlerClass):
-        """Constructor overridden to provide ability to read file"""
-        self.db = db
-        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
-
-    def shutdown(self):
-        BaseHTTPServer.HTTPServer.shutdown(self)
-        
-class UnprotectedRegistrarServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
-    
-    db = None
-    
-    def __init__(self, server_address,db,RequestHandlerClass):
-        """Constructor overridden to provide ability to read file"""
-        self.db = db
-        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
-
-    def shutdown(self):
-        BaseHTTPServer.HTTPServer.shutdown(self)
 
 def init_db(dbname):
     # in the form key, SQL type
@@ -377,68 +704,108 @@ def init_db(dbname):
     # in the form key : default value
     exclude_db = {}
     
-    return keylime_sqlite.KeylimeDB(dbname,cols_db,json_cols_db,exclude_db)
+    return keylime_db.open_db(dbname,cols_db,json_cols_db,exclude_db,config,'registrar')
 
-def do_shutdown(servers):
-        for server in servers:
-            server.shutdown()
+@tornado.gen.coroutine
+def rebalance(db,workers,ring,shard):
+    """Hand off the records of all instances owned by other shards of the registrar cluster to their owners.
+    
+    This runs once when the registrar starts.  The ring is read from registrar_shards at startup and does 
+    not change while the registrar runs, so after the shards change every shard has to be restarted.
+    """
+    registrar_client.init_client_tls(config, 'registrar')
+    moved = 0
+    for instance_id in db.get_instance_ids():
+        owner = ring.owner(instance_id)
+        if owner == shard:
+            continue
+        record = db.get_instance(instance_id)
+        if record is None:
+            continue
+        while True:
+            try:
+                transferred = yield workers.submit(registrar_client.doTransferInstance,owner[0],owner[2],instance_id,record)
+                break
+            except WorkerPoolFull:
+                # registrations come first, try again once the pool has room
+                yield tornado.gen.sleep(1)
+            except Exception as e:
+                logger.warning("Unable to hand off instance_id %s to shard %s: %s"%(instance_id,":".join(owner),e))
+                transferred = False
+                break
+        if transferred:
+            db.remove_instance(instance_id)
+            moved+=1
+    logger.info("Handed off %d instances to other registrar shards"%moved)
 
 def start(tlsport,port,dbfile):
     """Main method of the Registrar Server.  This method is encapsulated in a function for packaging to allow it to be 
     called as a function by an external program."""
     
-    threads = []
-    servers = []    
-    serveraddr = ('', tlsport)
-    
-    
-    db = init_db("%s/%s"%(common.WORK_DIR,dbfile))
+    db = RegistrarCache(init_db("%s/%s"%(common.WORK_DIR,dbfile)),config.getint('registrar','cache_size'))
     count = db.count_instances()
     if count>0:
         logger.info("Loaded %d public keys from database"%count)
     
-    server = ProtectedRegistrarServer(serveraddr, db, ProtectedHandler)    
+    # parse the trusted EK signers before the first registration
+    if config.getboolean('registrar','require_ek_cert') and not common.STUB_TPM:
+        tpm_initialize.get_ek_trust_store()
+    
+    workers = WorkerPool(config.getint('registrar','worker_threads'),config.getint('registrar','max_queued_requests'))
+    
     context = cloud_verifier_common.init_mtls(config,
                                              section='registrar',
                                              generatedir='reg_ca')
-    if context is not None:
-        server.socket = context.wrap_socket (server.socket, server_side=True)
-    thread = threading.Thread(target=server.serve_forever)
-    threads.append(thread)
+    # the entry of this registrar in the registrar cluster, if there is one
+    shard = None
+    shard_subjects = [subject.strip() for subject in config.get('registrar','shard_subjects').split(',') if subject.strip()!=""]
+    ring = registrar_client.get_ring(config)
+    if config.get('registrar','shard').strip()!="":
+        shard = registrar_client.parse_shard(config.get('registrar','shard'))
+        if ring is None or shard not in ring.shards:
+            raise Exception("shard %s is not listed in registrar_shards"%config.get('registrar','shard'))
+    
+    protected_app = tornado.web.Application([
+        (r"/v2/instances/.*", ProtectedHandler, {'db':db,'workers':workers,'shard':shard,'shard_subjects':shard_subjects}),
+        ])
+    server = tornado.httpserver.HTTPServer(protected_app,ssl_options=context)
+    server.listen(tlsport)
     
     # start up the unprotected registrar server
-    serveraddr2 = ('',port)
-    server2 = UnprotectedRegistrarServer(serveraddr2,db,UnprotectedHandler)
-    thread2 = threading.Thread(target=server2.serve_forever)
-    threads.append(thread2)
-
-    servers.append(server)
-    servers.append(server2)
+    unprotected_app = tornado.web.Application([
+        (r"/v2/instances/.*", UnprotectedHandler, {'db':db,'workers':workers}),
+        ])
+    server2 = tornado.httpserver.HTTPServer(unprotected_app)
+    server2.listen(port)
     
     logger.info('Starting Cloud Registrar Server on ports %s and %s (TLS) use <Ctrl-C> to stop'%(port,tlsport))
     logger.info('Require EK certificates: %s'%config.getboolean('registrar','require_ek_cert'))
-    for thread in threads:
-        thread.start()
+    
+    ioloop = tornado.ioloop.IOLoop.current()
+    if shard is not None:
+        ioloop.add_callback(rebalance,db,workers,ring,shard)
+    def log_metrics():
+        workers.log_metrics()
+        if context is not None:
+            logger.info("TLS handshake metrics: %s"%json.dumps({'server':common.tls_session_stats(context),
+                                                                 'client':common.tls_session_stats(registrar_client.context)},sort_keys=True))
+    
+    metrics_interval = config.getfloat('registrar','worker_metrics_interval')
+    if metrics_interval>0:
+        tornado.ioloop.PeriodicCallback(log_metrics, metrics_interval*1000).start()
     
     def signal_handler(signal, frame):
-        do_shutdown(servers)
-        sys.exit(0)   
+        ioloop.add_callback_from_signal(ioloop.stop)
 
     # Catch these signals.  Note that a SIGKILL cannot be caught, so
     # killing this process with "kill -9" may result in improper shutdown 
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGQUIT, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
-
-
-    # keep the main thread active, so it can process the signals and gracefully shutdown    
-    while True:
-        if not any([thread.isAlive() for thread in threads]):
-            # All threads have stopped
-            break
-        else:
-            # Some threads are still going
-            time.sleep(1)
-
-    for thread in threads:
-        thread.join()
+    
+    try:
+        ioloop.start()
+    finally:
+        server.stop()
+        server2.stop()
+        workers.shutdown()
@@ -30,7 +30,7 @@ function asyncRequest(type, uuid, body, callback) {
     let xmlHttp = new XMLHttpRequest();
     if (typeof(callback) === 'function') {
         xmlHttp.onreadystatechange = function() {
-            if (xmlHttp.readyState == 4 && xmlHttp.status == 200) {
+            if (xmlHttp.readyState == 4 && (xmlHttp.status == 200 || xmlHttp.status == 202)) {
                 callback(xmlHttp.responseText);
             }
             else if (xmlHttp.readyState == 4 && xmlHttp.status == 500) {
@@ -49,6 +49,33 @@ function asyncRequest(type, uuid, body, callback) {
 // Default/generic async request callback
 function defaultReqCallback(responseText) {}
 
+// Callback for node adds, which run in the background as jobs 
+function addNodeCallback(responseText) {
+    let json = JSON.parse(responseText);
+    if ("results" in json && "job" in json["results"]) {
+        followJob(json["results"]["job"]);
+    }
+}
+
+// Check on a node add job until it finishes, report if it failed 
+function followJob(jobId) {
+    let xmlHttp = new XMLHttpRequest();
+    xmlHttp.onreadystatechange = function() {
+        if (xmlHttp.readyState != 4 || xmlHttp.status != 200) {
+            return;
+        }
+        let job = JSON.parse(xmlHttp.responseText)["results"];
+        if (job["state"] == "failed") {
+            alert("ERROR: adding node " + job["node_id"] + " failed: " + job["error"]);
+        }
+        else if (job["state"] != "done") {
+            setTimeout(function() {followJob(jobId);}, 1000);
+        }
+    }
+    xmlHttp.open("GET", "/v2/jobs/"+jobId, true);
+    xmlHttp.send();
+}
+
 // Callback for node data requests 
 let style_mappings = {
     0 : {"class":"inactive","action":"POST"},
@@ -61,6 +88,7 @@ let style_mappings = {
     7 : {"class":"failed","action":"POST"},
     8 : {"class":"inactive","action":"PUT"},
     9 : {"class":"invalid","action":"DELETE"},
+    "-1" : {"class":"inactive","action":"DELETE"},
 }
 let STR_MAPPINGS = {
     0 : "Registered",
@@ -72,7 +100,8 @@ let STR_MAPPINGS = {
     6 : "Provide V (retry)",
     7 : "Failed",
     8 : "Terminated",
-    9 : "Invalid Quote"
+    9 : "Invalid Quote",
+    "-1" : "Unknown"
 }
 function nodeDataCallback(responseText) {
     let json = JSON.parse(responseText);
@@ -174,7 +203,7 @@ function submitAddNodeForm(form) {
     
     // Build POST string and send request (generic/default response handler) 
     let data = new FormData(form);
-    asyncRequest("POST", form.uuid.value, data, defaultReqCallback);
+    asyncRequest("POST", form.uuid.value, data, addNodeCallback);
     
     // Cleanup 
     toggleVisibility('modal_box');
@@ -324,10 +353,43 @@ window.onload = function(e) {
         droppable[i].addEventListener('drop', fileUploadCallback, false);
     }
     
-    // Auto-update node data functionality
-    let nodes = document.getElementById("node_container").children;
-    for (let i = 0; i < nodes.length; i++) {
-        setInterval(function() {asyncRequest("GET", nodes[i].id, undefined, nodeDataCallback);}, 1000);
+    // Auto-update node list and node data functionality
+    refreshNodeList();
+    setInterval(refreshNodeList, 5000);
+}
+
+// Add newly registered nodes to the GUI and start updating their data 
+let nodeTimers = {};
+function refreshNodeList() {
+    let xmlHttp = new XMLHttpRequest();
+    xmlHttp.onreadystatechange = function() {
+        if (xmlHttp.readyState != 4 || xmlHttp.status != 200) {
+            return;
+        }
+        let uuids = JSON.parse(xmlHttp.responseText)["results"]["uuids"];
+        let container = document.getElementById("node_container");
+        if (uuids.length == 0 && Object.keys(nodeTimers).length == 0) {
+            container.innerHTML = "<div style='color:#888;margin-left:15px;padding:10px;'><i>No nodes registered</i></div>";
+            return;
+        }
+        for (let i = 0; i < uuids.length; i++) {
+            let uuid = uuids[i];
+            if (uuid in nodeTimers) {
+                continue;
+            }
+            if (Object.keys(nodeTimers).length == 0) {
+                container.innerHTML = "";
+            }
+            let node = document.createElement("div");
+            node.id = uuid;
+            node.innerHTML = "<div id='" + uuid + "-over' style='display:block;cursor:help;width:800px;'></div>"
+                    + "<div id='" + uuid + "-det' style='display:none;'></div>";
+            container.appendChild(node);
+            asyncRequest("GET", uuid, undefined, nodeDataCallback);
+            nodeTimers[uuid] = setInterval(function() {asyncRequest("GET", uuid, undefined, nodeDataCallback);}, 1000);
+        }
     }
+    xmlHttp.open("GET", "/v2/nodes/", true);
+    xmlHttp.send();
 }
 
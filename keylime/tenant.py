@@ -45,6 +45,9 @@ import StringIO
 import tpm_exec
 import logging
 import subprocess
+import threading
+import csv
+from concurrent.futures import ThreadPoolExecutor
 
 #setup logging
 logger = common.init_logging('tenant')
@@ -53,6 +56,17 @@ logger = common.init_logging('tenant')
 config = ConfigParser.RawConfigParser()
 config.read(common.CONFIG_FILE)
 
+# guards the IMA whitelists shared by the nodes of a bulk run
+whitelist_cache_lock = threading.Lock()
+
+# ca_util is not safe to use from several threads at once
+ca_lock = threading.Lock()
+
+# client TLS context shared by every Tenant in the process, so that connections and TLS 
+# sessions to the verifier and registrar are reused
+tls_context = None
+tls_context_lock = threading.Lock()
+
 class Tenant():
     """Simple command processor example."""
     
@@ -88,7 +102,7 @@ class Tenant():
     
     context = None
     
-    def __init__(self):
+    def __init__(self,context=None):
         self.cloudverifier_port = config.get('general', 'cloudverifier_port')
         self.cloudnode_port = config.get('general', 'cloudnode_port')
         self.registrar_port = config.get('general', 'registrar_tls_port')
@@ -98,13 +112,22 @@ class Tenant():
         self.registrar_ip = config.get('general', 'registrar_ip')
         self.webapp_ip = config.get('general', 'webapp_ip')
         
-        if config.getboolean('general',"enable_tls"):
-            self.context = self.get_tls_context()
+        if context is not None:
+            self.context = context
+        elif config.getboolean('general',"enable_tls"):
+            self.context = self.get_shared_tls_context()
         else:
             logger.warning("TLS is currently disabled, keys will be sent in the clear! Should only be used for testing")
             self.context = None
             
     
+    def get_shared_tls_context(self):
+        global tls_context
+        with tls_context_lock:
+            if tls_context is None:
+                tls_context = self.get_tls_context()
+            return tls_context
+    
     def get_tls_context(self):
         ca_cert = config.get('tenant', 'ca_cert')
         my_cert = config.get('tenant', 'my_cert')
@@ -139,7 +162,12 @@ class Tenant():
         context.check_hostname = config.getboolean('general','tls_check_hostnames')
         return context
     
-    def init_add(self, args):
+    def init_add(self, args, whitelist_cache=None):
+        """Prepare the keys, payload and policies for adding a node.
+        
+        IMA whitelists read from files are stored in and taken from whitelist_cache if one is given,
+        so that nodes added together share them.
+        """
         # command line options can overwrite config values
         if "node_ip" in args:
             self.cloudnode_ip = args["node_ip"]
@@ -179,7 +207,18 @@ class Tenant():
             
             # Auto-enable IMA (or-bit mask)
             self.tpm_policy['mask'] = "0x%X"%(int(self.tpm_policy['mask'],0) + (1 << common.IMA_PCR))
-            
+        
+        # whitelists from files are read and processed once per bulk run
+        cache_key = None
+        cached = None
+        if whitelist_cache is not None and \
+                type(args.get("ima_whitelist",None)) in [str,unicode,type(None)] and \
+                type(args.get("ima_exclude",None)) in [str,unicode,type(None)]:
+            cache_key = (args.get("ima_whitelist",None),args.get("ima_exclude",None))
+            with whitelist_cache_lock:
+                cached = whitelist_cache.get(cache_key,None)
+        
+        if cached is None and "ima_whitelist" in args and args["ima_whitelist"] is not None:
             if type(args["ima_whitelist"]) in [str,unicode]:
                 if args["ima_whitelist"] == "default":
                     args["ima_whitelist"] = config.get('tenant', 'ima_whitelist')
@@ -192,7 +231,7 @@ class Tenant():
         
         # Read command-line path string IMA exclude list 
         excl_data = None
-        if "ima_exclude" in args and args["ima_exclude"] is not None:
+        if cached is None and "ima_exclude" in args and args["ima_exclude"] is not None:
             if type(args["ima_exclude"]) in [str,unicode]:
                 if args["ima_exclude"] == "default":
                     args["ima_exclude"] = config.get('tenant', 'ima_excludelist')
@@ -208,7 +247,12 @@ class Tenant():
             tpm_quote.check_mask(self.vtpm_policy['mask'],common.IMA_PCR):
             
             # Process IMA whitelists 
-            self.ima_whitelist = ima.process_whitelists(wl_data,excl_data)
+            if cached is None:
+                cached = ima.process_whitelists(wl_data,excl_data)
+                if cache_key is not None:
+                    with whitelist_cache_lock:
+                        whitelist_cache[cache_key] = cached
+            self.ima_whitelist = cached
             
         
         # if none
@@ -284,23 +328,24 @@ class Tenant():
             if args["ca_dir"]=='default':
                 args["ca_dir"] = common.CA_WORK_DIR
             
-            if "ca_dir_pw" in args and args["ca_dir_pw"] is not None:
-                ca_util.setpassword(args["ca_dir_pw"])
-            
-            if not os.path.exists(args["ca_dir"]):
-                logger.warning(" CA directory does not exist.  Creating...")
-                ca_util.cmd_init(args["ca_dir"])
-            
-            
-            if not os.path.exists("%s/%s-private.pem"%(args["ca_dir"],self.node_uuid)):
-                ca_util.cmd_mkcert(args["ca_dir"],self.node_uuid)
+            with ca_lock:
+                if "ca_dir_pw" in args and args["ca_dir_pw"] is not None:
+                    ca_util.setpassword(args["ca_dir_pw"])
                 
-            cert_pkg,serial = ca_util.cmd_certpkg(args["ca_dir"],self.node_uuid)
-            
-            # support revocation
-            if not os.path.exists("%s/RevocationNotifier-private.pem"%args["ca_dir"]):
-                ca_util.cmd_mkcert(args["ca_dir"],"RevocationNotifier")
-            rev_package,_ = ca_util.cmd_certpkg(args["ca_dir"],"RevocationNotifier")
+                if not os.path.exists(args["ca_dir"]):
+                    logger.warning(" CA directory does not exist.  Creating...")
+                    ca_util.cmd_init(args["ca_dir"])
+                
+                
+                if not os.path.exists("%s/%s-private.pem"%(args["ca_dir"],self.node_uuid)):
+                    ca_util.cmd_mkcert(args["ca_dir"],self.node_uuid)
+                    
+                cert_pkg,serial = ca_util.cmd_certpkg(args["ca_dir"],self.node_uuid)
+                
+                # support revocation
+                if not os.path.exists("%s/RevocationNotifier-private.pem"%args["ca_dir"]):
+                    ca_util.cmd_mkcert(args["ca_dir"],"RevocationNotifier")
+                rev_package,_ = ca_util.cmd_certpkg(args["ca_dir"],"RevocationNotifier")
             
             # extract public and private keys from package
             sf = cStringIO.StringIO(rev_package)
@@ -354,14 +399,14 @@ class Tenant():
             logger.debug("U:" + base64.b64encode(str(self.U)))
             logger.debug("Auth Tag: " + self.auth_tag)
 
-    def validate_tpm_quote(self,public_key, quote):
+    def validate_tpm_quote(self,public_key, quote, merkle_proof=None):
         registrar_client.init_client_tls(config,'tenant')
-        reg_keys = registrar_client.getKeys(self.cloudverifier_ip,self.registrar_port,self.node_uuid)
+        reg_keys = registrar_client.getRoutedKeys(config,self.node_uuid,self.cloudverifier_ip,self.registrar_port)
         if reg_keys is None:
             logger.warning("AIK not found in registrar, quote not validated")
             return False
         
-        if not tpm_quote.check_quote(self.nonce,public_key,quote,reg_keys['aik']):
+        if not tpm_quote.check_quote(self.nonce,public_key,quote,reg_keys['aik'],merkle_proof=merkle_proof):
             return False
         
         # check ek with optional script:
@@ -393,6 +438,21 @@ class Tenant():
         
         return True
 
+    def request_cv(self,method,url,data=None):
+        """Send a request to the Cloud Verifier, waiting and trying again while it is rate limited"""
+        numtries = 0
+        while True:
+            response = tornado_requests.request(method,url,data=data,context=self.context)
+            if response.status_code != 429:
+                return response
+            numtries+=1
+            maxr = config.getint('tenant','max_retries')
+            if numtries >= maxr:
+                return response
+            retry = config.getfloat('tenant','retry_interval')
+            logger.info("Cloud Verifier busy %d/%d times, trying again in %f seconds..."%(numtries,maxr,retry))
+            time.sleep(retry)
+
     def do_cv(self):
         """initiaite v, instance_id and ip
         initiate the cloudinit sequence"""
@@ -410,7 +470,7 @@ class Tenant():
         }
         
         json_message = json.dumps(data)
-        response = tornado_requests.request("POST","http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,self.node_uuid),data=json_message,context=self.context)
+        response = self.request_cv("POST","http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,self.node_uuid),data=json_message)
         if response.status_code == 409:
             # this is a conflict, delete first then re-add
             logger.warning("Node already existed at CV.  Deleting and re-adding...")
@@ -428,33 +488,39 @@ class Tenant():
         if not listing:
             node_uuid=self.node_uuid
 
-        response = tornado_requests.request("GET", "http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,node_uuid),context=self.context)
+        response = self.request_cv("GET", "http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,node_uuid))
         if response.status_code != 200:
             logger.error("Status command response: %d Unexpected response from Cloud Verifier."%response.status_code)
             common.log_http_response(logger,logging.ERROR,response.json())
+            return None
         else:
             logger.info("Node Status %d: %s"%(response.status_code,response.json()))
+            return response.json().get('results',None)
 
     def do_cvdelete(self):
         """initiaite v, instance_id and ip
         initiate the cloudinit sequence"""
         
-        response = tornado_requests.request("DELETE","http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,self.node_uuid),context=self.context)
+        response = self.request_cv("DELETE","http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,self.node_uuid))
         if response.status_code != 200:
             logger.error("Delete command response: %d Unexpected response from Cloud Verifier."%response.status_code)
             common.log_http_response(logger,logging.ERROR,response.json())
+            return False
         else:
             logger.info("Node %s deleted from CV"%(self.node_uuid))
+            return True
             
     def do_cvreactivate(self):
         """initiaite v, instance_id and ip
         initiate the cloudinit sequence"""
-        response = tornado_requests.request("PUT","http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,self.node_uuid),context=self.context,data=b'')
+        response = self.request_cv("PUT","http://%s:%s/v2/instances/%s"%(self.cloudverifier_ip,self.cloudverifier_port,self.node_uuid),data=b'')
         if response.status_code != 200:
             logger.error("Update command response: %d Unexpected response from Cloud Verifier."%response.status_code)
             common.log_http_response(logger,logging.ERROR,response.json())
+            return False
         else:
             logger.info("Node %s re-activated"%(self.node_uuid))
+            return True
         
     def do_quote(self):
         """initiaite v, instance_id and ip
@@ -466,7 +532,7 @@ class Tenant():
             # Get quote 
             try:
                 response = tornado_requests.request("GET",
-                                            "http://%s:%s/v2/quotes/identity/nonce/%s/"%(self.cloudnode_ip,self.cloudnode_port,self.nonce))
+                                            "http://%s:%s/v2/quotes/identity/nonce/%s/batch/1/"%(self.cloudnode_ip,self.cloudnode_port,self.nonce))
             except Exception as e:
                 # this is one exception that should return a 'keep going' response
                 if tornado_requests.is_refused(e):
@@ -485,13 +551,13 @@ class Tenant():
             
             if response.status_code != 200:
                 logger.error("Status command response: %d Unexpected response from Cloud Node."%response.status_code)
-                break
+                return False
             
             response_body = response.json()
             
             if "results" not in response_body:
                 logger.critical("Error: unexpected http response body from Cloud Node: %s"%str(response.status_code))
-                break
+                return False
             
             quote = response_body["results"]["quote"]
             logger.debug("cnquote received quote:" + quote)
@@ -499,9 +565,9 @@ class Tenant():
             public_key = response_body["results"]["pubkey"]
             logger.debug("cnquote received public key:" + public_key)
             
-            if not self.validate_tpm_quote(public_key, quote):
+            if not self.validate_tpm_quote(public_key, quote, response_body["results"].get("merkle_proof",None)):
                 logger.error("TPM Quote from cloud node is invalid for nonce: %s"%self.nonce)
-                break
+                return False
         
             logger.info("Quote from %s validated"%self.cloudnode_ip)
 
@@ -526,9 +592,9 @@ class Tenant():
             if response.status_code != 200:
                 logger.error("Posting of Encrypted U to the Cloud Node failed with response code %d" %response.status_code)
                 common.log_http_response(logger,logging.ERROR,response_body)
-                break
+                return False
             
-            break
+            return True
        
     def do_verify(self):
         """initiaite v, instance_id and ip
@@ -572,6 +638,98 @@ class Tenant():
                 break
             break;
 
+BULK_COMMANDS = ['add','delete','status','reactivate']
+
+# options of the add command a node in a manifest may set for itself
+NODE_OPTIONS = ['file','keyfile','payload','ca_dir','incl_dir','ima_whitelist','ima_exclude','tpm_policy','vtpm_policy']
+
+def read_manifest(path):
+    """Read the nodes of a bulk run from a JSON or CSV manifest.
+    
+    A JSON manifest is a list of objects, or an object with the list under "nodes".  A CSV manifest
+    has a header row.  Every node needs a uuid and may have an ip, a verifier_ip and any of 
+    NODE_OPTIONS, which override the command line for that node.
+    """
+    with open(path,'r') as f:
+        if path.endswith('.csv'):
+            nodes = [dict((k.strip(),v.strip()) for k,v in row.items() if v is not None and v.strip()!="") for row in csv.DictReader(f)]
+        else:
+            nodes = json.load(f)
+            if isinstance(nodes,dict):
+                nodes = nodes.get('nodes',[])
+    for node in nodes:
+        if 'uuid' not in node:
+            raise Exception("Every node in manifest %s needs a uuid"%path)
+        # policies may be given as json objects instead of strings
+        for key in ['tpm_policy','vtpm_policy']:
+            if isinstance(node.get(key,None),dict):
+                node[key] = json.dumps(node[key])
+    return nodes
+
+def run_command(mytenant,command,args,whitelist_cache=None):
+    """Run a command for the node of mytenant.  Returns whether it succeeded, or the status for status"""
+    if command=='add':
+        mytenant.init_add(args,whitelist_cache)
+        mytenant.preloop()
+        mytenant.do_cv()
+        return mytenant.do_quote()
+    elif command=='delete':
+        return mytenant.do_cvdelete()
+    elif command=='status':
+        return mytenant.do_cvstatus()
+    elif command=='reactivate':
+        return mytenant.do_cvreactivate()
+    else:
+        raise Exception("Invalid command specified %s"%(command))
+
+def run_bulk(command,manifest,args,workers):
+    """Run a command for every node in a manifest, at most workers nodes at a time.
+    
+    The TLS context and IMA whitelists are set up once and shared by all nodes.  Returns the 
+    outcome of each node: its uuid, whether it succeeded, the error if any, the status for 
+    status, and how long it took in seconds.
+    """
+    if command not in BULK_COMMANDS:
+        raise Exception("Command %s can not be used with a manifest, valid commands are %s"%(command,", ".join(BULK_COMMANDS)))
+    nodes = read_manifest(manifest)
+    template = Tenant()
+    if args.get('verifier_ip',None) is not None:
+        template.cloudverifier_ip = args['verifier_ip']
+    whitelist_cache = {}
+    
+    def run_node(node):
+        started = time.time()
+        outcome = {'uuid':node['uuid']}
+        try:
+            mytenant = Tenant(context=template.context)
+            mytenant.node_uuid = str(node['uuid'])
+            mytenant.cloudverifier_ip = node.get('verifier_ip',template.cloudverifier_ip)
+            node_args = dict(args)
+            for key in NODE_OPTIONS:
+                if key in node:
+                    node_args[key] = node[key]
+            node_args['node_ip'] = node.get('ip',args.get('node_ip',None))
+            result = run_command(mytenant,command,node_args,whitelist_cache)
+            outcome['success'] = result is not None and result is not False
+            if command=='status' and result is not None:
+                outcome['status'] = result
+        except Exception as e:
+            logger.error("%s of node %s failed: %s"%(command,node['uuid'],e))
+            outcome['success'] = False
+            outcome['error'] = str(e)
+        outcome['time'] = time.time()-started
+        return outcome
+    
+    started = time.time()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        outcomes = list(pool.map(run_node,nodes))
+    finally:
+        pool.shutdown()
+    failed = len([o for o in outcomes if not o['success']])
+    logger.info("Bulk %s of %d nodes finished in %f seconds, %d failed"%(command,len(nodes),time.time()-started,failed))
+    return outcomes
+
 def main(argv=sys.argv):    
     parser = argparse.ArgumentParser(argv[0])
     parser.add_argument('-c', '---command',action='store',dest='command',default='add',help="valid commands are add,delete,status,reactivate. defaults to add")
@@ -587,6 +745,9 @@ def main(argv=sys.argv):
     parser.add_argument('--exclude',action='store',dest='ima_exclude',default=None,help="Specify the location of an IMA exclude list")
     parser.add_argument('--tpm_policy',action='store',dest='tpm_policy',default=None,help="Specify a TPM policy in JSON format. e.g., {\"15\":\"0000000000000000000000000000000000000000\"}")
     parser.add_argument('--vtpm_policy',action='store',dest='vtpm_policy',default=None,help="Specify a vTPM policy in JSON format")
+    parser.add_argument('--manifest',action='store',dest='manifest',default=None,help="Run the command for every node in a JSON or CSV manifest of node uuids, ips and options. Other options apply to every node that doesn't set its own")
+    parser.add_argument('--workers',action='store',dest='workers',type=int,default=config.getint('tenant','bulk_workers'),help="Number of nodes from a manifest to work on at once")
+    parser.add_argument('--report',action='store',dest='report',default=None,help="Write the outcome of every node in a manifest to this file as JSON")
 
     if common.DEVELOP_IN_ECLIPSE:
         ca_util.setpassword('default')
@@ -601,6 +762,22 @@ def main(argv=sys.argv):
 
     args = parser.parse_args(tmp)
     
+    if args.manifest is not None:
+        try:
+            outcomes = run_bulk(args.command,args.manifest,vars(args),args.workers)
+        except Exception as e:
+            logger.error("Error: %s "%str(e))
+            sys.exit(2)
+        if args.report is not None:
+            with open(args.report,'w') as f:
+                json.dump(outcomes,f,indent=2)
+        else:
+            for outcome in outcomes:
+                logger.info("Node %s: %s"%(outcome['uuid'],json.dumps(outcome)))
+        if len([o for o in outcomes if not o['success']])>0:
+            sys.exit(1)
+        return
+    
     mytenant = Tenant()
     
     if args.command != 'list' and args.node_ip is None:
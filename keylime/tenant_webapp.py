@@ -26,8 +26,16 @@ import json
 import ConfigParser
 import traceback
 import sys
+import time
+import logging
 import tornado.ioloop
 import tornado.web
+import tornado.gen
+import tornado.template
+import mimetypes
+import hashlib
+import gzip
+import cStringIO
 import tornado_requests
 import functools
 from tornado import httpserver
@@ -38,6 +46,9 @@ import cloud_verifier_common
 import tenant
 import base64
 import common
+import keylime_db
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 logger = common.init_logging('tenant_webapp')
 
@@ -46,6 +57,246 @@ config.read(common.CONFIG_FILE)
 
 tenant_templ = tenant.Tenant()
 
+# operational state reported for nodes whose status could not be retrieved yet
+UNKNOWN_STATE = -1
+
+# the order in which nodes are listed by operational state
+PRINT_ORDER = [9,7,3,4,5,6,2,1,8,0,UNKNOWN_STATE]
+
+# seconds to wait before following the verifier's status change feed again after an error
+FEED_RETRY_INTERVAL = 5
+
+# how much longer than the verifier's event_wait to wait for an answer from the feed
+FEED_TIMEOUT_MARGIN = 10
+
+# how long in seconds the status of a node add job is kept
+JOB_RETENTION = 3600
+
+@tornado.gen.coroutine
+def get_retrying(url):
+    """GET a url on the IOLoop, waiting as long as the server asks in Retry-After and trying again while it is rate limited"""
+    numtries = 0
+    while True:
+        response = yield tornado_requests.request_async("GET",url,context=tenant_templ.context)
+        if response.status_code != 429:
+            raise tornado.gen.Return(response)
+        numtries+=1
+        maxr = config.getint('tenant','max_retries')
+        if numtries >= maxr:
+            raise tornado.gen.Return(response)
+        try:
+            retry = float(response.headers.get('Retry-After'))
+        except (TypeError,ValueError):
+            retry = config.getfloat('tenant','retry_interval')
+        logger.info("%s busy %d/%d times, trying again in %f seconds..."%(url,numtries,maxr,retry))
+        yield tornado.gen.sleep(retry)
+
+@tornado.gen.coroutine
+def get_instance_ids():
+    """Returns the ids of all nodes known to the registrar"""
+    response = yield get_retrying("http://%s:%s/v2/instances/"%(tenant_templ.registrar_ip,tenant_templ.registrar_port))
+    response_body = response.json()
+    
+    if response.status_code != 200:
+        logger.error("Status command response: %d Unexpected response from Registrar."%response.status_code)
+        common.log_http_response(logger,logging.ERROR,response_body)
+        raise tornado.gen.Return(None)
+    
+    if ("results" not in response_body) or ("uuids" not in response_body["results"]):
+        logger.critical("Error: unexpected http response body from Registrar: %s"%str(response.status_code))
+        raise tornado.gen.Return(None)
+    
+    raise tornado.gen.Return(response_body["results"]["uuids"])
+
+@tornado.gen.coroutine
+def get_instance_state(instance_id):
+    """Returns the status of a node from the Cloud Verifier, or None if it could not be retrieved"""
+    try:
+        response = yield get_retrying("http://%s:%s/v2/instances/%s"%(tenant_templ.cloudverifier_ip,tenant_templ.cloudverifier_port,instance_id))
+    except Exception as e:
+        logger.error("Status command response: %s:%s Unexpected response from Cloud Verifier."%(tenant_templ.cloudverifier_ip,tenant_templ.cloudverifier_port))
+        logger.error("Error: %s "%str(e))
+        raise tornado.gen.Return(None)
+    
+    inst_response_body = response.json()
+    
+    if response.status_code != 200 and response.status_code != 404:
+        logger.error("Status command response: %d Unexpected response from Cloud Verifier."%response.status_code)
+        common.log_http_response(logger,logging.ERROR,inst_response_body)
+        raise tornado.gen.Return(None)
+    
+    if "results" not in inst_response_body:
+        logger.critical("Error: unexpected http response body from Cloud Verifier: %s"%str(response.status_code))
+        raise tornado.gen.Return(None)
+    
+    # Node not added to CV (but still registered) 
+    if response.status_code == 404:
+        raise tornado.gen.Return({"operational_state" : cloud_verifier_common.CloudInstance_Operational_State.REGISTERED})
+    raise tornado.gen.Return(inst_response_body["results"])
+
+class StatusSnapshot(object):
+    """Status of every registered node, refreshed in the background.
+    
+    The node list comes from the registrar and the status of each node from the Cloud Verifier, 
+    fetched concurrently on the IOLoop.  Web requests are answered from the snapshot together with
+    the time it was taken, so they never wait on the registrar or verifier.
+    """
+    
+    def __init__(self,interval):
+        self.interval = interval
+        self.instances = {}
+        self.updated = None
+        self.refreshing = None
+    
+    def start(self):
+        tornado.ioloop.IOLoop.current().add_callback(self.refresh)
+        if self.interval>0:
+            tornado.ioloop.PeriodicCallback(self.refresh, self.interval*1000).start()
+        if config.getboolean('tenant','webapp_status_feed'):
+            tornado.ioloop.IOLoop.current().add_callback(self.follow)
+    
+    @tornado.gen.coroutine
+    def follow(self):
+        """Update the snapshot from the Cloud Verifier's status change feed as nodes change state"""
+        since = ""
+        wait = config.getfloat('cloud_verifier','event_wait')
+        while True:
+            try:
+                response = yield tornado_requests.request_async("GET",
+                                                                "http://%s:%s/v2/events/%s"%(tenant_templ.cloudverifier_ip,tenant_templ.cloudverifier_port,since),
+                                                                context=tenant_templ.context,timeout=wait+FEED_TIMEOUT_MARGIN)
+                if response.status_code != 200:
+                    raise Exception("unexpected response code %d"%response.status_code)
+                results = response.json()["results"]
+                
+                if results["truncated"]:
+                    yield self.refresh()
+                else:
+                    changed = set(event["instance_id"] for event in results["events"])
+                    yield [self.refresh_instance(instance_id) for instance_id in changed]
+                since = results["last"]
+            except Exception as e:
+                logger.warning("Unable to follow the status change feed of the Cloud Verifier: %s"%e)
+                yield tornado.gen.sleep(FEED_RETRY_INTERVAL)
+    
+    def refresh(self):
+        """Returns a future for a refresh of all nodes, joining the one in progress if there is one"""
+        if self.refreshing is not None:
+            return self.refreshing
+        future = self.do_refresh()
+        if not future.done():
+            self.refreshing = future
+        return future
+    
+    @tornado.gen.coroutine
+    def do_refresh(self):
+        try:
+            instance_ids = yield get_instance_ids()
+            if instance_ids is None:
+                return
+            states = yield [get_instance_state(instance_id) for instance_id in instance_ids]
+            now = time.time()
+            instances = {}
+            for instance_id,state in zip(instance_ids,states):
+                if state is None:
+                    # keep the last known status of nodes that could not be reached this time,
+                    # and list nodes never reached with an unknown state rather than hiding them
+                    if instance_id in self.instances:
+                        instances[instance_id] = self.instances[instance_id]
+                    else:
+                        instances[instance_id] = {'id':instance_id,'operational_state':UNKNOWN_STATE,'updated':now}
+                    continue
+                state['id'] = instance_id
+                state['updated'] = now
+                instances[instance_id] = state
+            self.instances = instances
+            self.updated = now
+        except Exception as e:
+            logger.warning("Unable to refresh the status of nodes: %s"%e)
+        finally:
+            self.refreshing = None
+    
+    @tornado.gen.coroutine
+    def refresh_instance(self,instance_id):
+        """Fetch the status of a single node right away, returns it or None"""
+        state = yield get_instance_state(instance_id)
+        if state is not None:
+            state['id'] = instance_id
+            state['updated'] = time.time()
+            self.instances[instance_id] = state
+        raise tornado.gen.Return(state)
+    
+    def sorted_ids(self):
+        """Returns the ids of all nodes ordered by operational state"""
+        sorted_by_state = {}
+        for instance_id,state in self.instances.iteritems():
+            sorted_by_state.setdefault(state["operational_state"],[]).append(instance_id)
+        
+        sorted_instances = []
+        for state in PRINT_ORDER:
+            sorted_instances.extend(sorted(sorted_by_state.get(state,[])))
+        return sorted_instances
+
+snapshot = StatusSnapshot(config.getfloat('tenant','webapp_refresh_interval'))
+
+def init_job_db(db_filename):
+    """Open the table of node add jobs.  Each job is a row keyed by its id in the instance_id column."""
+    cols_db = {
+        'instance_id': 'TEXT PRIMARY_KEY',
+        'node_id': 'TEXT',
+        'state': 'TEXT',
+        'created': 'REAL',
+        'started': 'REAL',
+        'finished': 'REAL',
+        'error': 'TEXT',
+        }
+    # always sqlite, job states have to survive a restart so that interrupted jobs can be marked failed
+    return keylime_db.open_db(db_filename,cols_db,[],{})
+
+class JobQueue(object):
+    """Adds nodes on a pool of worker threads so the IOLoop stays free for other users.
+    
+    Adding a node generates keys and certificates and waits on the verifier and the node, so 
+    node adds are accepted right away as jobs.  The state of each job (queued, running, done or 
+    failed) is kept in the job database so that it outlives the request that started the job.  
+    Jobs left queued or running by a previous run of the webapp are marked failed on startup.
+    """
+    def __init__(self,db,num_workers):
+        self.db = db
+        self.executor = ThreadPoolExecutor(num_workers)
+        now = time.time()
+        for state in ['queued','running']:
+            for job_id in self.db.find_instance_ids({'state':state}):
+                self.db.update_instance_fields(job_id,{'state':'failed','finished':now,'error':'interrupted by a restart of the webapp'})
+    
+    def submit(self,instance_id,args):
+        now = time.time()
+        # jobs still queued or running are kept however old they are, their threads still write to them
+        for state in ['done','failed']:
+            self.db.remove_instances_before('created',now-JOB_RETENTION,{'state':state})
+        
+        job_id = uuid.uuid4().hex
+        self.db.add_instance(job_id,{'node_id':instance_id,'state':'queued','created':now,'started':None,'finished':None,'error':None})
+        self.executor.submit(self.run,tornado.ioloop.IOLoop.current(),job_id,instance_id,args)
+        return job_id
+    
+    def run(self,ioloop,job_id,instance_id,args):
+        """Add the node, runs on a worker thread"""
+        self.db.update_instance_fields(job_id,{'state':'running','started':time.time()})
+        state = 'done'
+        error = None
+        try:
+            mytenant = tenant.Tenant()
+            mytenant.node_uuid = instance_id
+            if not tenant.run_command(mytenant,'add',args):
+                raise Exception("unable to validate the quote of node %s"%instance_id)
+        except Exception as e:
+            logger.warning("Adding node %s failed: %s"%(instance_id,e))
+            state = 'failed'
+            error = str(e)
+        self.db.update_instance_fields(job_id,{'state':state,'finished':time.time(),'error':error})
+        ioloop.add_callback(snapshot.refresh_instance,instance_id)
+
 
 class Node_Init_Types:
     FILE = '0'
@@ -79,283 +330,104 @@ class MainHandler(tornado.web.RequestHandler):
     def get(self):
         common.echo_json_response(self, 405, "Not Implemented: Use /webapp or /v2/nodes interface instead")
 
-class WebAppHandler(BaseHandler):       
-    def head(self):
-        """HEAD not supported"""
-        common.echo_json_response(self, 405, "HEAD not supported")
-  
-    def get(self):
-        """This method handles the GET requests to retrieve status on instances for all nodes in a Web-based GUI.
-        
-        Currently, only the web app is available for GETing, i.e. /webapp. All other GET uri's 
-        will return errors. 
-        """
-        
-        # Get list of instances from Registrar  
-        try:
-            response = tornado_requests.request("GET",
-                                        "http://%s:%s/v2/nodes/"%(tenant_templ.webapp_ip,tenant_templ.webapp_port),context=tenant_templ.context)
-        except Exception as e:
-            logger.error("Status command response: %s:%s Unexpected response from WebApp API."%(tenant_templ.webapp_ip,tenant_templ.webapp_port))
-            logger.error(traceback.print_exc())
-            logger.error("Error: %s "%str(e))
-            raise e
-        
-        response_body = response.json()
-        
-        if response.status_code != 200:
-            logger.error("Status command response: %d Unexpected response from WebApp API."%response.status_code)
-            common.log_http_response(logger,logging.ERROR,response_body)
-            return None
-        
-        if ("results" not in response_body) or ("uuids" not in response_body["results"]):
-            logger.critical("Error: unexpected http response body from WebApp API: %s"%str(response.status_code))
-            return None 
-        
-        instance_list = response_body["results"]["uuids"]
-        
-        # Get default policies for TPM/vTPM from config as suggestions to user 
-        tpm_policy = json.dumps(json.loads(config.get('tenant', 'tpm_policy')), indent=2)
-        vtpm_policy = json.dumps(json.loads(config.get('tenant', 'vtpm_policy')), indent=2)
-        
-        self.set_status(200)
-        self.set_header('Content-Type', 'text/html')
-        self.write(
-            """
-            <!DOCTYPE html>
-            <html>
-                <head>
-                    <meta charset='UTF-8'>
-                    <title>Advanced Tenant Management System</title>
-                    <script type='text/javascript' src='/static/js/webapp.js'></script>
-                    <link href='/static/css/webapp.css' rel='stylesheet' type='text/css'/>
-                </head>
-                <body>
-                    <div id='modal_box' onclick="if (event.target == this) {toggleVisibility(this.id);resetAddNodeForm();return false;}">
-                    
-            """
-        )
-        
-        self.write(
-            """
-                        <div id='modal_body'>
-                            <center>
-                                <h3>Add Node</h3>
-                                <h4 id='uuid_str'></h4>
-                            </center>
-                            <form id='add_node' name='add_node' onsubmit='submitAddNodeForm(this); return false;'>
-                                <div class="form_block">
-                                    <label for='node_ip'>Node IP: </label>
-                                    <input type='text' id='node_ip' name='node_ip' value='127.0.0.1' required onfocus='this.select()'>
-                                    <br>
-                                </div>
-                                
-                                <div id='imalist_toggle' onclick="toggleVisibility('imalist_block');" title='IMA Configuration'>
-                                    IMA Configuration
-                                </div>
-                                <div id="imalist_block">
-                                    <div class="form_block">
-                                        <label for='w_list'>Whitelist: </label>
-                                        <div id='w_list' name='w_list' class='file_drop'>
-                                            <i>Drag payload here &hellip;</i>
-                                        </div>
-                                        <input type='hidden' name='w_list_data' id='w_list_data' value=''>
-                                        <input type='hidden' name='w_list_name' id='w_list_name' value=''>
-                                        <br>
-                                    </div>
-                                    
-                                    <div class="form_block">
-                                        <label for='e_list'>Exclude: </label>
-                                        <div id='e_list' name='e_list' class='file_drop'>
-                                            <i>Drag payload here &hellip;</i>
-                                        </div>
-                                        <input type='hidden' name='e_list_data' id='e_list_data' value=''>
-                                        <input type='hidden' name='e_list_name' id='e_list_name' value=''>
-                                        <br>
-                                    </div>
-                                </div>
-                                <br>
-                                
-                                <div id='policy_toggle' onclick="toggleVisibility('policy_block');" title='TPM &amp; vTPM Policy Configuration'>
-                                    TPM &amp; vTPM Policy Configuration
-                                </div>
-                                <div id="policy_block">
-                                    <div class="form_block">
-                                        <label for='tpm_policy'>TPM Policy: </label><br>
-                                        <textarea class='json_input' id='tpm_policy' name='tpm_policy'>{0}</textarea>
-                                        <br>
-                                    </div>
-                                    
-                                    <div class="form_block">
-                                        <label for='vtpm_policy'>vTPM Policy: </label><br>
-                                        <textarea class='json_input' id='vtpm_policy' name='vtpm_policy'>{1}</textarea>
-                                        <br>
-                                    </div>
-                                </div>
-                                <br>
-            """.format(tpm_policy, vtpm_policy)
-        )
-        
-        self.write(
-            """
-                                <div id="payload_block">
-                                    <div class="form_block">
-                                        <label for='ptype'>Payload type: </label>
-                                        <label><input type='radio' name='ptype' value='{0}' checked="checked" onclick='toggleTabs(this.value)'> File </label>&nbsp;
-                                        <label><input type='radio' name='ptype' value='{1}' onclick='toggleTabs(this.value)'> Keyfile </label>&nbsp;
-                                        <label><input type='radio' name='ptype' value='{2}' onclick='toggleTabs(this.value)'> CA Dir </label>&nbsp;
-                                        <br>
-                                    </div>
-            """.format(Node_Init_Types.FILE, Node_Init_Types.KEYFILE, Node_Init_Types.CA_DIR)
-        )
-        
-        self.write(
-            """
-                                    <div id='keyfile_container' class="form_block" style="display:none;">
-                                        <label for='file'>Keyfile: </label>
-                                        <div id='keyfile' name='keyfile' class='file_drop'>
-                                            <i>Drag key file here &hellip;</i>
-                                        </div>
-                                        <input type='hidden' name='keyfile_data' id='keyfile_data' value=''>
-                                        <input type='hidden' name='keyfile_name' id='keyfile_name' value=''>
-                                        <br>
-                                    </div>
-                                    
-                                    <div id='file_container' class="form_block">
-                                        <label for='file'>Payload: </label>
-                                        <div id='file' name='file' class='file_drop'>
-                                            <i>Drag payload here &hellip;</i>
-                                        </div>
-                                        <input type='hidden' name='file_data' id='file_data' value=''>
-                                        <input type='hidden' name='file_name' id='file_name' value=''>
-                                        <br>
-                                    </div>
-                                    
-                                    <div id='ca_dir_container' style="display:none;">
-                                        <div class="form_block">
-                                            <label for='ca_dir'>CA Dir: </label>
-                                            <input type='text' id='ca_dir' name='ca_dir' placeholder='e.g., default'>
-                                            <br>
-                                        </div>
-                                        
-                                        <div class="form_block">
-                                            <label for='ca_dir_pw'>CA Password: </label>
-                                            <input type='password' id='ca_dir_pw' name='ca_dir_pw' placeholder='e.g., default'>
-                                            <br>
-                                        </div>
-                                        
-                                        <div class="form_block">
-                                            <label for='include_dir'>Include dir: </label>
-                                            <div id='include_dir' name='include_dir' class='file_drop multi_file'>
-                                                <i>Drag files here &hellip;</i>
-                                            </div>
-                                            <input type='hidden' name='include_dir_data' id='include_dir_data' value=''>
-                                            <input type='hidden' name='include_dir_name' id='include_dir_name' value=''>
-                                            <br>
-                                        </div>
-                                    </div>
-                                </div>
-                                <br>
-                                
-                                <input type='hidden' name='uuid' id='uuid' value=''>
-                                <center><button type="submit" value="Add Node">Add Node</button></center>
-                                <br>
-                            </form>
-                        </div>
-                    </div>
-                    
-                    <div id="header">
-                        <div class="logo" title="Keylime">&nbsp;</div>
-                        <div id="header_banner">
-                            <h1>Keylime Advanced Tenant Management System</h1>
-                        </div>
-                        <div class="logo" style="float:right;" title="Keylime">&nbsp;</div>
-                       <br style="clear:both;">
-                    </div>
-                    
-                    <div id="instance_body">
-                        <h2>Instances</h2>
-                        <div class='table_header'>
-                            <div class='table_control'>&nbsp;</div>
-                            <div class='table_col'>UUID</div>
-                            <div class='table_col'>address</div>
-                            <div class='table_col'>status</div>
-                            <br style='clear:both;' />
-                        </div>
-                        <div id='node_container'>
-            """
-        )
-        
-        # Print out all instance node entries (if any) 
-        if len(instance_list) == 0:
-            self.write(
-                """
-                            <div style="color:#888;margin-left:15px;padding:10px;">
-                                <i>No nodes registered</i>
-                            </div>
-                """
-            )
-        else:
-            for instance_id in instance_list:
-                self.write(
-                    """
-                            <div id='{0}'>
-                                <div id='{0}-over' style='display:block;cursor:help;width:800px;'></div>
-                                <div id='{0}-det' style='display:none;'></div>
-                            </div>
-                    """.format(instance_id)
-                )
-        
-        self.write(
-            """
-                        </div>
-                    </div>
-                </body>
-            </html>
-            """
-        )
-        
+class AssetHandler(tornado.web.RequestHandler):
+    """Serves the prebuilt web app page and static files, gzip compressed if the browser accepts it"""
+    assets = None
+    name = None
+    cache_control = None
+    def initialize(self, assets, cache_control, name=None):
+        self.assets = assets
+        self.cache_control = cache_control
+        self.name = name
+    
+    def head(self, path=None):
+        self.get(path, include_body=False)
+    
+    def get(self, path=None, include_body=True):
+        asset = self.assets.get(self.name or path)
+        if asset is None:
+            raise tornado.web.HTTPError(404)
+        
+        gzipped = asset['gzip'] is not None and 'gzip' in self.request.headers.get('Accept-Encoding','')
+        (body,etag) = (asset['gzip'],asset['gzip_etag']) if gzipped else (asset['body'],asset['etag'])
+        self.set_header('Content-Type', asset['content_type'])
+        self.set_header('Cache-Control', self.cache_control)
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+        self.set_header('Content-Length', len(body))
+        if include_body:
+            self.write(body)
+
+class StaticAssets(object):
+    """The static files of the web app, loaded, compressed and hashed once at startup.
+    
+    The web app page itself is rendered from the webapp.html template with the default policies
+    from the config.  Node data is only served through the JSON API.
+    """
+    # files smaller than this are not worth compressing
+    MIN_GZIP_LENGTH = 256
+    
+    def __init__(self,static_dir):
+        self.assets = {}
+        for root,_,files in os.walk(static_dir):
+            for filename in files:
+                path = os.path.join(root,filename)
+                with open(path,'rb') as f:
+                    self.add(os.path.relpath(path,static_dir),f.read())
+        
+        page = tornado.template.Template(self.assets.pop('webapp.html')['body']).generate(
+            tpm_policy=json.dumps(json.loads(config.get('tenant', 'tpm_policy')), indent=2),
+            vtpm_policy=json.dumps(json.loads(config.get('tenant', 'vtpm_policy')), indent=2),
+            FILE=Node_Init_Types.FILE,
+            KEYFILE=Node_Init_Types.KEYFILE,
+            CA_DIR=Node_Init_Types.CA_DIR)
+        self.add('webapp.html',page)
+    
+    def add(self,name,body):
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type+='; charset=UTF-8'
+        etag = hashlib.sha1(body).hexdigest()
+        
+        compressed = None
+        if len(body)>=self.MIN_GZIP_LENGTH and not content_type.startswith('image/'):
+            buf = cStringIO.StringIO()
+            with gzip.GzipFile(mode='wb',fileobj=buf,compresslevel=9,mtime=0) as f:
+                f.write(body)
+            if buf.tell()<len(body):
+                compressed = buf.getvalue()
+        
+        self.assets[name] = {'body':body,
+                             'etag':'"%s"'%etag,
+                             'gzip':compressed,
+                             'gzip_etag':'"%s-gzip"'%etag,
+                             'content_type':content_type}
+    
+    def get(self,name):
+        return self.assets.get(name,None)
 
 class InstancesHandler(BaseHandler):       
+    jobs = None
+    def initialize(self, jobs):
+        self.jobs = jobs
+    
     def head(self):
         """HEAD not supported"""
         common.echo_json_response(self, 405, "HEAD not supported")
     
     
-    def get_instance_state(self, instance_id):
-        try:
-            response = tornado_requests.request("GET",
-                                        "http://%s:%s/v2/instances/%s"%(tenant_templ.cloudverifier_ip,tenant_templ.cloudverifier_port,instance_id),context=tenant_templ.context)
-        except Exception as e:
-            logger.error("Status command response: %s:%s Unexpected response from Cloud Verifier."%(tenant_templ.cloudverifier_ip,tenant_templ.cloudverifier_port))
-            logger.error(traceback.print_exc())
-            logger.error("Error: %s "%str(e))
-            raise e
-        
-        inst_response_body = response.json()
-        
-        if response.status_code != 200 and response.status_code != 404:
-            logger.error("Status command response: %d Unexpected response from Cloud Verifier."%response.status_code)
-            common.log_http_response(logger,logging.ERROR,inst_response_body)
-            return None
-        
-        if "results" not in inst_response_body:
-            logger.critical("Error: unexpected http response body from Cloud Verifier: %s"%str(response.status_code))
-            return None 
-        
-        # Node not added to CV (but still registered) 
-        if response.status_code == 404:
-            return {"operational_state" : cloud_verifier_common.CloudInstance_Operational_State.REGISTERED}
-        else:
-            return inst_response_body["results"]
-        
-        return None
-    
+    @tornado.gen.coroutine
     def get(self):
         """This method handles the GET requests to retrieve status on instances from the WebApp. 
         
         Currently, only the web app is available for GETing, i.e. /v2/nodes. All other GET uri's 
-        will return errors. 
+        will return errors.  Status is served from the background-refreshed snapshot, the updated
+        field gives the time it was fetched.
         """
         
         rest_params = common.get_restful_params(self.request.path)
@@ -368,58 +440,21 @@ class InstancesHandler(BaseHandler):
         instance_id = rest_params["nodes"]
         
         if instance_id is not None:
-            instances = self.get_instance_state(instance_id)
-            instances["id"] = instance_id
+            instance = snapshot.instances.get(instance_id,None)
+            if instance is None:
+                instance = yield snapshot.refresh_instance(instance_id)
+            if instance is None:
+                common.echo_json_response(self, 500, "Unable to retrieve status of node")
+                return
             
-            common.echo_json_response(self, 200, "Success", instances)
+            common.echo_json_response(self, 200, "Success", instance)
         else:
-            # Get list of instances from Registrar  
-            try:
-                response = tornado_requests.request("GET",
-                                            "http://%s:%s/v2/instances/"%(tenant_templ.registrar_ip,tenant_templ.registrar_port),context=tenant_templ.context)
-            except Exception as e:
-                logger.error("Status command response: %s:%s Unexpected response from Registrar."%(tenant_templ.registrar_ip,tenant_templ.registrar_port))
-                logger.error(traceback.print_exc())
-                logger.error("Error: %s "%str(e))
-                raise e
-            
-            response_body = response.json()
-            
-            if response.status_code != 200:
-                logger.error("Status command response: %d Unexpected response from Registrar."%response.status_code)
-                common.log_http_response(logger,logging.ERROR,response_body)
-                return None
+            if snapshot.updated is None:
+                yield snapshot.refresh()
             
-            if ("results" not in response_body) or ("uuids" not in response_body["results"]):
-                logger.critical("Error: unexpected http response body from Registrar: %s"%str(response.status_code))
-                return None 
-            
-            instance_list = response_body["results"]["uuids"]
-            
-            # Loop through each instance and ask for status
-            instances = {}
-            for instance in instance_list:
-                instances[instance] = self.get_instance_state(instance_id)
-            
-            # Pre-create sorted instances list 
-            sorted_by_state = {}
-            states = cloud_verifier_common.CloudInstance_Operational_State.STR_MAPPINGS
-            for state in states:
-                sorted_by_state[state] = {}
-            
-            # Build sorted instances list 
-            for instance_id in instances:
-                state = instances[instance_id]["operational_state"]
-                sorted_by_state[state][instance_id] = instances[instance_id]
-            
-            print_order = [9,7,3,4,5,6,2,1,8,0]
-            sorted_instances = []
-            for state in print_order:
-                for instance_id in sorted_by_state[state]:
-                    sorted_instances.append(instance_id)
-            
-            common.echo_json_response(self, 200, "Success", {'uuids':sorted_instances})
+            common.echo_json_response(self, 200, "Success", {'uuids':snapshot.sorted_ids(),'updated':snapshot.updated})
 
+    @tornado.gen.coroutine
     def delete(self):
         """This method handles the DELETE requests to remove instances from the Cloud Verifier. 
          
@@ -439,7 +474,8 @@ class InstancesHandler(BaseHandler):
         # let Tenant do dirty work of deleting node 
         mytenant = tenant.Tenant()
         mytenant.node_uuid = instance_id
-        mytenant.do_cvdelete()
+        yield self.jobs.executor.submit(mytenant.do_cvdelete)
+        tornado.ioloop.IOLoop.current().add_callback(snapshot.refresh_instance,instance_id)
         
         common.echo_json_response(self, 200, "Success")
     
@@ -447,7 +483,8 @@ class InstancesHandler(BaseHandler):
         """This method handles the POST requests to add instances to the Cloud Verifier. 
          
         Currently, only instances resources are available for POSTing, i.e. /v2/nodes. All other POST uri's will return errors.
-        instances requests require a json block sent in the body
+        instances requests require a json block sent in the body.  The node is added in the background, the 
+        202 response holds the id of the job to follow with /v2/jobs/.
         """
         
         rest_params = common.get_restful_params(self.request.path)
@@ -532,21 +569,13 @@ class InstancesHandler(BaseHandler):
             'ima_exclude': ima_exclude,
         }
         
-        # let Tenant do dirty work of adding node 
-        try:
-            mytenant = tenant.Tenant()
-            mytenant.node_uuid = instance_id
-            mytenant.init_add(args)
-            mytenant.preloop()
-            mytenant.do_cv()
-            mytenant.do_quote()
-        except Exception as e:
-            logger.warning('POST returning 500 response. tenant error')
-            common.echo_json_response(self, 500, "Request failure", str(e))
-            return
+        # let Tenant do dirty work of adding node in the background
+        job_id = self.jobs.submit(instance_id,args)
         
-        common.echo_json_response(self, 200, "Success")
+        common.echo_json_response(self, 202, "Accepted", {'job':job_id})
+        logger.info('POST returning 202 response, adding node %s as job %s'%(instance_id,job_id))
     
+    @tornado.gen.coroutine
     def put(self):
         """This method handles the PUT requests to add instances to the Cloud Verifier. 
          
@@ -565,11 +594,41 @@ class InstancesHandler(BaseHandler):
         # let Tenant do dirty work of reactivating node 
         mytenant = tenant.Tenant()
         mytenant.node_uuid = instance_id
-        mytenant.do_cvreactivate()
+        yield self.jobs.executor.submit(mytenant.do_cvreactivate)
+        tornado.ioloop.IOLoop.current().add_callback(snapshot.refresh_instance,instance_id)
         
         common.echo_json_response(self, 200, "Success")
 
 
+class JobsHandler(BaseHandler):
+    jobs = None
+    def initialize(self, jobs):
+        self.jobs = jobs
+    
+    def get(self):
+        """This method handles the GET requests to follow node add jobs.
+        
+        /v2/jobs/id returns the node_id, state (queued, running, done or failed), the created, started and 
+        finished times and the error of a failed job.  /v2/jobs/ lists the ids of recent jobs.
+        """
+        rest_params = common.get_restful_params(self.request.path)
+        if rest_params is None or "jobs" not in rest_params:
+            common.echo_json_response(self, 400, "uri not supported")
+            logger.warning('GET returning 400 response. uri not supported: ' + self.request.path)
+            return
+        
+        job_id = rest_params["jobs"]
+        if job_id is None:
+            common.echo_json_response(self, 200, "Success", {'jobs':self.jobs.db.get_instance_ids()})
+            return
+        
+        row = self.jobs.db.get_instance(job_id)
+        if row is None:
+            common.echo_json_response(self, 404, "job id not found")
+            return
+        row['id'] = row.pop('instance_id')
+        common.echo_json_response(self, 200, "Success", row)
+
 def parse_data_uri(data_uri):
     if data_uri is None:
         return None
@@ -607,11 +666,14 @@ def main(argv=sys.argv):
     
     logger.info('Starting Tenant WebApp (tornado) on port ' + webapp_port + ', use <Ctrl-C> to stop')
     
+    jobs = JobQueue(init_job_db("%s/webapp_jobs.sqlite"%common.WORK_DIR),config.getint('tenant','webapp_job_workers'))
+    assets = StaticAssets(os.path.join(os.path.dirname(os.path.abspath(__file__)),'static'))
     app = tornado.web.Application([
         (r"/", MainHandler),                      
-        (r"/webapp/.*", WebAppHandler),
-        (r"/v2/nodes/.*", InstancesHandler),
-        (r'/static/(.*)', tornado.web.StaticFileHandler, {'path': "static/"}),
+        (r"/webapp/.*", AssetHandler, {'assets':assets,'name':'webapp.html','cache_control':'no-cache'}),
+        (r"/v2/nodes/.*", InstancesHandler, {'jobs':jobs}),
+        (r"/v2/jobs/.*", JobsHandler, {'jobs':jobs}),
+        (r'/static/(.*)', AssetHandler, {'assets':assets,'cache_control':'public, max-age=%d'%config.getint('tenant','webapp_static_max_age')}),
         ])
     
     
@@ -623,7 +685,14 @@ def main(argv=sys.argv):
     # Set up server 
     server = tornado.httpserver.HTTPServer(app,ssl_options=server_context)
     server.bind(int(webapp_port), address='0.0.0.0')
-    server.start(config.getint('cloud_verifier','multiprocessing_pool_num_workers')) 
+    # a single process: the status snapshot lives in memory, so forked processes would each poll 
+    # the registrar and verifier and a write would only refresh the copy of the process handling it.  
+    # The work that blocks runs on the job threads, so one IOLoop is enough.
+    server.start(1)
+    
+    # status of the nodes is fetched concurrently, up to this many requests at a time
+    AsyncHTTPClient.configure(None, max_clients=config.getint('tenant','webapp_max_concurrent_requests'))
+    snapshot.start()
     
     try:
         tornado.ioloop.IOLoop.instance().start()
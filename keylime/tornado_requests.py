@@ -18,33 +18,196 @@ above. Use of this work other than as specifically authorized by the U.S. Govern
 violate any copyrights that exist in this work.
 '''
 from tornado import httpclient
+from tornado import gen
+from tornado import httputil
 import json
+import httplib
+import urllib
+import urlparse
+import socket
+import errno
+import threading
+import collections
+import time
+import zlib
 
-def request(method,url,params=None,data=None,context=None):
-    http_client = httpclient.HTTPClient()        
-    if params is not None and len(params.keys())>0:
-        url+='?'
-        for key in params.keys():
-            url+="%s=%s&"%(key,params[key])
-        url=url[:-1]
+# limits for the process-wide connection pool used by request()
+MAX_CONNECTIONS_PER_HOST = 10
+MAX_POOLS = 100
+IDLE_TIMEOUT = 30
+REQUEST_TIMEOUT = 20
+MAX_REDIRECTS = 5
+
+class ConnectionPool(object):
+    """Keep-alive connections shared by every synchronous request in the process.
+    
+    Connections are pooled per scheme, host, port and TLS context, so a context that is reused
+    by the caller also reuses its connections.  At most MAX_CONNECTIONS_PER_HOST requests are
+    in flight to the same pool at once, further callers wait for a free connection.  Idle
+    connections are dropped after IDLE_TIMEOUT seconds and the least recently used pools are
+    closed once there are more than MAX_POOLS of them.  Connections of a closed pool that are still
+    in use are closed when they are released.
+    """
+    
+    def __init__(self,max_connections=MAX_CONNECTIONS_PER_HOST,max_pools=MAX_POOLS,idle_timeout=IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_pools = max_pools
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # key -> [context, semaphore, list of (connection, last used), closed]
+        self.pools = collections.OrderedDict()
+    
+    def get_pool(self,key,context):
+        with self.lock:
+            pool = self.pools.pop(key,None)
+            if pool is None:
+                # hold on to the context so its id is not reused while the pool exists
+                pool = [context,threading.BoundedSemaphore(self.max_connections),[],False]
+            self.pools[key]=pool
+            while len(self.pools)>self.max_pools:
+                _,old = self.pools.popitem(last=False)
+                self.close_pool(old)
+            return pool
+    
+    def close_pool(self,pool):
+        """Close the idle connections of a pool and make sure the busy ones are not returned to it.  
+        
+        Must be called with the lock held.
+        """
+        pool[3] = True
+        for conn,_ in pool[2]:
+            conn.close()
+        del pool[2][:]
     
+    def acquire(self,scheme,host,port,context,timeout):
+        """Returns the pool, a connection and whether that connection was used before"""
+        pool = self.get_pool((scheme,host,port,id(context)),context)
+        pool[1].acquire()
+        now = time.time()
+        with self.lock:
+            while len(pool[2])>0:
+                conn,last_used = pool[2].pop()
+                if now-last_used < self.idle_timeout:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return pool,conn,True
+                conn.close()
+        if scheme=='https':
+            conn = httplib.HTTPSConnection(host,port,timeout=timeout,context=context)
+        else:
+            conn = httplib.HTTPConnection(host,port,timeout=timeout)
+        return pool,conn,False
+    
+    def release(self,pool,conn,reusable):
+        with self.lock:
+            # nobody would take the connection out of a pool that was closed while it was in use
+            reusable = reusable and not pool[3]
+            if reusable:
+                pool[2].append((conn,time.time()))
+        if not reusable:
+            conn.close()
+        pool[1].release()
+    
+    def close(self):
+        with self.lock:
+            for pool in self.pools.itervalues():
+                self.close_pool(pool)
+            self.pools.clear()
+
+pool = ConnectionPool()
+
+def build_url(url,params=None,context=None):
+    if params:
+        url+='?'+urllib.urlencode(params)
     if context is not None:
         url = url.replace('http://','https://',1)
+    return url
+
+def is_stale(e):
+    """A reused keep-alive connection that the server already closed"""
+    if isinstance(e,(httplib.BadStatusLine,httplib.CannotSendRequest)):
+        return True
+    return isinstance(e,socket.error) and e.errno in (errno.ECONNRESET,errno.EPIPE,errno.ECONNABORTED)
+
+def decode_body(response,body):
+    encoding = response.getheader('content-encoding','').lower()
+    if encoding=='gzip':
+        return zlib.decompress(body,16+zlib.MAX_WBITS)
+    elif encoding=='deflate':
+        return zlib.decompress(body)
+    return body
+
+def send(method,url,data,context,headers,timeout):
+    parsed = urlparse.urlsplit(url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path+='?'+parsed.query
+    
+    req_headers = {'Accept-Encoding':'gzip'}
+    if data is not None and method in ('POST','PUT','PATCH'):
+        req_headers['Content-Type']='application/x-www-form-urlencoded'
+    if headers:
+        req_headers.update(headers)
+    
+    while True:
+        p,conn,reused = pool.acquire(parsed.scheme,parsed.hostname,parsed.port,context,timeout)
+        try:
+            conn.request(method,path,body=data,headers=req_headers)
+            response = conn.getresponse()
+            body = response.read()
+        except Exception as e:
+            pool.release(p,conn,False)
+            # retry once on a fresh connection if the server dropped an idle one
+            if reused and is_stale(e):
+                continue
+            raise
+        pool.release(p,conn,not response.will_close)
+        return response,decode_body(response,body)
+
+def request(method,url,params=None,data=None,context=None,headers=None,timeout=REQUEST_TIMEOUT):
+    """Synchronous request over the process-wide keep-alive connection pool.
+    
+    If a TLS context is given the request is made over https with it.  Any HTTP response is 
+    returned as a tornado_response.  As with the tornado HTTPClient this replaces, a timeout or a 
+    connection the server closed without a response is returned as a response with code 500, while 
+    other connection errors such as a refused connection are raised.
+    """
+    url = build_url(url,params,context)
+    for _ in range(MAX_REDIRECTS+1):
+        try:
+            response,body = send(method,url,data,context,headers,timeout)
+        except socket.timeout as e:
+            return tornado_response(500,"Timeout: %s"%e)
+        except httplib.HTTPException as e:
+            return tornado_response(500,"Connection closed: %r"%e)
+        location = response.getheader('location')
+        if response.status not in (301,302,303,307,308) or location is None:
+            break
+        url = urlparse.urljoin(url,location)
+        if response.status==303:
+            method = 'GET'
+            data = None
+    return tornado_response(response.status,body,httputil.HTTPHeaders(response.getheaders()))
+
+@gen.coroutine
+def request_async(method,url,params=None,data=None,context=None,headers=None,timeout=REQUEST_TIMEOUT):
+    """Same as request() for callers running on an IOLoop, using the loop's shared AsyncHTTPClient"""
+    req = httpclient.HTTPRequest(url=build_url(url,params,context),
+                                 method=method,
+                                 ssl_options=context,
+                                 headers=headers,
+                                 body=data,
+                                 decompress_response=True,
+                                 connect_timeout=timeout,
+                                 request_timeout=timeout)
     try:
-        request = httpclient.HTTPRequest(url=url,
-                                         method =method,
-                                         ssl_options=context,
-                                         body=data)
-        response = http_client.fetch(request)
-        http_client.close()
+        response = yield httpclient.AsyncHTTPClient().fetch(req)
     except httpclient.HTTPError as e:
         if e.response is None:
-            return tornado_response(500,str(e))
-        
-        return tornado_response(e.response.code,e.response.body)
-    if response is None:
-        return None
-    return tornado_response(response.code,response.body)
+            raise gen.Return(tornado_response(500,str(e)))
+        raise gen.Return(tornado_response(e.response.code,e.response.body,e.response.headers))
+    raise gen.Return(tornado_response(response.code,response.body,response.headers))
 
 def is_refused(e):
     if hasattr(e,'strerror'):
@@ -54,9 +217,12 @@ def is_refused(e):
 
 class tornado_response():
     
-    def __init__(self,code,body):
+    def __init__(self,code,body,headers=None):
         self.status_code = code
         self.body = body
+        if headers is None:
+            headers = httputil.HTTPHeaders()
+        self.headers = headers
         
     def json(self):
         try:
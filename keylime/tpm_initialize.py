@@ -35,11 +35,23 @@ import crypto
 from tpm_ek_ca import *
 import M2Crypto
 from M2Crypto import m2
+import struct
+import hashlib
+from Cryptodome.Util.number import long_to_bytes
+import threading
+import collections
 
 logger = common.init_logging('tpm_initialize')
 
 global_tpmdata = None
 
+# TPM 1.2 structure constants used to build identity activation blobs
+TPM_ALG_RSA = 0x00000001
+TPM_ALG_AES256 = 0x00000009
+TPM_ES_NONE = 0x0001
+TPM_ES_SYM_CBC_PKCS5PAD = 0x00ff
+TPM_SS_RSASSAPKCS1v15_SHA1 = 0x0002
+
 def random_password(length=20):
     rand = crypto.generate_random_key(length)
     chars = string.ascii_uppercase + string.digits + string.ascii_lowercase
@@ -88,6 +100,9 @@ def take_ownership(config_pw):
         logger.info("Taking ownership of TPM")
         tpm_exec.run("takeown -pwdo %s -nopubsrk"%owner_pw)
         ownerpw_known = True
+        # a new owner means a new SRK, nothing looked up before still holds
+        if tpm_context is not None:
+            tpm_context.invalidate()
     else:
         logger.debug("TPM ownership already taken")
         
@@ -194,6 +209,8 @@ def flush_keys():
         if len(tokens)==4 and tokens[0]=='Key' and tokens[1]=='handle':
             handle = tokens[3]
             tpm_exec.run("flushspecific -ha %s -rt 1"%handle)
+    if tpm_context is not None:
+        tpm_context.invalidate_aik()
             
 def load_aik():
     # is the key already there?
@@ -233,63 +250,42 @@ def load_aik():
     
     return handle
   
+def tpm_pubkey(pubkey):
+    """Serialize an RSA public key the way a TPM 1.2 identity key is serialized in a TPM_PUBKEY"""
+    modulus = long_to_bytes(pubkey.n)
+    exponent = ''
+    # an exponent size of 0 stands for the default exponent
+    if pubkey.e!=65537:
+        exponent = long_to_bytes(pubkey.e)
+    # TPM_RSA_KEY_PARMS
+    rsa_parms = struct.pack(">III",len(modulus)*8,2,len(exponent))+exponent
+    # TPM_KEY_PARMS
+    key_parms = struct.pack(">IHHI",TPM_ALG_RSA,TPM_ES_NONE,TPM_SS_RSASSAPKCS1v15_SHA1,len(rsa_parms))+rsa_parms
+    # TPM_STORE_PUBKEY
+    return key_parms+struct.pack(">I",len(modulus))+modulus
+
 def encryptAIK(uuid,pubaik,pubek):
-    pubaikFile=None
-    pubekFile=None
-    keyblob = None
-    blobpath = None
-    keypath = None
+    """Create the blob that TPM_ActivateIdentity on the TPM holding the EK opens for the given AIK.
     
+    The blob is a TPM_ASYM_CA_CONTENTS carrying a fresh AES key and the digest of the AIK, 
+    encrypted with the EK.  Returns the base64 encoded blob and key, or False on error.
+    """
     try:
-        # write out pubaik
-        pfd, ptemp = tempfile.mkstemp()
-        pubaikFile = open(ptemp,"wb")
-        pubaikFile.write(pubaik)
-        pubaikFile.close()
-        os.close(pfd)
-        
-        # write out the public EK
-        efd, etemp = tempfile.mkstemp()
-        pubekFile = open(etemp,"wb")
-        pubekFile.write(pubek)
-        pubekFile.close()
-        os.close(efd)
+        aik = crypto.rsa_import_pubkey(pubaik)
+        ek = crypto.rsa_import_pubkey(pubek)
+        key = crypto.generate_random_key(32)
         
-        #create temp files for the blob
-        blobfd,blobpath = tempfile.mkstemp()
-        keyfd,keypath = tempfile.mkstemp()
-        
-        tpm_exec.run("encaik -ik %s -ek %s -ok %s -oak %s"%(pubaikFile.name,pubekFile.name,blobpath,keypath),lock=False)
+        # TPM_SYMMETRIC_KEY followed by the idDigest
+        contents = struct.pack(">IHH",TPM_ALG_AES256,TPM_ES_SYM_CBC_PKCS5PAD,len(key))+key
+        contents += hashlib.sha1(tpm_pubkey(aik)).digest()
+        keyblob = crypto.tpm_rsa_encrypt(ek,contents)
         
         logger.info("Encrypting AIK for UUID %s"%uuid)
-        
-        # read in the blob
-        f = open(blobpath,"rb")
-        keyblob = base64.b64encode(f.read())
-        f.close()
-        os.close(blobfd)
-        
-        # read in the aes key
-        f = open(keypath,"rb")
-        key = base64.b64encode(f.read())
-        f.close()
-        os.close(keyfd)
-        
     except Exception as e:
         logger.error("Error encrypting AIK: "+str(e))
         logger.error(traceback.format_exc())
         return False
-    finally:
-        if pubaikFile is not None:
-            os.remove(pubaikFile.name)
-        if pubekFile is not None:
-            os.remove(pubekFile.name)
-        if blobpath is not None:
-            os.remove(blobpath)
-        if keypath is not None:
-            os.remove(keypath)
-        pass
-    return (keyblob,key)
+    return (base64.b64encode(keyblob),base64.b64encode(key))
 
     
 def activate_identity(keyblob):
@@ -341,25 +337,104 @@ def activate_identity(keyblob):
             os.remove(secpath)
     return key
 
-#openssl x509 -inform der -in certificate.cer -out certificate.pem
+def get_key_id(cert,extension):
+    """Returns the key identifier held in a key identifier extension of the certificate or None"""
+    try:
+        value = cert.get_ext(extension).get_value()
+    except LookupError:
+        return None
+    if extension == 'subjectKeyIdentifier':
+        return value.strip().upper()
+    # the authority key identifier may also name the issuer and serial of the signer
+    for line in value.splitlines():
+        line = line.strip()
+        if line.startswith('keyid:'):
+            return line[len('keyid:'):].upper()
+    return None
+
+class EKTrustStore(object):
+    """The trusted EK signers from tpm_ek_ca, parsed once.
+    
+    Signer certificates are indexed by subject DN and subject key identifier so that an EK 
+    certificate is checked against the signer named by its issuer and authority key identifier
+    first.  Only if none of those verify it are the remaining signers tried, which includes the 
+    bare Atmel keys as they have no name to index.
+    """
+    def __init__(self,certs,keys):
+        self.signers = []
+        self.by_subject = {}
+        self.by_key_id = {}
+        for name in certs:
+            signcert = M2Crypto.X509.load_cert_string(certs[name])
+            signer = (name,signcert.get_pubkey())
+            self.signers.append(signer)
+            self.by_subject.setdefault(signcert.get_subject().as_der(),[]).append(signer)
+            key_id = get_key_id(signcert,'subjectKeyIdentifier')
+            if key_id is not None:
+                self.by_key_id.setdefault(key_id,[]).append(signer)
+        
+        for name in keys:
+            e = m2.bn_to_mpi(m2.hex_to_bn(keys[name]['exponent']))
+            n = m2.bn_to_mpi(m2.hex_to_bn(keys[name]['key']))
+            rsa = M2Crypto.RSA.new_pub_key((e, n))
+            pubkey = M2Crypto.EVP.PKey()
+            pubkey.assign_rsa(rsa)
+            self.signers.append((name,pubkey))
+    
+    def find_signer(self,ek509):
+        """Returns the name of the trusted signer of the certificate or None"""
+        candidates = []
+        key_id = get_key_id(ek509,'authorityKeyIdentifier')
+        if key_id is not None:
+            candidates.extend(self.by_key_id.get(key_id,[]))
+        candidates.extend(self.by_subject.get(ek509.get_issuer().as_der(),[]))
+        
+        tried = set()
+        for name,pubkey in candidates+self.signers:
+            if name in tried:
+                continue
+            tried.add(name)
+            if ek509.verify(pubkey) == 1:
+                return name
+        return None
+
+ek_trust_store = None
+ek_trust_store_lock = threading.Lock()
+
+# verification results by digest of the EK certificate and public EK
+EK_CACHE_SIZE = 4096
+ek_cache = collections.OrderedDict()
+ek_cache_lock = threading.Lock()
+
+def get_ek_trust_store():
+    global ek_trust_store
+    with ek_trust_store_lock:
+        if ek_trust_store is None:
+            ek_trust_store = EKTrustStore(trusted_certs,atmel_trusted_keys)
+            logger.debug("Loaded %d trusted EK signers"%len(ek_trust_store.signers))
+        return ek_trust_store
+
 def verify_ek(ekcert,ekpem):
     """Verify that the provided EK certificate is signed by a trusted root
     :param ekcert: The Endorsement Key certificate in DER format
     :param ekpem: the endorsement public key in PEM format
     :returns: True if the certificate can be verified, false otherwise
     """
-    tmppath = None
-    try:
-        # write out key blob
-        tmpfd, tmppath = tempfile.mkstemp()
-        ekFile = open(tmppath,"wb")
-        ekFile.write(ekpem)
-        ekFile.close()
-        os.close(tmpfd)
-        pubekmod = base64.b64decode(get_mod_from_pem(tmppath))
-    finally:
-        if tmppath is not None:
-            os.remove(tmppath)
+    digest = hashlib.sha256(ekcert+ekpem).digest()
+    with ek_cache_lock:
+        if digest in ek_cache:
+            return ek_cache[digest]
+    
+    result = check_ek(ekcert,ekpem)
+    
+    with ek_cache_lock:
+        ek_cache[digest] = result
+        while len(ek_cache)>EK_CACHE_SIZE:
+            ek_cache.popitem(last=False)
+    return result
+
+def check_ek(ekcert,ekpem):
+    pubekmod = long_to_bytes(crypto.rsa_import_pubkey(ekpem).n)
     
     ek509 = M2Crypto.X509.load_cert_der_string(ekcert)
     
@@ -367,22 +442,10 @@ def verify_ek(ekcert,ekpem):
         logger.error("Public EK does not match EK certificate")
         return False
     
-    for signer in trusted_certs:
-        signcert = M2Crypto.X509.load_cert_string(trusted_certs[signer])
-        signkey = signcert.get_pubkey()
-        if ek509.verify(signkey) == 1:
-            logger.debug("EK cert matched signer %s"%signer)
-            return True
-
-    for key in atmel_trusted_keys:
-        e = m2.bn_to_mpi(m2.hex_to_bn(atmel_trusted_keys[key]['exponent']))
-        n = m2.bn_to_mpi(m2.hex_to_bn(atmel_trusted_keys[key]['key']))
-        rsa = M2Crypto.RSA.new_pub_key((e, n))
-        pubkey = M2Crypto.EVP.PKey()
-        pubkey.assign_rsa(rsa)
-        if ek509.verify(pubkey) == 1:
-            logger.debug("EK cert matched trusted key %s"%key)
-            return True
+    signer = get_ek_trust_store().find_signer(ek509)
+    if signer is not None:
+        logger.debug("EK cert matched signer %s"%signer)
+        return True
     logger.error("No Root CA matched EK Certificate")
     return False
 
@@ -436,9 +499,77 @@ def set_tpm_metadata(key,value):
         global_tpmdata = read_tpm_data()
     global_tpmdata[key]=value
     write_tpm_data()
+    if tpm_context is not None:
+        tpm_context.metadata_changed(key)
+
+class TPMContext(object):
+    """TPM state the node needs on every quote, looked up once and kept until explicitly invalidated.
+    
+    Holds the manufacturer, whether the TPM is a vTPM, the owner password, the handle the AIK 
+    is loaded at and the digest last bound into TPM_DATA_PCR.  The AIK handle is dropped when keys 
+    are flushed and when the AIK metadata changes.  invalidate() drops everything and is called 
+    whenever the TPM is initialized, when ownership is taken and when a quote fails.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.invalidate()
+    
+    def invalidate(self):
+        with self.lock:
+            self.manufacturer = None
+            self.vtpm = None
+            self.owner_pw = None
+            self.aik_handle = None
+            self.bound_digest = None
+    
+    def invalidate_aik(self):
+        with self.lock:
+            self.aik_handle = None
+    
+    def metadata_changed(self,key):
+        if key=='owner_pw':
+            with self.lock:
+                self.owner_pw = None
+        elif key in ['aik','aikpriv','aikmod']:
+            self.invalidate_aik()
+    
+    def get_manufacturer(self):
+        with self.lock:
+            if self.manufacturer is None:
+                self.manufacturer = get_tpm_manufacturer()
+            return self.manufacturer
+    
+    def is_vtpm(self):
+        with self.lock:
+            if self.vtpm is None:
+                self.vtpm = is_vtpm()
+            return self.vtpm
+    
+    def get_owner_pw(self):
+        with self.lock:
+            if self.owner_pw is None:
+                self.owner_pw = get_tpm_metadata('owner_pw')
+            return self.owner_pw
+    
+    def get_aik_handle(self):
+        with self.lock:
+            if self.aik_handle is None:
+                self.aik_handle = load_aik()
+            return self.aik_handle
+
+tpm_context = None
+
+def get_tpm_context():
+    """Returns the process wide TPMContext, creating it on first use"""
+    global tpm_context
+    if tpm_context is None:
+        tpm_context = TPMContext()
+    return tpm_context
 
 def init(self_activate=False,config_pw=None):
     if not common.STUB_TPM:
+        # the TPM may have been reset or cleared since the context was filled
+        get_tpm_context().invalidate()
         create_ek()
         take_ownership(config_pw)
         
@@ -452,7 +583,7 @@ def init(self_activate=False,config_pw=None):
         create_aik(self_activate)
         
         # preemptively load AIK up
-        load_aik()
+        get_tpm_context().get_aik_handle()
         
         return get_tpm_metadata('ek'),get_tpm_metadata('ekcert'),get_tpm_metadata('aik')
     else:
@@ -45,6 +45,71 @@ def check_mask(mask,pcr):
         return False
     return bool(1<<pcr & int(mask,0))
 
+def merkle_leaf(nonce):
+    return hashlib.sha1('\x00'+nonce).digest()
+
+def merkle_node(left,right):
+    return hashlib.sha1('\x01'+left+right).digest()
+
+def merkle_tree(nonces):
+    """Build a Merkle tree over the nonces of a batch of quote requests.
+    
+    Returns the root as a hex string, which is quoted in place of the nonces, and for every nonce
+    a proof of its inclusion.  A proof lists the sibling hashes from the leaf up to the root, each
+    prefixed with L or R for the side the sibling is on.  A node without a sibling moves up as is.
+    """
+    level = [merkle_leaf(nonce) for nonce in nonces]
+    positions = range(len(nonces))
+    proofs = [[] for _ in nonces]
+    while len(level)>1:
+        for i in range(len(nonces)):
+            pos = positions[i]
+            if pos%2==1:
+                proofs[i].append('L'+level[pos-1].encode('hex'))
+            elif pos+1<len(level):
+                proofs[i].append('R'+level[pos+1].encode('hex'))
+            positions[i] = pos/2
+        level = [merkle_node(level[j],level[j+1]) if j+1<len(level) else level[j] for j in range(0,len(level),2)]
+    return level[0].encode('hex'),proofs
+
+def merkle_root(nonce,proof):
+    """Returns the root of the Merkle tree the proof places nonce in"""
+    digest = merkle_leaf(nonce)
+    for step in proof:
+        sibling = str(step[1:]).decode('hex')
+        if step[0]=='L':
+            digest = merkle_node(sibling,digest)
+        elif step[0]=='R':
+            digest = merkle_node(digest,sibling)
+        else:
+            raise Exception("Invalid Merkle proof step %s"%step)
+    return digest.encode('hex')
+
+def read_pcr(pcr):
+    """Returns the value of a PCR as lower case hex.  Must be called with tpmutilLock held."""
+    output = tpm_exec.run("pcrread -ix %d"%pcr,lock=False)[0]
+    return output[0].split()[5].lower()
+
+def bind_data(context,data):
+    """Reset and extend TPM_DATA_PCR with the hash of data unless it already holds it.  
+    
+    Must be called with tpmutilLock held.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    # the PCR is in an unknown state until it is confirmed or the extend succeeds
+    bound = context.bound_digest == digest
+    context.bound_digest = None
+    if bound:
+        # the PCR may have been reset or extended by someone else since we bound it
+        expected = hashlib.sha1(EMPTY_PCR.decode('hex')+hashlib.sha1(digest).digest()).hexdigest()
+        if read_pcr(common.TPM_DATA_PCR) == expected:
+            context.bound_digest = digest
+            return
+        logger.warning("PCR %d no longer holds the bound data, binding it again"%common.TPM_DATA_PCR)
+    tpm_exec.run("pcrreset -ix %d"%common.TPM_DATA_PCR,lock=False)
+    tpm_exec.run("extend -ix %d -ic %s"%(common.TPM_DATA_PCR,digest),lock=False)
+    context.bound_digest = digest
+
 def create_deep_quote(nonce,data=None,vpcrmask=EMPTYMASK,pcrmask=EMPTYMASK):
     # don't deep quote when developing
     if common.DEVELOP_IN_ECLIPSE or common.STUB_TPM:
@@ -55,8 +120,9 @@ def create_deep_quote(nonce,data=None,vpcrmask=EMPTYMASK,pcrmask=EMPTYMASK):
     quotepath = None
     try:
         # read in the vTPM key handle
-        keyhandle = tpm_initialize.load_aik()
-        owner_pw = tpm_initialize.get_tpm_metadata('owner_pw')
+        context = tpm_initialize.get_tpm_context()
+        keyhandle = context.get_aik_handle()
+        owner_pw = context.get_owner_pw()
 
         if pcrmask is None:
             pcrmask = EMPTYMASK
@@ -68,15 +134,19 @@ def create_deep_quote(nonce,data=None,vpcrmask=EMPTYMASK,pcrmask=EMPTYMASK):
             if data is not None:
                 # add PCR 16 to pcrmask
                 pcrmask = "0x%X"%(int(pcrmask,0) + (1 << common.TPM_DATA_PCR))
-                tpm_exec.run("pcrreset -ix %d"%common.TPM_DATA_PCR,lock=False)
-                tpm_exec.run("extend -ix %d -ic %s"%(common.TPM_DATA_PCR,hashlib.sha1(data).hexdigest()),lock=False)
+                bind_data(context,data)
             
             #make a temp file for the quote 
             quotefd,quotepath = tempfile.mkstemp()
             
             command = "deepquote -vk %s -hm %s -vm %s -nonce %s -pwdo %s -oq %s" % (keyhandle, pcrmask, vpcrmask, nonce, owner_pw,quotepath)
             #print("Executing %s"%(command))
-            tpm_exec.run(command,lock=False)
+            try:
+                tpm_exec.run(command,lock=False)
+            except Exception:
+                # the key may have been evicted or the TPM reset, look everything up again next time
+                context.invalidate()
+                raise
 
         # read in the quote
         f = open(quotepath,"rb")
@@ -97,7 +167,8 @@ def create_quote(nonce,data=None,pcrmask=EMPTYMASK):
         
     quotepath = None
     try:
-        keyhandle = tpm_initialize.load_aik()
+        context = tpm_initialize.get_tpm_context()
+        keyhandle = context.get_aik_handle()
         if pcrmask is None:
             pcrmask = EMPTYMASK
 
@@ -105,12 +176,16 @@ def create_quote(nonce,data=None,pcrmask=EMPTYMASK):
             if data is not None:
                 # add PCR 16 to pcrmask
                 pcrmask = "0x%X"%(int(pcrmask,0) + (1 << common.TPM_DATA_PCR))
-                tpm_exec.run("pcrreset -ix %d"%common.TPM_DATA_PCR,lock=False)
-                tpm_exec.run("extend -ix %d -ic %s"%(common.TPM_DATA_PCR,hashlib.sha1(data).hexdigest()),lock=False)
+                bind_data(context,data)
             
             #make a temp file for the quote 
             quotefd,quotepath = tempfile.mkstemp()
-            tpm_exec.run("tpmquote -hk %s -bm %s -nonce %s -noverify -oq %s"%(keyhandle,pcrmask,nonce,quotepath),lock=False)
+            try:
+                tpm_exec.run("tpmquote -hk %s -bm %s -nonce %s -noverify -oq %s"%(keyhandle,pcrmask,nonce,quotepath),lock=False)
+            except Exception:
+                # the key may have been evicted or the TPM reset, look everything up again next time
+                context.invalidate()
+                raise
             
         # read in the quote
         f = open(quotepath,"rb")
@@ -131,10 +206,14 @@ def is_deep_quote(quote):
     else:
         raise Exception("Invalid quote type %s"%quote[0])
 
-def check_deep_quote(nonce,data,quote,vAIK,hAIK,vtpm_policy={},tpm_policy={},ima_measurement_list=None,ima_whitelist={}):
+def check_deep_quote(nonce,data,quote,vAIK,hAIK,vtpm_policy={},tpm_policy={},ima_measurement_list=None,ima_whitelist={},merkle_proof=None):
     quoteFile=None
     vAIKFile=None
     hAIKFile=None
+    
+    # a quote shared by a batch of requests is over the root of the tree of their nonces
+    if merkle_proof is not None:
+        nonce = merkle_root(nonce,merkle_proof)
 
     if common.STUB_TPM:
         nonce = common.TEST_DQ_NONCE
@@ -214,9 +293,13 @@ def check_deep_quote(nonce,data,quote,vAIK,hAIK,vtpm_policy={},tpm_policy={},ima
     # don't pass in data to check pcrs for physical quote 
     return check_pcrs(tpm_policy,pcrs,None,False,None,None) and check_pcrs(vtpm_policy, vpcrs, data, True,ima_measurement_list,ima_whitelist)
 
-def check_quote(nonce,data,quote,aikFromRegistrar,tpm_policy={},ima_measurement_list=None,ima_whitelist={}):
+def check_quote(nonce,data,quote,aikFromRegistrar,tpm_policy={},ima_measurement_list=None,ima_whitelist={},merkle_proof=None):
     quoteFile=None
     aikFile=None
+    
+    # a quote shared by a batch of requests is over the root of the tree of their nonces
+    if merkle_proof is not None:
+        nonce = merkle_root(nonce,merkle_proof)
 
     if common.STUB_TPM:
         nonce = common.TEST_NONCE
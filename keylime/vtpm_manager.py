@@ -38,7 +38,7 @@ import tpm_exec
 from uuid import UUID
 
 sys.path.append(os.path.dirname(__file__))
-from tpm_initialize import get_mod_from_pem
+from tpm_initialize import get_mod_from_pem, encryptAIK
 
 # Logging boiler plate
 logger = common.init_logging('vtpmmgr')
@@ -419,10 +419,19 @@ def do_register_test_helper(groupnum=1,
     aikpem = ginfo['aikpem']
     goalkey = symkey + '.goal'
 
-    # Use encaik to obtain keyblob and goalkey (normally whoever is using
-    # us would handle providing the keyblob)
-    check_call('encaik -ik {0!r} -ek {1!r} -ok {2!r} -oak {3!r}'.format(
-        aikpem, pubekpem, keyblob, goalkey), shell=True)
+    # Build the keyblob and goalkey (normally whoever is using us would
+    # handle providing the keyblob)
+    with open(aikpem, 'rb') as f:
+        pubaik = f.read()
+    with open(pubekpem, 'rb') as f:
+        pubek = f.read()
+    result = encryptAIK(ginfo['uuid'], pubaik, pubek)
+    if result is False:
+        raise Exception('unable to build the keyblob for group %d' % groupnum)
+    with open(keyblob, 'wb') as f:
+        f.write(base64.b64decode(result[0]))
+    with open(goalkey, 'wb') as f:
+        f.write(base64.b64decode(result[1]))
 
     # Obtain the symkey via group activate
     symkey_raw = get_group_symkey(groupnum, aikpem, pubekpem, keyblob)
@@ -430,7 +439,7 @@ def do_register_test_helper(groupnum=1,
         f.write(symkey_raw)
     logger.info('Wrote %s', symkey)
 
-    # Verify the key we got from the VTPM is the same as we'd get from encaik
+    # Verify the key we got from the VTPM is the one we put in the keyblob
     check_call('diff "{0}" "{1}"'.format(symkey, goalkey), shell=True)
     print('[vtpmmgr] Test succeeded')
 
@@ -0,0 +1,69 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import os
+import unittest
+import shutil
+import tempfile
+
+import testenv
+
+import cloud_verifier_common
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir,'events.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_append_and_read(self):
+        log = cloud_verifier_common.EventLog(self.filename,10)
+        self.assertEqual(log.bounds(),(0,0))
+        events = log.append([('a',None,1,1.0),('a',1,3,2.0),('b',3,None,3.0)])
+        self.assertEqual([event['seq'] for event in events],[1,2,3])
+        self.assertEqual(log.read(1,10),events[1:])
+        self.assertEqual(log.read(0,2),events[:2])
+        self.assertEqual(log.bounds(),(1,3))
+        self.assertEqual(log.append([]),[])
+
+    def test_keeps_most_recent(self):
+        log = cloud_verifier_common.EventLog(self.filename,3)
+        log.append([('a',i,i+1,float(i)) for i in range(5)])
+        self.assertEqual(log.bounds(),(3,5))
+        self.assertEqual([event['old_state'] for event in log.read(0,10)],[2,3,4])
+
+    def test_shared_between_logs(self):
+        # the same ordering for every worker process
+        log = cloud_verifier_common.EventLog(self.filename,10)
+        other = cloud_verifier_common.EventLog(self.filename,10)
+        log.append([('a',None,1,1.0)])
+        other.append([('b',None,1,2.0)])
+        self.assertEqual([event['instance_id'] for event in log.read(0,10)],['a','b'])
+
+    def test_memory(self):
+        log = cloud_verifier_common.EventLog(':memory:',10)
+        log.append([('a',None,1,1.0)])
+        self.assertEqual(log.bounds(),(1,1))
+
+if __name__ == '__main__':
+    unittest.main()
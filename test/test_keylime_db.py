@@ -0,0 +1,187 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import testenv
+
+import keylime_db
+import keylime_sqlite
+
+cols_db = {'instance_id': 'TEXT PRIMARY_KEY',
+           'v': 'TEXT',
+           'port': 'INT',
+           'tpm_policy': 'TEXT',
+           'operational_state': 'INT'}
+json_cols_db = ['tpm_policy']
+exclude_db = {'pending_event': None}
+
+def sqlite_engine(tmpdir):
+    return keylime_sqlite.KeylimeDB(os.path.join(tmpdir,'test.sqlite'),cols_db,json_cols_db,exclude_db)
+
+def memory_engine(tmpdir):
+    return keylime_db.KeylimeMemoryDB(cols_db,json_cols_db,exclude_db)
+
+def log_engine(tmpdir):
+    return keylime_db.KeylimeLogDB(os.path.join(tmpdir,'test.log'),cols_db,json_cols_db,exclude_db)
+
+class EngineTests(object):
+    """Behaviour expected of every storage engine, mixed into one TestCase per engine.
+    
+    Each TestCase sets engine to a function that opens its engine in a scratch directory.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = self.engine(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def instance(self,**kwargs):
+        d = {'v':'abc','port':9002,'tpm_policy':{'22':['ffff']},'operational_state':1}
+        d.update(kwargs)
+        return d
+
+    def test_add_get(self):
+        d = self.db.add_instance('node1',self.instance())
+        self.assertEqual(d['tpm_policy'],{'22':['ffff']})
+        got = self.db.get_instance('node1')
+        self.assertEqual(got['instance_id'],'node1')
+        self.assertEqual(got['v'],'abc')
+        self.assertEqual(got['port'],9002)
+        self.assertEqual(got['tpm_policy'],{'22':['ffff']})
+        self.assertTrue('pending_event' in got)
+        self.assertEqual(self.db.get_instance('missing'),None)
+
+    def test_add_does_not_overwrite(self):
+        self.db.add_instance('node1',self.instance())
+        self.assertEqual(self.db.add_instance('node1',self.instance(v='new')),None)
+        self.assertEqual(self.db.get_instance('node1')['v'],'abc')
+
+    def test_types_match_sqlite(self):
+        self.db.add_instance('node1',self.instance())
+        got = self.db.get_instance('node1')
+        self.assertTrue(isinstance(got['instance_id'],unicode))
+        self.assertTrue(isinstance(got['v'],unicode))
+        self.assertTrue(isinstance(got['port'],int))
+
+    def test_update(self):
+        self.db.add_instance('node1',self.instance())
+        self.db.update_instance('node1','operational_state',3)
+        self.db.update_instance('node1','tpm_policy',{'23':['aaaa']})
+        got = self.db.get_instance('node1')
+        self.assertEqual(got['operational_state'],3)
+        self.assertEqual(got['tpm_policy'],{'23':['aaaa']})
+        self.assertRaises(Exception,self.db.update_instance,'node1','bogus',1)
+
+    def test_update_all(self):
+        self.db.add_instance('node1',self.instance())
+        self.db.add_instance('node2',self.instance())
+        self.db.update_all_instances('operational_state',7)
+        for instance_id in ['node1','node2']:
+            self.assertEqual(self.db.get_instance(instance_id)['operational_state'],7)
+
+    def test_overwrite(self):
+        self.db.add_instance('node1',self.instance())
+        got = self.db.get_instance('node1')
+        got['v'] = 'xyz'
+        got['tpm_policy'] = {'10':['bbbb']}
+        self.db.overwrite_instance('node1',got)
+        got = self.db.get_instance('node1')
+        self.assertEqual(got['v'],'xyz')
+        self.assertEqual(got['tpm_policy'],{'10':['bbbb']})
+        self.assertEqual(got['instance_id'],'node1')
+
+    def test_remove_count(self):
+        self.assertEqual(self.db.count_instances(),0)
+        self.db.add_instance('node1',self.instance())
+        self.db.add_instance('node2',self.instance())
+        self.assertEqual(self.db.count_instances(),2)
+        self.assertEqual(sorted(self.db.get_instance_ids()),['node1','node2'])
+        self.assertTrue(self.db.remove_instance('node1'))
+        self.assertFalse(self.db.remove_instance('node1'))
+        self.assertEqual(self.db.count_instances(),1)
+        self.assertEqual(self.db.get_instance('node1'),None)
+
+    def test_find_instance_ids(self):
+        self.db.add_instance('node1',self.instance())
+        self.db.add_instance('node2',self.instance(port=9003))
+        self.db.add_instance('node3',self.instance(port=9003,operational_state=2))
+        self.assertEqual(sorted(self.db.find_instance_ids({'port':9003})),['node2','node3'])
+        self.assertEqual(self.db.find_instance_ids({'port':9003,'operational_state':2}),['node3'])
+        self.assertEqual(self.db.find_instance_ids({'v':u'abc','port':9002}),['node1'])
+        self.assertEqual(len(self.db.find_instance_ids({})),3)
+        self.assertRaises(Exception,self.db.find_instance_ids,{'tpm_policy':{}})
+        self.assertRaises(Exception,self.db.find_instance_ids,{'bogus':1})
+
+    def test_update_instance_fields(self):
+        self.db.add_instance('node1',self.instance())
+        self.db.update_instance_fields('node1',{'port':9003,'tpm_policy':{'23':['0']}})
+        got = self.db.get_instance('node1')
+        self.assertEqual((got['port'],got['tpm_policy'],got['v']),(9003,{'23':['0']},'abc'))
+        self.db.update_instance_fields('missing',{'port':1})
+        self.assertEqual(self.db.count_instances(),1)
+        self.assertRaises(Exception,self.db.update_instance_fields,'node1',{'bogus':1})
+
+    def test_remove_instances_before(self):
+        for port in [9001,9002,9003]:
+            self.db.add_instance('node%d'%port,self.instance(port=port))
+        self.assertEqual(self.db.remove_instances_before('port',9003),2)
+        self.assertEqual(self.db.get_instance_ids(),['node9003'])
+        self.assertEqual(self.db.remove_instances_before('port',9003),0)
+
+    def test_remove_instances_before_matching(self):
+        self.db.add_instance('node1',self.instance(port=9001,operational_state=2))
+        self.db.add_instance('node2',self.instance(port=9001,operational_state=3))
+        self.db.add_instance('node3',self.instance(port=9003,operational_state=2))
+        self.assertEqual(self.db.remove_instances_before('port',9003,{'operational_state':2}),1)
+        self.assertEqual(sorted(self.db.get_instance_ids()),['node2','node3'])
+
+    def test_same_as_sqlite(self):
+        reference = keylime_sqlite.KeylimeDB(os.path.join(self.tmpdir,'reference.sqlite'),cols_db,json_cols_db,exclude_db)
+        for db in [self.db,reference]:
+            db.add_instance('node1',self.instance())
+            db.update_instance('node1','port',9003)
+        self.assertEqual(self.db.get_instance('node1'),reference.get_instance('node1'))
+
+class SqliteEngineTest(EngineTests,unittest.TestCase):
+    engine = staticmethod(sqlite_engine)
+
+class MemoryEngineTest(EngineTests,unittest.TestCase):
+    engine = staticmethod(memory_engine)
+
+class LogEngineTest(EngineTests,unittest.TestCase):
+    engine = staticmethod(log_engine)
+
+    def test_replay(self):
+        self.db.add_instance('node1',self.instance())
+        self.db.update_instance('node1','operational_state',5)
+        self.db.add_instance('node2',self.instance())
+        self.db.remove_instance('node2')
+        reopened = self.engine(self.tmpdir)
+        self.assertEqual(reopened.get_instance_ids(),['node1'])
+        self.assertEqual(reopened.get_instance('node1'),self.db.get_instance('node1'))
+
+if __name__ == '__main__':
+    unittest.main()
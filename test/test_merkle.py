@@ -0,0 +1,72 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import hashlib
+import unittest
+
+import testenv
+
+import tpm_quote
+
+class MerkleTest(unittest.TestCase):
+
+    def nonces(self,count):
+        return ['nonce%03d'%i for i in range(count)]
+
+    def test_every_proof_leads_to_the_root(self):
+        for count in range(1,18):
+            nonces = self.nonces(count)
+            root,proofs = tpm_quote.merkle_tree(nonces)
+            self.assertEqual(len(proofs),count)
+            for nonce,proof in zip(nonces,proofs):
+                self.assertEqual(tpm_quote.merkle_root(nonce,proof),root)
+
+    def test_single_nonce(self):
+        root,proofs = tpm_quote.merkle_tree(['only'])
+        self.assertEqual(proofs,[[]])
+        self.assertEqual(root,hashlib.sha1('\x00only').hexdigest())
+
+    def test_two_nonces(self):
+        root,proofs = tpm_quote.merkle_tree(['a','b'])
+        left = tpm_quote.merkle_leaf('a')
+        right = tpm_quote.merkle_leaf('b')
+        self.assertEqual(root,hashlib.sha1('\x01'+left+right).hexdigest())
+        self.assertEqual(proofs,[['R'+right.encode('hex')],['L'+left.encode('hex')]])
+
+    def test_wrong_nonce_or_position(self):
+        nonces = self.nonces(5)
+        root,proofs = tpm_quote.merkle_tree(nonces)
+        self.assertNotEqual(tpm_quote.merkle_root('other',proofs[0]),root)
+        self.assertNotEqual(tpm_quote.merkle_root(nonces[0],proofs[1]),root)
+        # a proof of an interior node can't pass for a leaf
+        interior = tpm_quote.merkle_node(tpm_quote.merkle_leaf(nonces[2]),tpm_quote.merkle_leaf(nonces[3]))
+        self.assertNotEqual(tpm_quote.merkle_root(interior,proofs[2][1:]),root)
+
+    def test_invalid_step(self):
+        root,proofs = tpm_quote.merkle_tree(self.nonces(2))
+        self.assertRaises(Exception,tpm_quote.merkle_root,'nonce000',['X'+proofs[0][0][1:]])
+
+    def test_order_matters(self):
+        root,_ = tpm_quote.merkle_tree(['a','b','c'])
+        other,_ = tpm_quote.merkle_tree(['b','a','c'])
+        self.assertNotEqual(root,other)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import unittest
+import ConfigParser
+
+import testenv
+
+import cloud_verifier_common
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        bucket = cloud_verifier_common.TokenBucket(2,3,100.0)
+        for _ in range(3):
+            self.assertEqual(bucket.consume(100.0),0)
+        self.assertAlmostEqual(bucket.consume(100.0),0.5)
+        # a refused request does not take a token
+        self.assertAlmostEqual(bucket.wait(100.25),0.25)
+        self.assertEqual(bucket.consume(100.5),0)
+
+    def test_refill_capped_at_capacity(self):
+        bucket = cloud_verifier_common.TokenBucket(10,2,0.0)
+        bucket.consume(0.0)
+        bucket.refill(1000.0)
+        self.assertEqual(bucket.tokens,2)
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def make(self,client,change):
+        config = ConfigParser.RawConfigParser()
+        config.add_section('cloud_verifier')
+        for key,value in [('rate_limit','True'),('rate_limit_burst','1'),('max_loop_lag','0'),
+                          ('rate_limit_client',client),('rate_limit_status','0'),('rate_limit_change',change)]:
+            config.set('cloud_verifier',key,value)
+        return cloud_verifier_common.AdmissionControl(config)
+
+    def test_rejected_by_endpoint_keeps_client_tokens(self):
+        admission = self.make('5','1')
+        self.assertEqual(admission.admit('a','change'),0)
+        self.assertTrue(admission.admit('a','change')>0)
+        # the refused change must not have used up a client token
+        self.assertEqual(int(admission.clients['a'].tokens),4)
+
+    def test_rejected_by_client_keeps_endpoint_tokens(self):
+        admission = self.make('1','5')
+        self.assertEqual(admission.admit('a','change'),0)
+        self.assertTrue(admission.admit('a','change')>0)
+        self.assertEqual(admission.admit('b','change'),0)
+        self.assertEqual(int(admission.endpoints['change'].tokens),3)
+
+    def test_unlimited_endpoint(self):
+        admission = self.make('0','0')
+        for _ in range(100):
+            self.assertEqual(admission.admit('a','status'),0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import os
+import unittest
+import shutil
+import tempfile
+import json
+
+import testenv
+
+import tornado.web
+import tornado.testing
+import registrar_client
+import registrar_common
+
+A = ('10.0.0.1','8890','8891')
+B = ('10.0.0.2','8890','8891')
+C = ('10.0.0.3','8890','8891')
+
+class RegistrarRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = ['node-%d'%i for i in range(2000)]
+
+    def test_owner_is_stable(self):
+        ring = registrar_client.RegistrarRing([A,B])
+        other = registrar_client.RegistrarRing([B,A])
+        for instance_id in self.ids[:100]:
+            self.assertEqual(ring.owner(instance_id),other.owner(instance_id))
+
+    def test_owners_lists_every_shard_once(self):
+        ring = registrar_client.RegistrarRing([A,B,C])
+        for instance_id in self.ids[:100]:
+            owners = ring.owners(instance_id)
+            self.assertEqual(sorted(owners),sorted([A,B,C]))
+            self.assertEqual(owners[0],ring.owner(instance_id))
+
+    def test_balanced(self):
+        ring = registrar_client.RegistrarRing([A,B,C])
+        counts = {A:0,B:0,C:0}
+        for instance_id in self.ids:
+            counts[ring.owner(instance_id)]+=1
+        for shard in counts:
+            self.assertTrue(counts[shard]>len(self.ids)/6,counts)
+
+    def test_adding_a_shard_only_moves_ids_to_it(self):
+        before = registrar_client.RegistrarRing([A,B])
+        after = registrar_client.RegistrarRing([A,B,C])
+        moved = 0
+        for instance_id in self.ids:
+            if before.owner(instance_id)!=after.owner(instance_id):
+                self.assertEqual(after.owner(instance_id),C)
+                moved+=1
+        self.assertTrue(0<moved<len(self.ids)/2)
+
+    def test_single_shard(self):
+        ring = registrar_client.RegistrarRing([A])
+        self.assertEqual(ring.owners('node'),[A])
+
+    def test_no_shards(self):
+        self.assertRaises(Exception,registrar_client.RegistrarRing,[])
+
+    def test_parse_shard(self):
+        self.assertEqual(registrar_client.parse_shard(' 10.0.0.1:8890:8891 '),A)
+        self.assertRaises(Exception,registrar_client.parse_shard,'10.0.0.1:8890')
+
+class ShardHandler(registrar_common.ProtectedHandler):
+    def peer_subject(self):
+        return self.request.headers.get('X-Test-Subject',None)
+
+class HandOffTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = registrar_common.RegistrarCache(registrar_common.init_db(os.path.join(self.tmpdir,'reg.sqlite')),10)
+        workers = registrar_common.WorkerPool(1,10)
+        return tornado.web.Application([
+            (r"/v2/instances/.*", ShardHandler, {'db':self.db,'workers':workers,'shard':C,'shard_subjects':['shard-a']}),
+            ])
+
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def record(self,**kwargs):
+        d = {'key':'a2V5','aik':'aik','ek':'ek','ekcert':'virtual','virtual':0,'active':1,'provider_keys':{}}
+        d.update(kwargs)
+        return d
+
+    def hand_off(self,instance_id,record,subject='shard-a'):
+        return self.fetch('/v2/instances/%s'%instance_id,method='POST',body=json.dumps(record),headers={'X-Test-Subject':subject})
+
+    def test_active_record_served_by_new_owner(self):
+        self.assertEqual(self.hand_off('node',self.record()).code,200)
+        response = self.fetch('/v2/instances/node')
+        self.assertEqual(response.code,200)
+        keys = json.loads(response.body)['results']
+        self.assertEqual((keys['aik'],keys['ek'],keys['ekcert']),('aik','ek','virtual'))
+
+    def test_inactive_record_stays_inactive(self):
+        self.assertEqual(self.hand_off('node',self.record(active=0)).code,200)
+        self.assertEqual(self.fetch('/v2/instances/node').code,404)
+
+    def test_refused(self):
+        self.assertEqual(self.hand_off('node',self.record(),subject='stranger').code,403)
+        # the EK is checked again by the new owner
+        self.assertEqual(self.hand_off('node',self.record(ekcert=None)).code,400)
+        self.assertEqual(self.db.get_instance('node'),None)
+
+    def test_already_registered(self):
+        self.assertEqual(self.hand_off('node',self.record()).code,200)
+        self.assertEqual(self.hand_off('node',self.record()).code,409)
+
+if __name__ == '__main__':
+    unittest.main()
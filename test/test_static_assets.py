@@ -0,0 +1,110 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import os
+import unittest
+import shutil
+import tempfile
+import gzip
+import cStringIO
+
+import testenv
+
+import tornado.web
+import tornado.testing
+import tenant
+tenant.config.set('general','enable_tls','False')
+import tenant_webapp
+
+def make_static_dir():
+    static_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(static_dir,'css'))
+    with open(os.path.join(static_dir,'webapp.html'),'w') as f:
+        f.write("<html>{{ FILE }} {{ tpm_policy }}</html>")
+    with open(os.path.join(static_dir,'css','webapp.css'),'w') as f:
+        f.write("body { margin: 0; }\n"*100)
+    with open(os.path.join(static_dir,'small.js'),'w') as f:
+        f.write("let x = 1;")
+    with open(os.path.join(static_dir,'icon.png'),'wb') as f:
+        f.write("\x89PNG"*100)
+    return static_dir
+
+class StaticAssetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.static_dir = make_static_dir()
+        self.assets = tenant_webapp.StaticAssets(self.static_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.static_dir)
+
+    def test_page_rendered(self):
+        page = self.assets.get('webapp.html')
+        self.assertTrue(page['body'].startswith("<html>%s "%tenant_webapp.Node_Init_Types.FILE))
+        self.assertEqual(page['content_type'],'text/html; charset=UTF-8')
+
+    def test_compressed(self):
+        css = self.assets.get(os.path.join('css','webapp.css'))
+        self.assertEqual(css['content_type'],'text/css; charset=UTF-8')
+        self.assertEqual(gzip.GzipFile(fileobj=cStringIO.StringIO(css['gzip'])).read(),css['body'])
+        self.assertNotEqual(css['etag'],css['gzip_etag'])
+
+    def test_not_compressed(self):
+        # too small to be worth it, and images are compressed already
+        self.assertEqual(self.assets.get('small.js')['gzip'],None)
+        self.assertEqual(self.assets.get('icon.png')['gzip'],None)
+        self.assertEqual(self.assets.get('icon.png')['content_type'],'image/png')
+
+    def test_missing(self):
+        self.assertEqual(self.assets.get('missing.js'),None)
+
+class AssetHandlerTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.static_dir = make_static_dir()
+        self.assets = tenant_webapp.StaticAssets(self.static_dir)
+        return tornado.web.Application([
+            (r'/static/(.*)', tenant_webapp.AssetHandler, {'assets':self.assets,'cache_control':'public, max-age=60'}),
+            ])
+
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        shutil.rmtree(self.static_dir)
+
+    def test_gzip_and_etag(self):
+        css = self.assets.get('css/webapp.css')
+        response = self.fetch('/static/css/webapp.css',headers={'Accept-Encoding':'gzip'},decompress_response=False)
+        self.assertEqual(response.code,200)
+        self.assertEqual(response.headers['Content-Encoding'],'gzip')
+        self.assertEqual(response.headers['Cache-Control'],'public, max-age=60')
+        self.assertEqual(response.body,css['gzip'])
+        response = self.fetch('/static/css/webapp.css',headers={'Accept-Encoding':'gzip','If-None-Match':css['gzip_etag']})
+        self.assertEqual(response.code,304)
+
+    def test_plain(self):
+        response = self.fetch('/static/css/webapp.css',decompress_response=False)
+        self.assertEqual(response.headers.get('Content-Encoding'),None)
+        self.assertEqual(response.headers['Etag'],self.assets.get('css/webapp.css')['etag'])
+
+    def test_not_found(self):
+        self.assertEqual(self.fetch('/static/missing.js').code,404)
+
+if __name__ == '__main__':
+    unittest.main()
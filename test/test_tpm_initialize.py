@@ -0,0 +1,73 @@
+'''
+DISTRIBUTION STATEMENT A. Approved for public release: distribution unlimited.
+
+This material is based upon work supported by the Assistant Secretary of Defense for
+Research and Engineering under Air Force Contract No. FA8721-05-C-0002 and/or
+FA8702-15-D-0001. Any opinions, findings, conclusions or recommendations expressed in this
+material are those of the author(s) and do not necessarily reflect the views of the
+Assistant Secretary of Defense for Research and Engineering.
+
+Copyright 2017 Massachusetts Institute of Technology.
+
+The software/firmware is provided to you on an As-Is basis
+
+Delivered to the US Government with Unlimited Rights, as defined in DFARS Part
+252.227-7013 or 7014 (Feb 2014). Notwithstanding any copyright notice, U.S. Government
+rights in this work are defined by DFARS 252.227-7013 or DFARS 252.227-7014 as detailed
+above. Use of this work other than as specifically authorized by the U.S. Government may
+violate any copyrights that exist in this work.
+'''
+
+import base64
+import struct
+import hashlib
+import unittest
+
+import testenv
+
+import crypto
+import tpm_initialize
+from Cryptodome.PublicKey import RSA
+
+class EncryptAIKTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ek = RSA.generate(2048)
+        cls.aik = RSA.generate(2048)
+
+    def test_tpm_pubkey_layout(self):
+        pubkey = tpm_initialize.tpm_pubkey(self.aik.publickey())
+        algorithm,enc_scheme,sig_scheme,parms_size = struct.unpack(">IHHI",pubkey[:12])
+        self.assertEqual(algorithm,tpm_initialize.TPM_ALG_RSA)
+        self.assertEqual(enc_scheme,tpm_initialize.TPM_ES_NONE)
+        self.assertEqual(sig_scheme,tpm_initialize.TPM_SS_RSASSAPKCS1v15_SHA1)
+        # the default exponent is left out
+        self.assertEqual(parms_size,12)
+        self.assertEqual(struct.unpack(">III",pubkey[12:24]),(2048,2,0))
+        self.assertEqual(struct.unpack(">I",pubkey[24:28])[0],256)
+        self.assertEqual(pubkey[28:],tpm_initialize.long_to_bytes(self.aik.n))
+
+    def test_round_trip(self):
+        result = tpm_initialize.encryptAIK('uuid',self.aik.publickey().exportKey(),self.ek.publickey().exportKey())
+        self.assertNotEqual(result,False)
+        keyblob = base64.b64decode(result[0])
+        key = base64.b64decode(result[1])
+        self.assertEqual(len(keyblob),256)
+
+        # what TPM_ActivateIdentity recovers with the private EK: a TPM_ASYM_CA_CONTENTS
+        contents = crypto.tpm_rsa_decrypt(self.ek,keyblob)
+        # TPM 1.2 Part 2: TPM_ALG_AES256 (9), TPM_ES_SYM_CBC_PKCS5PAD (0xff) and a 32 byte key
+        self.assertEqual(contents[:8],'\x00\x00\x00\x09\x00\xff\x00\x20')
+        self.assertEqual(contents[8:40],key)
+        self.assertEqual(contents[40:],hashlib.sha1(tpm_initialize.tpm_pubkey(self.aik.publickey())).digest())
+
+    def test_plain_oaep_cannot_open(self):
+        result = tpm_initialize.encryptAIK('uuid',self.aik.publickey().exportKey(),self.ek.publickey().exportKey())
+        self.assertRaises(ValueError,crypto.rsa_decrypt,self.ek,base64.b64decode(result[0]))
+
+    def test_bad_key(self):
+        self.assertEqual(tpm_initialize.encryptAIK('uuid','garbage',self.ek.publickey().exportKey()),False)
+
+if __name__ == '__main__':
+    unittest.main()